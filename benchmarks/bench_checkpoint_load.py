@@ -0,0 +1,36 @@
+"""对比权重加载方式的冷启动耗时
+
+    python -m benchmarks.bench_checkpoint_load --checkpoint checkpoints/Metal_HQ.pth
+
+legacy: 原有方式(随机初始化 + torch.load + load_state_dict)
+fast: meta设备构建 + mmap读取 + assign
+fast+converted: 同上，但读取预先转存的fp32 zip格式权重(首次会生成缓存)
+"""
+import argparse
+import json
+import statistics
+import torch
+from src.model_loading import time_loaders
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint", default="checkpoints/Metal_HQ.pth")
+    parser.add_argument("--model-type", default="vit_l")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--cache-dir", default="checkpoints/.converted")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", default=None, help="结果另存为JSON")
+    args = parser.parse_args()
+
+    results = time_loaders(args.model_type, args.checkpoint, args.device, args.cache_dir, args.repeat)
+    print(f"{'方式':<16}{'中位数(ms)':>12}{'最小(ms)':>12}")
+    for name, times in results.items():
+        print(f"{name:<16}{statistics.median(times):>12.1f}{min(times):>12.1f}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results_ms": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""CPU推理配置的精度/延迟对比报告
+
+    python -m benchmarks.bench_cpu_profile --images samples/ --limit 10
+
+以fp32为基准，对每个配置统计编码器耗时、解码+精修耗时，以及精修后掩膜与fp32掩膜的IoU。
+未提供--manifest时，每张图使用中心50%区域作为提示框。
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+import numpy as np
+from PIL import Image
+from src.inference import Config, Inference
+from src.cpu_profile import CPU_PROFILES
+from src.batch_annotate import load_manifest
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+
+def mask_iou(a, b):
+    a = a > 0
+    b = b > 0
+    union = np.logical_or(a, b).sum()
+    if union == 0:
+        return 1.0
+    return float(np.logical_and(a, b).sum() / union)
+
+
+def sample_items(args):
+    if args.manifest:
+        items = [(p, b) for p, b in load_manifest(args.manifest) if b]
+    else:
+        items = []
+        for name in sorted(os.listdir(args.images)):
+            if name.lower().endswith(IMAGE_EXTS):
+                path = os.path.join(args.images, name)
+                w, h = Image.open(path).size
+                items.append((path, [[w * 0.25, h * 0.25, w * 0.75, h * 0.75]]))
+    return items[: args.limit]
+
+
+def run_profile(profile, items, threads):
+    config = Config()
+    config.device = "cpu"
+    config.cpu_profile = profile
+    config.cpu_threads = threads
+    config.use_embedding_store = False
+    engine = Inference(config=config)
+    encode_ms, decode_ms, masks = [], [], []
+    for path, boxes in items:
+        engine.embedding_cache.clear()
+        t0 = time.perf_counter()
+        engine.get_image_embedding(path)
+        t1 = time.perf_counter()
+        m, _ = engine.run_prompt_inference_batch(path, boxes)
+        t2 = time.perf_counter()
+        encode_ms.append((t1 - t0) * 1000.0)
+        decode_ms.append((t2 - t1) * 1000.0)
+        masks.append(m)
+    return engine.encoder_profile, encode_ms, decode_ms, masks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", default=None, help="样本图像目录")
+    parser.add_argument("--manifest", default=None, help="可选，batch_annotate格式的框清单")
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--profiles", default=",".join(CPU_PROFILES))
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--json", default=None, help="结果另存为JSON")
+    args = parser.parse_args()
+    if not args.images and not args.manifest:
+        parser.error("需要--images或--manifest")
+
+    items = sample_items(args)
+    profiles = ["fp32"] + [p for p in args.profiles.split(",") if p and p != "fp32"]
+    report = {}
+    baseline = None
+    for profile in profiles:
+        effective, encode_ms, decode_ms, masks = run_profile(profile, items, args.threads)
+        if baseline is None:
+            baseline = masks
+        ious = [mask_iou(a, b) for ma, mb in zip(masks, baseline) for a, b in zip(ma, mb)]
+        report[profile] = {
+            "effective_profile": effective,
+            "encoder_ms_median": statistics.median(encode_ms),
+            "decode_refine_ms_median": statistics.median(decode_ms),
+            "iou_vs_fp32_mean": statistics.mean(ious) if ious else None,
+            "iou_vs_fp32_min": min(ious) if ious else None,
+        }
+
+    base_ms = report["fp32"]["encoder_ms_median"]
+    print(f"样本数: {len(items)}")
+    print(f"{'配置':<8}{'实际':<8}{'编码(ms)':>10}{'加速':>8}{'解码+精修(ms)':>16}{'平均IoU':>10}{'最小IoU':>10}")
+    for profile, r in report.items():
+        print(f"{profile:<8}{r['effective_profile']:<8}{r['encoder_ms_median']:>10.1f}"
+              f"{base_ms / r['encoder_ms_median']:>7.2f}x{r['decode_refine_ms_median']:>16.1f}"
+              f"{r['iou_vs_fp32_mean']:>10.4f}{r['iou_vs_fp32_min']:>10.4f}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"samples": len(items), "profiles": report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
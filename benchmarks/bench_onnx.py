@@ -0,0 +1,123 @@
+"""ONNX Runtime后端与PyTorch的一致性与延迟对比
+
+    python -m benchmarks.bench_onnx --images samples/ --limit 10
+
+对每张图比较两个后端的图像嵌入相对误差、解码器掩膜IoU(导出的每个
+(multimask_output, hq_token_only)变体各算一次)以及精修后掩膜IoU，并统计编码器、解码器中位耗时。
+pytest中的tests/test_onnx_backend.py用随机小模型做同样的逐变体比对，无需权重。
+任一解码器或精修掩膜IoU低于--min-iou时以非零状态退出，可作为一致性检查使用。
+"""
+import argparse
+import itertools
+import json
+import statistics
+import sys
+import numpy as np
+from src.inference import Config, Inference
+from benchmarks.bench_cpu_profile import mask_iou, sample_items
+
+# OnnxSamBackend按(multimask_output, hq_token_only)各导出一个解码器
+DECODER_VARIANTS = list(itertools.product((False, True), repeat=2))
+
+
+def variant_name(multimask, hq_token_only):
+    return f"multimask_output={multimask}, hq_token_only={hq_token_only}"
+
+
+def make_engine(backend, threads):
+    config = Config()
+    config.device = "cpu"
+    config.backend = backend
+    config.cpu_threads = threads
+    config.use_embedding_store = False
+    config.crop_mode = False
+    config.progressive_preview = False
+    engine = Inference(config=config)
+    if engine.backend != backend:
+        raise RuntimeError(f"{backend}后端初始化失败")
+    return engine
+
+
+def run_backend(engine, items):
+    embeddings, decoder_masks, refined, encoder_ms, decoder_ms = [], [], [], [], []
+    for path, boxes in items:
+        engine.embedding_cache.clear()
+        masks, _, timing = engine.run_prompt_inference_batch(path, boxes, return_timing=True)
+        stages = {s["name"]: s["ms"] for s in timing["stages"]}
+        encoder_ms.append(stages.get("encoder", 0.0))
+        decoder_ms.append(stages.get("decoder", 0.0))
+        refined.append(masks)
+        entry, _ = engine.get_image_embedding(path)
+        embeddings.append(entry.features.float().cpu().numpy())
+        predictor = engine._bind_predictor(entry)
+        per_variant = {}
+        for multimask, hq_token_only in DECODER_VARIANTS:
+            per_variant[multimask, hq_token_only] = [
+                predictor.predict(box=np.array(box, dtype=np.float32), multimask_output=multimask,
+                                  hq_token_only=hq_token_only)[0]
+                for box in boxes
+            ]
+        decoder_masks.append(per_variant)
+    return embeddings, decoder_masks, refined, encoder_ms, decoder_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", default=None, help="样本图像目录")
+    parser.add_argument("--manifest", default=None, help="可选，batch_annotate格式的框清单")
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--min-iou", type=float, default=0.98, help="一致性检查的IoU下限")
+    parser.add_argument("--json", default=None, help="结果另存为JSON")
+    args = parser.parse_args()
+    if not args.images and not args.manifest:
+        parser.error("需要--images或--manifest")
+
+    items = sample_items(args)
+    results = {}
+    for backend in ("torch", "onnx"):
+        results[backend] = run_backend(make_engine(backend, args.threads), items)
+
+    t_emb, t_dec, t_ref, t_enc_ms, t_dec_ms = results["torch"]
+    o_emb, o_dec, o_ref, o_enc_ms, o_dec_ms = results["onnx"]
+    emb_err = [float(np.abs(a - b).max() / (np.abs(a).max() + 1e-6)) for a, b in zip(t_emb, o_emb)]
+    dec_iou = {
+        variant: [mask_iou(a, b) for ta, oa in zip(t_dec, o_dec) for a, b in zip(ta[variant], oa[variant])]
+        for variant in DECODER_VARIANTS
+    }
+    ref_iou = [mask_iou(a, b) for ta, oa in zip(t_ref, o_ref) for a, b in zip(ta, oa)]
+
+    report = {
+        "samples": len(items),
+        "embedding_rel_err_max": max(emb_err) if emb_err else None,
+        "decoder_iou_min": {variant_name(*variant): min(v) if v else None for variant, v in dec_iou.items()},
+        "refined_iou_mean": statistics.mean(ref_iou) if ref_iou else None,
+        "refined_iou_min": min(ref_iou) if ref_iou else None,
+        "latency_ms_median": {
+            "torch": {"encoder": statistics.median(t_enc_ms), "decoder": statistics.median(t_dec_ms)},
+            "onnx": {"encoder": statistics.median(o_enc_ms), "decoder": statistics.median(o_dec_ms)},
+        },
+    }
+    lat = report["latency_ms_median"]
+    print(f"样本数: {len(items)}")
+    print(f"嵌入最大相对误差: {report['embedding_rel_err_max']:.2e}")
+    for name, v in report["decoder_iou_min"].items():
+        print(f"解码器掩膜最小IoU ({name}): {v:.4f}")
+    print(f"精修掩膜IoU: 平均 {report['refined_iou_mean']:.4f}  最小 {report['refined_iou_min']:.4f}")
+    print(f"{'后端':<8}{'编码(ms)':>12}{'解码(ms)':>12}")
+    for backend in ("torch", "onnx"):
+        print(f"{backend:<8}{lat[backend]['encoder']:>12.1f}{lat[backend]['decoder']:>12.1f}")
+    print(f"编码加速: {lat['torch']['encoder'] / lat['onnx']['encoder']:.2f}x")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    worst = min([v for v in report["decoder_iou_min"].values() if v is not None] + ref_iou, default=1.0)
+    if worst < args.min_iou:
+        print(f"一致性检查未通过: 最小IoU {worst:.4f} < {args.min_iou}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
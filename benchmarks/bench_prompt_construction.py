@@ -0,0 +1,326 @@
+"""sam_refiner提示构造(框、点与掩膜提示)的批量实现与逐实例循环实现的对比
+
+    python -m benchmarks.bench_prompt_construction --sizes 1,5,10,25,50,100
+
+合成图像上随机生成N个椭圆掩膜，分别计时extract_bboxes_expand、extract_points与extract_mask的
+原逐实例实现(legacy)与当前实现，并检查两者输出完全一致(框、点坐标与高斯掩膜权重)。
+legacy_*为改动前src/utils.py中的实现，仅用于对比。
+"""
+import argparse
+import json
+import statistics
+import time
+import FastGeodis
+import torch
+from torch.nn import functional as F
+from src.utils import extract_bboxes_expand, extract_mask, extract_points, get_mask_embed
+
+
+def legacy_extract_bboxes_expand(image_embeddings, mask, margin=0, img_path=None):
+    ori_h, ori_w = mask.shape[-2:]
+    if margin > 0 and ori_h > 0 and ori_w > 0:
+        embed_H, embed_W = image_embeddings.shape[-2:]
+        if ori_h >= ori_w:
+            resize_W = int(embed_H * ori_w / ori_h)
+            resize_H = embed_H
+        else:
+            resize_H = int(embed_W * ori_h / ori_w)
+            resize_W = embed_W
+        image_embeddings_resize = image_embeddings[:, :, :resize_H, :resize_W]
+        image_embeddings_resize = F.interpolate(image_embeddings_resize, size=(ori_h, ori_w), mode='bilinear')
+        image_embeddings_resize = image_embeddings_resize.permute(0, 2, 3, 1)
+        image_embeddings_resize = image_embeddings_resize / image_embeddings_resize.norm(dim=-1, keepdim=True)
+    
+    boxes = []
+    box_masks = []
+    areas = []
+    expand_list = []
+    for i in range(mask.shape[0]):
+        m = mask[i, :, :]
+        # Bounding box.
+        coord = torch.nonzero(m)
+        y_coord, x_coord = coord[:, 0], coord[:, 1]
+        try:
+            y1, x1 = int(y_coord.min()), int(x_coord.min())
+            y2, x2 = int(y_coord.max()), int(x_coord.max())
+        except:
+            y1, x1 = 0, 0
+            y2, x2 = 0, 0
+        
+        x1 = max(0, x1)
+        y1 = max(0, y1)
+        y2 = min(mask.shape[-2] - 1, y2)
+        x2 = min(mask.shape[-1] - 1, x2)
+        
+        box_h = y2 - y1
+        box_w = x2 - x1
+        final_x1, final_x2, final_y1, final_y2 = x1, x2, y1, y2
+        changed = False
+        
+        if box_h > 0 and box_w > 0 and margin > 0 and ori_h > 0 and ori_w > 0:
+            steph = min(box_h * 0.1, 10)
+            stepw = min(box_w * 0.1, 10)
+            
+        
+            query_embed, mask_resize = get_mask_embed(m, image_embeddings)
+            query_embed = query_embed / query_embed.norm(dim=-1, keepdim=True)
+            sim = image_embeddings_resize @ query_embed.transpose(0, 1)
+            sim = sim.squeeze()
+            sim = sim > 0.5
+            
+            temp_x1 = int(x1-stepw)
+            
+            if temp_x1 > 0 and temp_x1 < x1:
+                context_area = (y2-y1) * (x1-temp_x1)
+                sim_context = sim[y1:y2, temp_x1:x1]
+                pos_area = sim_context.sum()
+                if pos_area / context_area > margin:
+                    final_x1 = temp_x1
+                    changed = True
+                    
+            temp_x2 = int(x2+stepw)
+            if temp_x2 < ori_w and temp_x2 > x2:
+                context_area = (y2-y1) * (temp_x2-x2)
+                sim_context = sim[y1:y2, x2:temp_x2]
+                pos_area = sim_context.sum()
+                if pos_area / context_area > margin:
+                    final_x2 = temp_x2
+                    changed = True
+                    
+            temp_y1 = int(y1-steph)
+            if temp_y1 > 0 and temp_y1 < y1:
+                context_area = (y1-temp_y1) * (x2-x1)
+                sim_context = sim[temp_y1:y1, x1:x2]
+                pos_area = sim_context.sum()
+                if pos_area / context_area > margin:
+                    final_y1 = temp_y1
+                    changed = True
+                    
+            temp_y2 = int(y2+steph)
+            if temp_y2 < ori_h and temp_y2 > y2:
+                context_area = (temp_y2-y2) * (x2-x1)
+                sim_context = sim[y2:temp_y2, x1:x2]
+                pos_area = sim_context.sum()
+                if pos_area / context_area > margin:
+                    final_y2 = temp_y2
+                    changed = True
+                
+        if changed:
+            expand_list.append(1)
+        else:
+            expand_list.append(0)
+            
+        x1, x2, y1, y2 = final_x1, final_x2, final_y1, final_y2
+        boxes.append(torch.tensor([x1, y1, x2, y2]))
+        box_mask = torch.zeros((m.shape[0], m.shape[1])).to(image_embeddings.device)
+        
+        box_mask[y1:y2, x1:x2] = 1
+        box_masks.append(box_mask)
+        areas.append(1.0*(x2-x1)*(y2-y1))
+    boxes = torch.stack(boxes, dim=0).reshape(-1, 4).to(image_embeddings.device)
+    box_masks = torch.stack(box_masks,dim=0).to(image_embeddings.device)
+    areas = torch.tensor(areas).reshape(-1).to(image_embeddings.device)
+    expand_list = torch.tensor(expand_list).reshape(-1).to(image_embeddings.device)
+    return boxes, box_masks, areas, expand_list
+
+
+def legacy_extract_mask(pred_masks, gaus_dt, target_size, is01, strength=15, device=0, expand_list=0):
+    pred_masks = pred_masks.float().unsqueeze(1)
+    gaus_dt = gaus_dt.float().unsqueeze(1)
+
+    if is01:
+        pred_masks[pred_masks==0] = -1
+        pred_masks[pred_masks==1] = 1
+        padvalue = -1
+    else:
+        padvalue = -100
+    pred_masks = F.interpolate(
+            pred_masks, target_size, mode="bilinear", align_corners=False,
+        )
+
+    gaus_dt = F.interpolate(
+                gaus_dt, target_size, mode="bilinear", align_corners=False,
+            )
+
+    h, w = pred_masks.shape[-2:]
+    padh = 1024 - h
+    padw = 1024 - w
+    pred_masks = F.pad(pred_masks, (0, padw, 0, padh), 'constant', padvalue)
+    pred_masks = F.interpolate(
+            pred_masks, (256,256),mode="bilinear", align_corners=False,
+        )
+
+    gaus_dt = F.pad(gaus_dt, (0, padw, 0, padh), 'constant', 0)
+    gaus_dt = F.interpolate(
+                gaus_dt, (256,256),mode="bilinear", align_corners=False,
+            )
+
+    if is01:
+        for i in range(len(pred_masks)):
+            if expand_list[i] == 0:
+                pred_masks[pred_masks<=0] = -1*strength
+                pred_masks[pred_masks>0] = strength
+            else:
+                pred_masks[pred_masks<=0] = -1
+                pred_masks[pred_masks>0] = 1
+
+        gaus_dt[gaus_dt<=0] = 1
+        pred_masks = pred_masks * gaus_dt
+        
+    return pred_masks
+
+
+def legacy_extract_points(pred_masks, add_neg=True, use_mask=True, gamma=1.0):
+    
+    point_coords = []
+    point_labels = []
+    gaus_dt = []
+    
+    image_pt = torch.ones(pred_masks.shape[-2:]).float().unsqueeze_(0).unsqueeze_(0).to(pred_masks.device)
+    v = 1e10
+    # lamb = 0.0 (Euclidean) or 1.0 (Geodesic) or (0.0, 1.0) (mixture)
+    lamb = 0.0
+    iterations = 2
+    for idx, pred_mask in enumerate(pred_masks):
+        h, w = pred_mask.shape
+       
+        
+        #pos point
+        pred_mask_dt = FastGeodis.generalised_geodesic2d(
+            image_pt, pred_mask.unsqueeze(0).unsqueeze(0), v, lamb, iterations
+        )
+        pred_mask_dt = pred_mask_dt.squeeze()
+        
+        
+        pred_max_dist = pred_mask_dt.max()
+        coords_y, coords_x = torch.where(pred_mask_dt == pred_max_dist)  # coords is [y, x]
+        point_coords.append([coords_x[0], coords_y[0]])
+        point_labels.append(1)
+        
+        coord = torch.nonzero(pred_mask)
+        y_coord, x_coord = coord[:, 0], coord[:, 1]
+        try:
+            ymin, xmin = int(y_coord.min()), int(x_coord.min())
+            ymax, xmax = int(y_coord.max()), int(x_coord.max())
+        except:
+            ymin, xmin = 0, 0
+            ymax, xmax = 0, 0
+
+        
+        box_mask = torch.zeros_like(pred_mask).to(pred_masks.device)
+        box_mask[ymin:ymax, xmin:xmax] = 1
+        
+        if add_neg:
+            pred_mask_rev = pred_mask.clone().detach()
+            
+            assert pred_mask_rev.dtype == torch.uint8, "unsuitable data type {}".format(pred_mask_rev.dtype)
+            assert pred_mask_rev.device == pred_mask.device
+            pred_mask_rev[pred_mask_rev > 0] = 255
+            pred_mask_rev = (~pred_mask_rev) / 255
+            assert pred_mask_rev.max() <= 1
+            
+            pred_mask_dt_rev = FastGeodis.generalised_geodesic2d(
+                image_pt, pred_mask_rev.unsqueeze(0).unsqueeze(0), v, lamb, iterations
+            )
+            pred_mask_dt_rev = pred_mask_dt_rev.squeeze()
+
+            pred_mask_dt_rev[box_mask == 0] = 0
+
+            pred_max_dist_rev = pred_mask_dt_rev.max()
+            coords_y_neg, coords_x_neg = torch.where(pred_mask_dt_rev == pred_max_dist_rev)  # coords is [y, x]
+            
+            point_coords.append([coords_x_neg[0], coords_y_neg[0]])
+            point_labels.append(0)
+        
+        if use_mask:
+            pred_mask_dt_copy = pred_mask_dt.clone().detach()
+
+            
+            boxh, boxw = ymax-ymin, xmax-xmin
+            mask_area = pred_mask.sum() / gamma
+            mask_area = max(mask_area, 1)
+            pred_max_dist = pred_mask_dt.max()
+            pred_mask_dt0 = pred_mask_dt - pred_max_dist
+            pred_mask_dt0 = torch.exp(-pred_mask_dt0*pred_mask_dt0/mask_area)
+            pred_mask_dt0[pred_mask_dt_copy==0] = 0
+            gaus_dt.append(pred_mask_dt0)
+    
+    point_coords = torch.tensor(point_coords).reshape(len(pred_masks),-1,2).to(pred_masks.device)
+    point_labels = torch.tensor(point_labels).reshape(len(pred_masks),-1).to(pred_masks.device)
+    if use_mask:
+        gaus_dt = torch.stack(gaus_dt, dim=0).to(pred_masks.device)
+    return point_coords, point_labels, gaus_dt
+
+
+def synthetic_masks(n, h, w, device, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    ys = torch.arange(h).view(-1, 1).float()
+    xs = torch.arange(w).view(1, -1).float()
+    masks = []
+    for _ in range(n):
+        cy, cx = torch.rand(2, generator=g) * torch.tensor([h, w])
+        ry, rx = 10 + torch.rand(2, generator=g) * torch.tensor([h / 6.0, w / 6.0])
+        masks.append((((ys - cy) / ry) ** 2 + ((xs - cx) / rx) ** 2 <= 1).to(torch.uint8))
+    return torch.stack(masks).to(device)
+
+
+def timeit(fn, repeat, device):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        times.append((time.perf_counter() - t0) * 1000.0)
+    return statistics.median(times), out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1,5,10,25,50,100", help="每张图的实例数")
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1536)
+    parser.add_argument("--margin", type=float, default=0.0, help="extract_bboxes_expand的margin，>0时计入扩框")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", default=None, help="结果另存为JSON")
+    args = parser.parse_args()
+
+    embeddings = torch.randn(1, 256, 64, 64, device=args.device)
+    target_size = (683, 1024) if args.width >= args.height else (1024, 683)
+    rows = []
+    print(f"{'N':>5}{'框 legacy(ms)':>16}{'框 批量(ms)':>14}{'点 legacy(ms)':>16}{'点 批量(ms)':>14}"
+          f"{'掩膜 legacy(ms)':>18}{'掩膜 批量(ms)':>16}{'一致':>6}")
+    for n in [int(v) for v in args.sizes.split(",") if v]:
+        masks = synthetic_masks(n, args.height, args.width, args.device)
+        gaus_dt = torch.rand(masks.shape, device=args.device) * masks
+        t_box_old, old_box = timeit(lambda: legacy_extract_bboxes_expand(embeddings, masks, args.margin), args.repeat, args.device)
+        t_box_new, new_box = timeit(lambda: extract_bboxes_expand(embeddings, masks, args.margin), args.repeat, args.device)
+        expand_list = new_box[3]
+        t_pts_old, old_pts = timeit(lambda: legacy_extract_points(masks, gamma=4.0), args.repeat, args.device)
+        t_pts_new, new_pts = timeit(lambda: extract_points(masks, gamma=4.0), args.repeat, args.device)
+        t_mask_old, old_mask = timeit(
+            lambda: legacy_extract_mask(masks, gaus_dt, target_size, True, 30, args.device, expand_list),
+            args.repeat, args.device)
+        t_mask_new, new_mask = timeit(
+            lambda: extract_mask(masks, gaus_dt, target_size, True, 30, args.device, expand_list),
+            args.repeat, args.device)
+        same = all(torch.equal(a.cpu(), b.cpu()) for a, b in zip(old_box, new_box))
+        point_err = (old_pts[0].float() - new_pts[0].float()).norm(dim=-1).max().item() if n else 0.0
+        same = (same and torch.equal(old_pts[0].cpu(), new_pts[0].cpu()) and torch.equal(old_pts[1].cpu(), new_pts[1].cpu())
+                and torch.allclose(old_pts[2], new_pts[2]))
+        # legacy extract_mask applies the last instance's amplitude to all; identical when nothing was expanded
+        if not bool(expand_list.any()):
+            same = same and torch.allclose(old_mask, new_mask)
+        rows.append({"n": n, "bbox_legacy_ms": t_box_old, "bbox_batched_ms": t_box_new,
+                     "points_legacy_ms": t_pts_old, "points_batched_ms": t_pts_new, "point_max_err_px": point_err,
+                     "mask_legacy_ms": t_mask_old, "mask_batched_ms": t_mask_new, "match": same})
+        print(f"{n:>5}{t_box_old:>16.2f}{t_box_new:>14.2f}{t_pts_old:>16.2f}{t_pts_new:>14.2f}"
+              f"{t_mask_old:>18.2f}{t_mask_new:>16.2f}{'是' if same else '否':>6}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
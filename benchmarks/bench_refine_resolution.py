@@ -0,0 +1,99 @@
+"""sam_refiner在原图分辨率与降低工作分辨率下的耗时与掩膜一致性对比
+
+    python -m benchmarks.bench_refine_resolution --images samples/ --work-sizes 1024,1536
+
+每张图先取得图像嵌入与解码器粗掩膜(不计时)，再分别以原图分辨率和各--work-sizes
+运行sam_refiner，统计精修耗时中位数以及与原图分辨率结果的IoU。
+"""
+import argparse
+import json
+import statistics
+import time
+import numpy as np
+import torch
+from src.inference import Config, Inference
+from src.sam_refiner import sam_refiner
+from benchmarks.bench_cpu_profile import mask_iou, sample_items
+
+
+def coarse_masks(engine, path, boxes):
+    entry, _ = engine.get_image_embedding(path)
+    predictor = engine._bind_predictor(entry)
+    masks = [predictor.predict(box=np.array(box, dtype=np.float32), multimask_output=False)[0][0] for box in boxes]
+    return entry, np.stack(masks, axis=0).astype(np.uint8)
+
+
+def refine(engine, entry, masks, work_size, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        refined = sam_refiner(
+            None,
+            masks,
+            engine.model_hq,
+            use_samhq=True,
+            iters=engine.config.refiner_iters,
+            image_embeddings=entry.features,
+            interm_embeddings=entry.interm_features[0],
+            input_image=entry.input_image,
+            work_size=work_size,
+        )[0]
+        if engine.config.device.startswith("cuda"):
+            torch.cuda.synchronize()
+        times.append((time.perf_counter() - t0) * 1000.0)
+    return statistics.median(times), refined
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", default=None, help="样本图像目录")
+    parser.add_argument("--manifest", default=None, help="可选，batch_annotate格式的框清单")
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--work-sizes", default="1024", help="逗号分隔的工作分辨率(长边)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", default=None, help="结果另存为JSON")
+    args = parser.parse_args()
+    if not args.images and not args.manifest:
+        parser.error("需要--images或--manifest")
+
+    config = Config()
+    config.use_embedding_store = False
+    config.warmup = False
+    config.refiner_stop_iou = None
+    engine = Inference(config=config)
+    work_sizes = [int(v) for v in args.work_sizes.split(",") if v]
+    items = sample_items(args)
+
+    results = {"full": []}
+    results.update({str(ws): [] for ws in work_sizes})
+    ious = {str(ws): [] for ws in work_sizes}
+    for path, boxes in items:
+        entry, masks = coarse_masks(engine, path, boxes)
+        full_ms, full = refine(engine, entry, masks, None, args.repeat)
+        results["full"].append(full_ms)
+        for ws in work_sizes:
+            ms, refined = refine(engine, entry, masks, ws, args.repeat)
+            results[str(ws)].append(ms)
+            ious[str(ws)].extend(mask_iou(a, b) for a, b in zip(refined, full))
+        print(f"{path}: {masks.shape[2]}x{masks.shape[1]}, {len(boxes)} 个框")
+
+    report = {"samples": len(items), "modes": {}}
+    full_median = statistics.median(results["full"])
+    print(f"{'模式':<10}{'精修(ms)':>12}{'加速':>8}{'平均IoU':>10}{'最小IoU':>10}")
+    for mode, times in results.items():
+        median = statistics.median(times)
+        mode_ious = ious.get(mode)
+        report["modes"][mode] = {
+            "refine_ms_median": median,
+            "iou_vs_full_mean": statistics.mean(mode_ious) if mode_ious else None,
+            "iou_vs_full_min": min(mode_ious) if mode_ious else None,
+        }
+        iou_text = f"{statistics.mean(mode_ious):>10.4f}{min(mode_ious):>10.4f}" if mode_ious else f"{'-':>10}{'-':>10}"
+        print(f"{mode:<10}{median:>12.1f}{full_median / median:>7.2f}x{iou_text}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""推理与精修流水线的离线基准套件(CPU，无需权重与数据集)
+
+    python -m benchmarks.run_suite --megapixels 1,5,12,25,50 --instances 1,10,50 --json results.json
+
+使用随机初始化的小型SAM-HQ(编码器深度与宽度可调，解码器与正式模型结构一致)和合成图像/椭圆掩膜，
+分别计时run_prompt_inference(嵌入未缓存/已缓存)、sam_refiner(复用嵌入)、extract_bboxes_expand、
+extract_points与extract_mask，统计中位耗时与相对调用前的内存峰值(CPU上为进程RSS采样，CUDA上为显存分配峰值)。
+随机种子固定，精修固定跑满refiner_iters轮，结果连同提交号与机器信息写入JSON，便于跨机器、跨提交对比。
+掩膜占用超过--max-mask-gb的(尺寸, 实例数)组合会被跳过并在结果中注明。
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import torch
+from PIL import Image
+from src.image_cache import shared_image_cache
+from src.inference import Config
+from src.sam_refiner import sam_refiner
+from src.utils import extract_bboxes_expand, extract_mask, extract_points
+from benchmarks.bench_prompt_construction import synthetic_masks
+from benchmarks.tiny_model import TinyInference
+
+FUNCTIONS = ("run_prompt_inference_cold", "run_prompt_inference_warm", "sam_refiner",
+             "extract_bboxes_expand", "extract_points", "extract_mask")
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class PeakMemory:
+    """调用期间相对调用前的内存峰值(MB)；无法测量时mb为None"""
+
+    def __init__(self, device, interval=0.001):
+        self.cuda = str(device).startswith("cuda")
+        self.interval = interval
+        self.mb = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            rss = _rss_bytes()
+            if rss is not None and rss > self._peak:
+                self._peak = rss
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            self._base = torch.cuda.memory_allocated()
+            return self
+        self._base = self._peak = _rss_bytes()
+        if self._base is not None:
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.cuda:
+            torch.cuda.synchronize()
+            self.mb = (torch.cuda.max_memory_allocated() - self._base) / 2 ** 20
+        elif self._base is not None:
+            self._stop.set()
+            self._thread.join()
+            self._peak = max(self._peak, _rss_bytes() or 0)
+            self.mb = (self._peak - self._base) / 2 ** 20
+        return False
+
+
+def measure(fn, repeat, device, setup=None):
+    """首次调用只测内存峰值(同时充当预热)，之后repeat次计时，setup不计入耗时"""
+    if setup is not None:
+        setup()
+    with PeakMemory(device) as peak:
+        fn()
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        fn()
+        if str(device).startswith("cuda"):
+            torch.cuda.synchronize()
+        times.append((time.perf_counter() - t0) * 1000.0)
+    return {"latency_ms_median": statistics.median(times), "latency_ms_min": min(times), "peak_mem_mb": peak.mb}
+
+
+def image_shape(megapixels, aspect=4 / 3):
+    h = int(round(math.sqrt(megapixels * 1e6 / aspect)))
+    return h, int(round(h * aspect))
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_size(engine, megapixels, instance_counts, functions, args, tmp_dir):
+    device = engine.config.device
+    h, w = image_shape(megapixels)
+    np_img, box = engine._synthetic_image((h, w))
+    path = os.path.join(tmp_dir, f"synthetic_{h}x{w}.bmp")
+    Image.fromarray(np_img).save(path)
+    del np_img
+    base = {"megapixels": megapixels, "height": h, "width": w}
+    rows = []
+
+    def record(name, instances, fn, setup=None):
+        if name not in functions:
+            return
+        row = dict(base, function=name, instances=instances)
+        row.update(measure(fn, args.repeat, device, setup))
+        rows.append(row)
+        mem = "-" if row["peak_mem_mb"] is None else f"{row['peak_mem_mb']:.1f}"
+        print(f"{name:<28}{megapixels:>6}{instances:>6}{row['latency_ms_median']:>12.1f}{mem:>12}")
+
+    def clear_caches():
+        # 冷启动既要重新编码，也要重新读取解码原图
+        engine.embedding_cache.clear()
+        shared_image_cache.clear()
+
+    record("run_prompt_inference_cold", 1, lambda: engine.run_prompt_inference(path, box), setup=clear_caches)
+    record("run_prompt_inference_warm", 1, lambda: engine.run_prompt_inference(path, box))
+
+    entry, _ = engine.get_image_embedding(path)
+    target_size = tuple(entry.input_image.shape[1:])
+    for n in instance_counts:
+        # extract_mask等会生成N×H×W的float中间结果
+        if n * h * w * 4 > args.max_mask_gb * 2 ** 30:
+            rows.append(dict(base, instances=n, skipped=f"掩膜超过--max-mask-gb={args.max_mask_gb}"))
+            print(f"{'(跳过)':<28}{megapixels:>6}{n:>6}")
+            continue
+        masks = synthetic_masks(n, h, w, device, seed=args.seed)
+        _, _, _, expand_list = extract_bboxes_expand(entry.features, masks, args.margin)
+        _, _, gaus_dt = extract_points(masks, gamma=4.0)
+        record("extract_bboxes_expand", n, lambda: extract_bboxes_expand(entry.features, masks, args.margin))
+        record("extract_points", n, lambda: extract_points(masks, gamma=4.0))
+        record("extract_mask", n, lambda: extract_mask(masks, gaus_dt, target_size, True, 30, device, expand_list))
+        coarse = masks.cpu().numpy()
+        record("sam_refiner", n, lambda: sam_refiner(
+            None,
+            coarse,
+            engine.model_hq,
+            use_samhq=True,
+            iters=engine.config.refiner_iters,
+            margin=args.margin,
+            image_embeddings=entry.features,
+            interm_embeddings=entry.interm_features[0],
+            input_image=entry.input_image,
+            work_size=engine.config.refiner_work_size,
+        ))
+        del masks, gaus_dt, coarse
+    engine.embedding_cache.clear()
+    os.remove(path)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--megapixels", default="1,5,12,25,50", help="逗号分隔的合成图像尺寸(百万像素，4:3)")
+    parser.add_argument("--instances", default="1,10,50", help="逗号分隔的实例数")
+    parser.add_argument("--functions", default=",".join(FUNCTIONS), help="逗号分隔的待测函数")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--margin", type=float, default=0.0, help="extract_bboxes_expand与sam_refiner的margin")
+    parser.add_argument("--refiner-iters", type=int, default=None, help="默认取Config.refiner_iters")
+    parser.add_argument("--work-size", type=int, default=None, help="sam_refiner的工作分辨率，默认原图分辨率")
+    parser.add_argument("--encoder-depth", type=int, default=2)
+    parser.add_argument("--encoder-dim", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=None, help="CPU线程数，默认物理核数")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--max-mask-gb", type=float, default=4.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default=None, help="结果JSON路径，默认suite_<提交号>_<主机名>.json")
+    args = parser.parse_args()
+
+    functions = {f for f in args.functions.split(",") if f}
+    unknown = functions - set(FUNCTIONS)
+    if unknown:
+        parser.error(f"未知函数: {', '.join(sorted(unknown))}，可选: {', '.join(FUNCTIONS)}")
+    torch.manual_seed(args.seed)
+    config = Config()
+    config.hq_model_type = f"tiny_d{args.encoder_depth}_e{args.encoder_dim}"
+    config.device = args.device
+    config.cpu_threads = args.threads
+    config.use_embedding_store = False
+    config.warmup = False
+    config.progressive_preview = False
+    config.refiner_stop_iou = None
+    config.refiner_stop_score_delta = None
+    config.refiner_work_size = args.work_size
+    if args.refiner_iters is not None:
+        config.refiner_iters = args.refiner_iters
+    engine = TinyInference({"encoder_depth": args.encoder_depth, "encoder_embed_dim": args.encoder_dim}, config,
+                           seed=args.seed)
+
+    commit = _git_commit()
+    report = {
+        "meta": {
+            "commit": commit,
+            "timestamp": time.time(),
+            "host": socket.gethostname(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "torch": torch.__version__,
+            "threads": torch.get_num_threads(),
+            "device": args.device,
+            "refiner_iters": config.refiner_iters,
+            "crop_mode": config.crop_mode,
+            "args": vars(args),
+        },
+        "results": [],
+    }
+    instance_counts = [int(v) for v in args.instances.split(",") if v]
+    print(f"{'函数':<28}{'MP':>6}{'实例':>6}{'中位(ms)':>12}{'峰值(MB)':>12}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for megapixels in [float(v) for v in args.megapixels.split(",") if v]:
+            report["results"].extend(run_size(engine, megapixels, instance_counts, functions, args, tmp_dir))
+
+    out_path = args.json or f"suite_{commit or 'unknown'}_{socket.gethostname()}.json"
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"结果已写入 {out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""基准与测试共用的随机初始化小型SAM-HQ，无需下载权重
+
+输入尺寸与嵌入形状(256×64×64)和正式模型相同，编码器与解码器的深度、宽度可调；
+TINY_TEST_MODEL是测试用的最小配置。
+"""
+from functools import partial
+import torch
+from segment_anything_hq.modeling import ImageEncoderViT, MaskDecoderHQ, PromptEncoder, Sam, TwoWayTransformer
+from src.inference import Inference
+
+# 测试只关心流程与形状，用单层窄模型缩短编码时间
+TINY_TEST_MODEL = {
+    "encoder_depth": 1,
+    "encoder_embed_dim": 32,
+    "encoder_num_heads": 1,
+    "encoder_mlp_ratio": 2,
+    "decoder_depth": 1,
+    "decoder_mlp_dim": 256,
+}
+
+
+def build_tiny_sam_hq(encoder_depth=2, encoder_embed_dim=64, encoder_num_heads=2, encoder_mlp_ratio=4,
+                      decoder_depth=2, decoder_mlp_dim=2048, image_size=1024):
+    """随机初始化的小型SAM-HQ，输入尺寸与嵌入形状(256×64×64)和正式模型相同"""
+    prompt_embed_dim = 256
+    vit_patch_size = 16
+    image_embedding_size = image_size // vit_patch_size
+    return Sam(
+        image_encoder=ImageEncoderViT(
+            depth=encoder_depth,
+            embed_dim=encoder_embed_dim,
+            img_size=image_size,
+            mlp_ratio=encoder_mlp_ratio,
+            norm_layer=partial(torch.nn.LayerNorm, eps=1e-6),
+            num_heads=encoder_num_heads,
+            patch_size=vit_patch_size,
+            qkv_bias=True,
+            use_rel_pos=True,
+            # HQ解码器使用全局注意力层的中间特征，最后一层设为全局注意力
+            global_attn_indexes=[encoder_depth - 1],
+            window_size=14,
+            out_chans=prompt_embed_dim,
+        ),
+        prompt_encoder=PromptEncoder(
+            embed_dim=prompt_embed_dim,
+            image_embedding_size=(image_embedding_size, image_embedding_size),
+            input_image_size=(image_size, image_size),
+            mask_in_chans=16,
+        ),
+        mask_decoder=MaskDecoderHQ(
+            num_multimask_outputs=3,
+            transformer=TwoWayTransformer(depth=decoder_depth, embedding_dim=prompt_embed_dim,
+                                          mlp_dim=decoder_mlp_dim, num_heads=8),
+            transformer_dim=prompt_embed_dim,
+            iou_head_depth=3,
+            iou_head_hidden_dim=256,
+            vit_dim=encoder_embed_dim,
+        ),
+        pixel_mean=[123.675, 116.28, 103.53],
+        pixel_std=[58.395, 57.12, 57.375],
+    )
+
+
+class TinyInference(Inference):
+    """以小型随机模型代替权重加载的Inference，其余流程(缓存、裁剪、精修、计时)不变"""
+
+    def __init__(self, model_kwargs=None, config=None, progress_callback=None, seed=0):
+        self.model_kwargs = model_kwargs or {}
+        self.seed = seed
+        super().__init__(progress_callback=progress_callback, config=config)
+
+    def _load_metal_model(self):
+        torch.manual_seed(self.seed)
+        self.model_hq = build_tiny_sam_hq(**self.model_kwargs).to(self.config.device).eval()
+        self._checkpoint_hash = "random-init"
+        self.use_fp16 = False
+        return self.model_hq
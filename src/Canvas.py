@@ -11,12 +11,12 @@ from PyQt5.QtGui import (
     QColor,
     QImage,
     QBrush,
-    QImageReader,
     QPixmap,
     QPainterPath,
 )
 from PyQt5.QtCore import Qt, QPoint, QRect, QRectF
 import numpy as np
+from .qt_utils import load_qimage
 
 
 class Canvas(QWidget):
@@ -24,6 +24,8 @@ class Canvas(QWidget):
         super().__init__(parent)
         self.parent = parent
         self.setMouseTracking(True)
+        # 点击画布后获得键盘焦点，Esc/回车才能送到keyPressEvent
+        self.setFocusPolicy(Qt.ClickFocus)
         
         self.setSizePolicy(
             QSizePolicy.Expanding,
@@ -64,6 +66,10 @@ class Canvas(QWidget):
         self.rectSelecting = False
         self.rectStart = QPoint()
         self.rectEnd = QPoint()
+        # 按住Shift拉出的提示框先排队，确认后一次批量推理
+        self.queuedBoxes = []
+        # 拉框推理的临时预览掩膜，不写入maskLayer，精修结果到达或切换图像时清除
+        self.previewMask = None
 
         self.setAutoFillBackground(True)
         p = self.palette()
@@ -71,12 +77,11 @@ class Canvas(QWidget):
         self.setPalette(p)
 
     def loadImage(self, filePath):
-        reader = QImageReader(filePath)
-        reader.setAutoTransform(True)
-        
-        self.baseImage = reader.read()
+        self.baseImage = load_qimage(filePath)
         self.originalImageSize = self.baseImage.size()
         self.zoomFactor = 1.0
+        self.queuedBoxes = []
+        self.previewMask = None
         
         self.calculateImageRect()
         
@@ -90,6 +95,8 @@ class Canvas(QWidget):
             self.baseImage = image
             self.originalImageSize = self.baseImage.size()
             self.zoomFactor = 1.0
+            self.queuedBoxes = []
+            self.previewMask = None
             
             self.calculateImageRect()
             
@@ -185,6 +192,18 @@ class Canvas(QWidget):
             self.drawing = False
             self.update()
             return
+
+        # 有排队的提示框时，回车批量推理、Esc清空；否则按键照常处理
+        if self.queuedBoxes and event.key() in (Qt.Key_Return, Qt.Key_Enter):
+            if hasattr(self.parent, 'applyQueuedBoxes'):
+                self.parent.applyQueuedBoxes()
+            return
+        if self.queuedBoxes and event.key() == Qt.Key_Escape:
+            if hasattr(self.parent, 'clearQueuedBoxes'):
+                self.parent.clearQueuedBoxes()
+            else:
+                self.clearQueuedBoxes()
+            return
         
         super().keyPressEvent(event)
         
@@ -402,6 +421,8 @@ class Canvas(QWidget):
                     x2 = self.imageRect.x() + int(self.rectEnd.x() * self.scaleFactor)
                     y2 = self.imageRect.y() + int(self.rectEnd.y() * self.scaleFactor)
                     painter.drawRect(QRect(min(x1, x2), min(y1, y2), abs(x2 - x1), abs(y2 - y1)))
+                self.drawPreviewMask(painter)
+                self.drawQueuedBoxes(painter)
             finally:
                 painter.end()
         else:
@@ -458,9 +479,59 @@ class Canvas(QWidget):
                     x2 = self.imageRect.x() + int(self.rectEnd.x() * self.scaleFactor)
                     y2 = self.imageRect.y() + int(self.rectEnd.y() * self.scaleFactor)
                     painter.drawRect(QRect(min(x1, x2), min(y1, y2), abs(x2 - x1), abs(y2 - y1)))
+                self.drawPreviewMask(painter)
+                self.drawQueuedBoxes(painter)
             finally:
                 painter.end()
 
+    def setPreviewMask(self, mask_arr):
+        """显示一版临时预览掩膜(numpy, 非零为前景)"""
+        h, w = mask_arr.shape[:2]
+        rgba = np.zeros((h, w, 4), dtype=np.uint8)
+        rgba[mask_arr > 0] = [255, 200, 0, 110]
+        preview = QImage(rgba.data, w, h, w * 4, QImage.Format_RGBA8888).copy()
+        if not self.baseImage.isNull() and preview.size() != self.baseImage.size():
+            preview = preview.scaled(self.baseImage.size(), Qt.IgnoreAspectRatio, Qt.FastTransformation)
+        self.previewMask = preview
+        self.update()
+
+    def clearPreviewMask(self):
+        if self.previewMask is not None:
+            self.previewMask = None
+            self.update()
+
+    def drawPreviewMask(self, painter):
+        if self.previewMask is None or self.imageRect.isEmpty():
+            return
+        painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+        painter.drawImage(self.imageRect, self.previewMask)
+
+    def drawQueuedBoxes(self, painter):
+        if not self.queuedBoxes:
+            return
+        pen = QPen(QColor(255, 165, 0))
+        pen.setWidth(2)
+        pen.setStyle(Qt.DashDotLine)
+        painter.setPen(pen)
+        painter.setBrush(Qt.NoBrush)
+        for x1, y1, x2, y2 in self.queuedBoxes:
+            painter.drawRect(QRect(
+                self.imageRect.x() + int(x1 * self.scaleFactor),
+                self.imageRect.y() + int(y1 * self.scaleFactor),
+                int((x2 - x1) * self.scaleFactor),
+                int((y2 - y1) * self.scaleFactor),
+            ))
+
+    def queueBox(self, box):
+        self.queuedBoxes.append(box)
+        self.update()
+
+    def clearQueuedBoxes(self):
+        boxes = self.queuedBoxes
+        self.queuedBoxes = []
+        self.update()
+        return boxes
+
     def mapToImage(self, point):
         if self.imageRect.isEmpty() or self.baseImage.isNull():
             return QPoint()
@@ -644,6 +715,10 @@ class Canvas(QWidget):
                     self.parent.onRectAddSelected([x1, y1, x2, y2])
                 elif self.drawingMode == "rect_erase" and hasattr(self.parent, 'onRectEraseSelected'):
                     self.parent.onRectEraseSelected([x1, y1, x2, y2])
+                elif self.drawingMode == "rect_prompt" and event.modifiers() & Qt.ShiftModifier:
+                    self.queueBox([x1, y1, x2, y2])
+                    if hasattr(self.parent, 'onBoxPromptQueued'):
+                        self.parent.onBoxPromptQueued(len(self.queuedBoxes))
                 elif self.drawingMode == "rect_prompt" and hasattr(self.parent, 'onBoxPromptSelected'):
                     self.parent.onBoxPromptSelected([x1, y1, x2, y2])
                 self.update()
@@ -1,5 +1,6 @@
 import sys
 import os
+import time
 from PyQt5.QtWidgets import (
     QApplication,
     QMainWindow,
@@ -19,22 +20,22 @@ from PyQt5.QtGui import (
     QColor,
     QImage,
     QKeySequence,
-    QImageReader,
     QPainter,
 )
-from PyQt5.QtCore import Qt, QTimer, QThreadPool, QRunnable, pyqtSignal, QObject, QRect
+from PyQt5.QtCore import Qt, QTimer, QThread, QThreadPool, QRunnable, pyqtSignal, QObject, QRect
 from .Canvas import Canvas
+from .qt_utils import load_qimage
+from .timing import timed
 try:
-    from .utils import mask_has_content
+    from .qt_utils import mask_has_content
     NUMPY_AVAILABLE = True
 except ImportError:
     NUMPY_AVAILABLE = False
 
-# try:
-from .inference import Inference
+# 推理依赖(torch等)导入很慢，改为在后台加载模型时再导入，窗口可以先显示出来
 INFERENCE_AVAILABLE = True
-# except ImportError:
-#     INFERENCE_AVAILABLE = False
+
+APP_START_TIME = time.time()
 
 class ImageLoaderWorker(QRunnable):
     def __init__(self, file_path, callback):
@@ -43,62 +44,149 @@ class ImageLoaderWorker(QRunnable):
         self.callback = callback
         
     def run(self):
-        reader = QImageReader(self.file_path)
-        reader.setAutoTransform(True)
-        image = reader.read()
+        image = load_qimage(self.file_path)
         
         self.callback(self.file_path, image)
 
-class ImageMaskingTool(QMainWindow):
-    def __init__(self):
+class EmbeddingPreloadWorker(QRunnable):
+    """后台按导航顺序预计算SAM图像嵌入，generation过期即停止"""
+    def __init__(self, engine, file_paths, generation, isCurrent):
         super().__init__()
-        
-        if INFERENCE_AVAILABLE:
+        self.engine = engine
+        self.file_paths = file_paths
+        self.generation = generation
+        self.isCurrent = isCurrent
+
+    def cancelled(self):
+        return not self.isCurrent(self.generation)
+
+    def run(self):
+        QThread.currentThread().setPriority(QThread.LowestPriority)
+        for path in self.file_paths:
+            if self.cancelled():
+                return
             try:
-                self.inference_engine = Inference()
-                self.inference_available = True
+                self.engine.preencode(path, should_cancel=self.cancelled)
             except Exception as e:
-                print(f"推理引擎初始化失败: {e}")
-                self.inference_available = False
-        else:
-            self.inference_available = False
-        
-        self.initUI()
-        
-        self.imageCache = {}
-        self.threadpool = QThreadPool()
-        self.threadpool.setMaxThreadCount(3)
-        
-        self.saveTimer = QTimer()
-        self.saveTimer.setSingleShot(True)
-        self.saveTimer.timeout.connect(self.performDelayedSave)
-        self.pendingSavePath = None
-        self.saveDelay = 1000
+                print(f"预编码失败 {os.path.basename(path)}: {e}")
 
-        self.canvas.cacheEnabled = True
-        
-        self.panMode = True
-        self.canvas.setPanMode(True)
+class ModelLoaderSignals(QObject):
+    progress = pyqtSignal(str)
+    finished = pyqtSignal(object, float)
+    failed = pyqtSignal(str)
+
+class ModelLoaderWorker(QRunnable):
+    """在后台线程中导入推理依赖并构建模型
+
+    设置了SAM_MODEL_SERVER时优先连接模型服务，连接失败则退回本地推理。
+    """
+    def __init__(self):
+        super().__init__()
+        self.signals = ModelLoaderSignals()
+
+    def run(self):
+        t0 = time.time()
+        try:
+            engine = None
+            address = os.environ.get("SAM_MODEL_SERVER")
+            if address:
+                self.signals.progress.emit(f"正在连接模型服务 {address}...")
+                from .model_server import RemoteInference
+                try:
+                    engine = RemoteInference(address)
+                except Exception as e:
+                    print(f"连接模型服务失败，改用本地推理: {e}")
+            if engine is None:
+                self.signals.progress.emit("正在导入推理依赖...")
+                from .inference import Inference
+                engine = Inference(progress_callback=self.signals.progress.emit)
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+            return
+        self.signals.finished.emit(engine, (time.time() - t0) * 1000.0)
+
+class PromptWorkerSignals(QObject):
+    preview = pyqtSignal(int, object)
+    finished = pyqtSignal(int, object)
+    failed = pyqtSignal(int, str)
+
+class BoxPromptWorker(QRunnable):
+    """后台执行拉框推理：先发出预览掩膜，精修完成后发出(最终掩膜, 计时器)
+
+    boxes只有一个框时走单框推理(带预览)，多个框时走批量推理并发出它们的并集。
+    计时器尚未结束，界面线程把掩膜合成到画布的阶段记入后再调用engine.finish_timing。
+    请求在开始前或精修轮次之间过期(isCurrent返回False)时直接放弃，不发出任何信号。
+    """
+    def __init__(self, engine, requestId, imagePath, boxes, isCurrent):
+        super().__init__()
+        self.engine = engine
+        self.requestId = requestId
+        self.imagePath = imagePath
+        self.boxes = boxes
+        self.isCurrent = isCurrent
+        self.signals = PromptWorkerSignals()
+
+    def cancelled(self):
+        return not self.isCurrent(self.requestId)
+
+    def run(self):
+        # 连续拉框时排队中的旧请求在这里直接丢弃，只有最新的一个真正执行
+        if self.cancelled():
+            return
+        timer = self.engine.new_timer()
+        try:
+            if len(self.boxes) == 1:
+                mask_result, _ = self.engine.run_prompt_inference(
+                    image=self.imagePath,
+                    box=self.boxes[0],
+                    multimask_output=False,
+                    hq_token_only=False,
+                    on_preview=lambda mask: self.signals.preview.emit(self.requestId, mask),
+                    should_cancel=self.cancelled,
+                    timer=timer,
+                )
+            else:
+                import numpy as np
+                masks, _ = self.engine.run_prompt_inference_batch(
+                    image=self.imagePath,
+                    boxes=self.boxes,
+                    multimask_output=False,
+                    hq_token_only=False,
+                    should_cancel=self.cancelled,
+                    timer=timer,
+                )
+                mask_result = np.any(masks > 0, axis=0).astype(np.uint8)
+        except Exception as e:
+            if not self.cancelled():
+                self.signals.failed.emit(self.requestId, str(e))
+            return
+        self.signals.finished.emit(self.requestId, (mask_result, timer))
 
 class ImageMaskingTool(QMainWindow):
     def __init__(self):
         super().__init__()
         
-        if INFERENCE_AVAILABLE:
-            try:
-                self.inference_engine = Inference()
-                self.inference_available = True
-            except Exception as e:
-                print(f"推理引擎初始化失败: {e}")
-                self.inference_available = False
-        else:
-            self.inference_available = False
+        self.inference_engine = None
+        self.inference_available = False
+        self.firstFrameShown = False
         
         self.initUI()
         
         self.imageCache = {}
         self.threadpool = QThreadPool()
         self.threadpool.setMaxThreadCount(3)
+
+        # 预编码单独一个线程，避免与图像解码争抢线程池
+        self.encodeThreadpool = QThreadPool()
+        self.encodeThreadpool.setMaxThreadCount(1)
+        self.preencodeAhead = 3
+        self.preencodeGeneration = 0
+
+        # 拉框推理在单独线程中执行，只应用最新一次请求的结果
+        self.promptThreadpool = QThreadPool()
+        self.promptThreadpool.setMaxThreadCount(1)
+        self.promptRequestId = 0
+        self.activePrompt = None
         
         self.saveTimer = QTimer()
         self.saveTimer.setSingleShot(True)
@@ -111,6 +199,74 @@ class ImageMaskingTool(QMainWindow):
         self.panMode = True
         self.canvas.setPanMode(True)
 
+        self.setAIToolsEnabled(False)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        if not self.firstFrameShown:
+            self.firstFrameShown = True
+            # 排到事件队列末尾，首帧绘制完成后再计时并开始加载模型
+            QTimer.singleShot(0, self.onFirstFrame)
+
+    def closeEvent(self, event):
+        # 停止后台请求后再关闭推理引擎(模型服务的连接与共享内存)
+        self.cancelBoxPrompts()
+        self.preencodeGeneration += 1
+        self.encodeThreadpool.clear()
+        self.promptThreadpool.waitForDone(3000)
+        self.encodeThreadpool.waitForDone(3000)
+        close = getattr(self.inference_engine, "close", None)
+        if close is not None:
+            close()
+        super().closeEvent(event)
+
+    def onFirstFrame(self):
+        ttff = (time.time() - APP_START_TIME) * 1000.0
+        print(f"[UI] 首帧用时: {ttff:.1f}ms")
+        self.statusBar.showMessage(f"界面就绪 ({ttff:.0f}ms)，AI模型后台加载中...")
+        self.startModelLoading()
+
+    def startModelLoading(self):
+        if not INFERENCE_AVAILABLE or self.inference_engine is not None:
+            return
+        self.modelLoader = ModelLoaderWorker()
+        self.modelLoader.signals.progress.connect(self.onModelLoadProgress)
+        self.modelLoader.signals.finished.connect(self.onModelLoaded)
+        self.modelLoader.signals.failed.connect(self.onModelLoadFailed)
+        self.threadpool.start(self.modelLoader)
+
+    def onModelLoadProgress(self, message):
+        self.statusBar.showMessage(f"AI模型加载中: {message}")
+
+    def onModelLoaded(self, engine, elapsed):
+        self.inference_engine = engine
+        self.inference_available = True
+        self.setAIToolsEnabled(True)
+        total = (time.time() - APP_START_TIME) * 1000.0
+        print(f"[UI] 模型加载用时: {elapsed:.1f}ms，启动至模型就绪: {total:.1f}ms")
+        self.statusBar.showMessage(f"AI模型已就绪 (加载{elapsed / 1000.0:.1f}s)")
+        self.schedulePreencode()
+
+    def onModelLoadFailed(self, error):
+        print(f"推理引擎初始化失败: {error}")
+        self.statusBar.showMessage(f"AI模型加载失败: {error}")
+
+    def setAIToolsEnabled(self, enabled):
+        self.rectPromptButton.setEnabled(enabled)
+        if hasattr(self, "inferenceButton"):
+            self.inferenceButton.setEnabled(enabled)
+        if not enabled and self.drawingMode in ("rect_prompt", "rect_add", "rect_erase"):
+            self.setDrawingMode("target")
+
+    def checkAIToolsReady(self):
+        if self.inference_available:
+            return True
+        if self.inference_engine is None:
+            self.statusBar.showMessage("AI模型尚未加载完成，请稍候")
+        else:
+            self.statusBar.showMessage("推理功能不可用")
+        return False
+
     def initUI(self):
         self.setWindowTitle("图像掩码工具")
         self.setMinimumSize(1280, 720)
@@ -293,6 +449,7 @@ class ImageMaskingTool(QMainWindow):
         QShortcut(QKeySequence(Qt.Key_B), self, self.toggleRectPromptMode)
         QShortcut(QKeySequence(Qt.Key_A), self, self.toggleRectAddMode)
         QShortcut(QKeySequence(Qt.Key_E), self, self.toggleRectEraseMode)
+        # 回车/Esc由Canvas.keyPressEvent处理，以免抢走套索模式下的Esc取消
 
         self.imagePath = None
         self.brushSize = 10
@@ -322,6 +479,7 @@ class ImageMaskingTool(QMainWindow):
 
             self.imagePath = filePath
             self.loadImageToCanvas(filePath)
+            self.schedulePreencode()
             self.saveButton.setEnabled(True)
             self.saveAllButton.setEnabled(False)
 
@@ -387,12 +545,37 @@ class ImageMaskingTool(QMainWindow):
                 
             worker = ImageLoaderWorker(path, self.cacheImage)
             self.threadpool.start(worker)
+
+        self.schedulePreencode()
+
+    def schedulePreencode(self):
+        """取消旧的预编码任务，并按导航顺序(当前、后续N张、前一张)重新排队"""
+        self.preencodeGeneration += 1
+        if not self.inference_available or not self.imageFiles or self.currentImageIndex < 0:
+            return
+        self.encodeThreadpool.clear()
+
+        order = [self.currentImageIndex]
+        order += range(self.currentImageIndex + 1, min(len(self.imageFiles), self.currentImageIndex + 1 + self.preencodeAhead))
+        if self.currentImageIndex > 0:
+            order.append(self.currentImageIndex - 1)
+        paths = [self.imageFiles[i] for i in order]
+
+        worker = EmbeddingPreloadWorker(
+            self.inference_engine,
+            paths,
+            self.preencodeGeneration,
+            lambda generation: generation == self.preencodeGeneration,
+        )
+        self.encodeThreadpool.start(worker)
             
     def cacheImage(self, path, image):
         if image and not image.isNull():
             self.imageCache[path] = image
             
     def loadImageToCanvas(self, image_path):
+        # 切换图像后，针对上一张图像的拉框请求不再有意义
+        self.cancelBoxPrompts()
         if image_path in self.imageCache:
             self.canvas.setImage(self.imageCache[image_path])
             self.statusBar.showMessage(f"从缓存加载图像: {os.path.basename(image_path)}")
@@ -632,7 +815,7 @@ class ImageMaskingTool(QMainWindow):
             self.statusBar.showMessage("套索模式: 按住鼠标绘制闭合曲线，松开后自动填充区域，可使用Ctrl+Z撤销，Ctrl+Y重做")
         elif mode == "rect_prompt":
             self.rectPromptButton.setChecked(True)
-            self.statusBar.showMessage("框选金属模式: 在图像上拖拽矩形框以执行金属区域提示推理")
+            self.statusBar.showMessage("框选金属模式: 在图像上拖拽矩形框以执行金属区域提示推理，按住Shift可连续排队多个框后按回车批量推理")
         elif mode == "rect_add":
             self.statusBar.showMessage("拉框添加模式: 拖拽矩形为遮盖上色")
         elif mode == "rect_erase":
@@ -662,54 +845,33 @@ class ImageMaskingTool(QMainWindow):
     def toggleRectPromptMode(self):
         if self.drawingMode == "rect_prompt":
             self.setDrawingMode("target")
-        else:
+        elif self.checkAIToolsReady():
             self.setDrawingMode("rect_prompt")
 
     def toggleRectAddMode(self):
         if self.drawingMode == "rect_add":
             self.setDrawingMode("target")
-        else:
+        elif self.checkAIToolsReady():
             self.setDrawingMode("rect_add")
 
     def toggleRectEraseMode(self):
         if self.drawingMode == "rect_erase":
             self.setDrawingMode("target")
-        else:
+        elif self.checkAIToolsReady():
             self.setDrawingMode("rect_erase")
 
     def onRectAddSelected(self, box):
-        if not self.inference_available or not self.imagePath:
-            return
-        try:
-            mask_arr, _ = self.inference_engine.run_prompt_inference(
-                image=self.imagePath,
-                box=box,
-                multimask_output=False,
-                hq_token_only=False,
-            )
-        except Exception as e:
-            print(f"rect add 推理失败: {e}")
-            return
-        self._applyMaskAdd(mask_arr)
+        self.startBoxPrompt("add", [box], "框选添加推理中...")
 
     def onRectEraseSelected(self, box):
-        if not self.inference_available or not self.imagePath:
-            return
-        try:
-            mask_arr, _ = self.inference_engine.run_prompt_inference(
-                image=self.imagePath,
-                box=box,
-                multimask_output=False,
-                hq_token_only=False,
-            )
-        except Exception as e:
-            print(f"rect erase 推理失败: {e}")
-            return
-        self._applyMaskErase(mask_arr)
+        self.startBoxPrompt("erase", [box], "框选擦除推理中...")
 
     def _resizeMaskToCanvas(self, mask_arr):
         import numpy as np
         from PIL import Image as _PIL
+        if mask_arr.ndim == 3:
+            # 推理返回(N, H, W)，合并为一张掩膜
+            mask_arr = mask_arr.max(axis=0)
         if hasattr(self.canvas, 'baseImage') and not self.canvas.baseImage.isNull():
             w = self.canvas.baseImage.width()
             h = self.canvas.baseImage.height()
@@ -718,17 +880,24 @@ class ImageMaskingTool(QMainWindow):
             return mask_arr, w, h
         return mask_arr, None, None
 
-    def _applyMaskAdd(self, mask_arr):
+    def _applyMaskAdd(self, mask_arr, timer=None):
         import numpy as np
-        mask_arr = (mask_arr * 255).astype(np.uint8) if mask_arr.max() <= 1 else mask_arr.astype(np.uint8)
-        mask_arr, w, h = self._resizeMaskToCanvas(mask_arr)
+        with timed(timer, "resize_to_canvas"):
+            mask_arr = (mask_arr * 255).astype(np.uint8) if mask_arr.max() <= 1 else mask_arr.astype(np.uint8)
+            mask_arr, w, h = self._resizeMaskToCanvas(mask_arr)
         if w is None:
             return
+        with timed(timer, "compose"):
+            return self._composeMaskAdd(mask_arr, w, h)
+
+    def _composeMaskAdd(self, mask_arr, w, h):
+        import numpy as np
         if not hasattr(self.canvas, 'maskLayer') or self.canvas.maskLayer is None:
             self.canvas.createMaskLayer()
         mask_bool = mask_arr > 128
-        if not mask_bool.any():
-            return
+        painted = int(mask_bool.sum())
+        if not painted:
+            return 0
         # 先清除将要叠加的区域，避免重复叠加加深
         clear_rgba = np.zeros((h, w, 4), dtype=np.uint8)
         clear_rgba[mask_bool, 3] = 255
@@ -748,95 +917,136 @@ class ImageMaskingTool(QMainWindow):
         self.masks[self.imagePath] = self.canvas.maskLayer.copy()
         self.canvas.invalidateCache()
         self.canvas.update()
+        return painted
 
-    def _applyMaskErase(self, mask_arr):
+    def _applyMaskErase(self, mask_arr, timer=None):
         import numpy as np
-        mask_arr = (mask_arr * 255).astype(np.uint8) if mask_arr.max() <= 1 else mask_arr.astype(np.uint8)
-        mask_arr, w, h = self._resizeMaskToCanvas(mask_arr)
+        with timed(timer, "resize_to_canvas"):
+            mask_arr = (mask_arr * 255).astype(np.uint8) if mask_arr.max() <= 1 else mask_arr.astype(np.uint8)
+            mask_arr, w, h = self._resizeMaskToCanvas(mask_arr)
         if w is None:
             return
         if not hasattr(self.canvas, 'maskLayer') or self.canvas.maskLayer is None:
             return
-        rgba = np.zeros((h, w, 4), dtype=np.uint8)
-        rgba[mask_arr > 128, 3] = 255
-        qimg = QImage(rgba.data, w, h, w * 4, QImage.Format_RGBA8888).copy()
-        p = QPainter(self.canvas.maskLayer)
-        try:
-            p.setCompositionMode(QPainter.CompositionMode_DestinationOut)
-            p.drawImage(0, 0, qimg)
-        finally:
-            p.end()
-        self.masks[self.imagePath] = self.canvas.maskLayer.copy()
-        self.canvas.invalidateCache()
-        self.canvas.update()
+        with timed(timer, "compose"):
+            rgba = np.zeros((h, w, 4), dtype=np.uint8)
+            rgba[mask_arr > 128, 3] = 255
+            qimg = QImage(rgba.data, w, h, w * 4, QImage.Format_RGBA8888).copy()
+            p = QPainter(self.canvas.maskLayer)
+            try:
+                p.setCompositionMode(QPainter.CompositionMode_DestinationOut)
+                p.drawImage(0, 0, qimg)
+            finally:
+                p.end()
+            self.masks[self.imagePath] = self.canvas.maskLayer.copy()
+            self.canvas.invalidateCache()
+            self.canvas.update()
 
     def onBoxPromptSelected(self, box):
+        self.startBoxPrompt("add", [box], "框选金属推理中...")
+
+    def startBoxPrompt(self, kind, boxes, message):
+        """把拉框请求交给后台线程；kind为add或erase
+
+        新请求使之前所有未完成的请求过期：排队中的直接丢弃，正在运行的在下一轮精修前放弃，
+        因此快速连续拉框只会执行最新的一个。
+        """
         if not self.inference_available or not self.imagePath:
-            print(f"图像的路径是: {self.imagePath}")
             self.statusBar.showMessage("推理不可用或未加载图像")
+            return False
+        self.cancelBoxPrompts()
+        self.activePrompt = (self.promptRequestId, self.imagePath, time.time(), kind, len(boxes))
+        worker = BoxPromptWorker(
+            self.inference_engine,
+            self.promptRequestId,
+            self.imagePath,
+            boxes,
+            self.isActivePrompt,
+        )
+        worker.signals.preview.connect(self.onBoxPromptPreview)
+        worker.signals.finished.connect(self.onBoxPromptFinished)
+        worker.signals.failed.connect(self.onBoxPromptFailed)
+        self.promptWorker = worker
+        self.promptThreadpool.start(worker)
+        self.statusBar.showMessage(message)
+        return True
+
+    def cancelBoxPrompts(self):
+        """使所有未完成的拉框请求过期，并清掉还没开始执行的任务"""
+        self.promptRequestId += 1
+        self.activePrompt = None
+        self.promptThreadpool.clear()
+        self.canvas.clearPreviewMask()
+
+    def isActivePrompt(self, requestId):
+        """请求仍是最新一次且图像未切换时，其结果才应被应用；也会在工作线程中调用"""
+        activePrompt = self.activePrompt
+        return (activePrompt is not None
+                and activePrompt[0] == requestId
+                and activePrompt[1] == self.imagePath)
+
+    def onBoxPromptPreview(self, requestId, mask):
+        if not self.isActivePrompt(requestId) or self.activePrompt[3] != "add":
             return
-        import time
-        t0 = time.time()
-        try:
-            mask_result, _ = self.inference_engine.run_prompt_inference(
-                image=self.imagePath,
-                box=box,
-                multimask_output=False,
-                hq_token_only=False,
-            )
-        except Exception as e:
-            # self.statusBar.showMessage(f"框选推理失败: {e}")
-            print(f"框选推理失败: {e}") 
+        self.canvas.setPreviewMask(mask)
+        dt = (time.time() - self.activePrompt[2]) * 1000.0
+        self.statusBar.showMessage(f"预览已显示 ({dt:.0f}ms)，正在精修...")
+
+    def onBoxPromptFailed(self, requestId, error):
+        if not self.isActivePrompt(requestId):
             return
+        self.activePrompt = None
+        self.canvas.clearPreviewMask()
+        print(f"框选推理失败: {error}")
+        self.statusBar.showMessage(f"框选推理失败: {error}")
+
+    def onBoxPromptFinished(self, requestId, result):
+        if not self.isActivePrompt(requestId):
+            return
+        mask_result, timer = result
+        _, _, t0, kind, boxCount = self.activePrompt
+        self.activePrompt = None
+        self.canvas.clearPreviewMask()
         try:
             import numpy as np
-            if isinstance(mask_result, np.ndarray):
-                if mask_result.max() <= 1:
-                    mask_result = (mask_result * 255).astype(np.uint8)
-                else:
-                    mask_result = mask_result.astype(np.uint8)
-                if hasattr(self.canvas, 'baseImage') and not self.canvas.baseImage.isNull():
-                    w = self.canvas.baseImage.width()
-                    h = self.canvas.baseImage.height()
-                    if mask_result.shape[:2] != (h, w):
-                        from PIL import Image as _PIL
-                        _m = _PIL.fromarray(mask_result, mode='L').resize((w, h), _PIL.NEAREST)
-                        mask_result = np.array(_m)
-                    import numpy as _np
-                    mask_bool = mask_result > 128
-                    painted = int(mask_bool.sum())
-                    if not hasattr(self.canvas, 'maskLayer') or self.canvas.maskLayer is None:
-                        self.canvas.createMaskLayer()
-                    painter = QPainter(self.canvas.maskLayer)
-                    try:
-                        if painted > 0:
-                            # 先把该掩膜区域清空，避免重复叠加加深
-                            clear_rgba = _np.zeros((h, w, 4), dtype=_np.uint8)
-                            clear_rgba[mask_bool, 3] = 255
-                            qimg_clear = QImage(clear_rgba.data, w, h, w * 4, QImage.Format_RGBA8888).copy()
-                            painter.setCompositionMode(QPainter.CompositionMode_DestinationOut)
-                            painter.drawImage(0, 0, qimg_clear)
-
-                            # 再以固定透明度覆盖绿色
-                            green_rgba = _np.zeros((h, w, 4), dtype=_np.uint8)
-                            green_rgba[mask_bool] = [0, 255, 0, 128]
-                            qimg_green = QImage(green_rgba.data, w, h, w * 4, QImage.Format_RGBA8888).copy()
-                            painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
-                            painter.drawImage(0, 0, qimg_green)
-                    finally:
-                        painter.end()
-                    self.masks[self.imagePath] = self.canvas.maskLayer.copy()
-                    self.canvas.invalidateCache()
-                    self.canvas.update()
-                    dt = (time.time() - t0) * 1000.0
-                    self.statusBar.showMessage(f"框选金属推理完成: 用时{dt:.1f}ms, 上色像素{painted}")
-                else:
+            if not isinstance(mask_result, np.ndarray):
+                self.statusBar.showMessage("推理结果格式错误")
+                return
+            if kind == "erase":
+                self._applyMaskErase(mask_result, timer)
+                painted = None
+            else:
+                painted = self._applyMaskAdd(mask_result, timer)
+                if painted is None:
                     self.statusBar.showMessage("无法获取基础图像信息")
+                    return
+            if boxCount > 1:
+                self.canvas.clearQueuedBoxes()
+            self.inference_engine.finish_timing(timer)
+            dt = (time.time() - t0) * 1000.0
+            if kind == "erase":
+                self.statusBar.showMessage(f"框选擦除完成: 用时{dt:.1f}ms")
+            elif boxCount > 1:
+                self.statusBar.showMessage(f"批量框选推理完成: {boxCount} 个框, 用时{dt:.1f}ms")
             else:
-                self.statusBar.showMessage("推理结果格式错误")
+                self.statusBar.showMessage(f"框选金属推理完成: 用时{dt:.1f}ms, 上色像素{painted}")
         except Exception as e:
             self.statusBar.showMessage(f"应用推理结果时出错: {e}")
     
+    def onBoxPromptQueued(self, count):
+        self.statusBar.showMessage(f"已排队 {count} 个提示框: 回车批量推理，Esc清空")
+
+    def clearQueuedBoxes(self):
+        if self.canvas.clearQueuedBoxes():
+            self.statusBar.showMessage("已清空排队的提示框")
+
+    def applyQueuedBoxes(self):
+        boxes = list(self.canvas.queuedBoxes)
+        if not boxes:
+            return
+        # 排队的框在结果应用后才清空，推理失败或被取消时可以再次回车
+        self.startBoxPrompt("add", boxes, f"批量框选推理中: {len(boxes)} 个框...")
+
     def resetView(self):
         self.canvas.resetPan()
         self.statusBar.showMessage("视图已重置")
@@ -913,6 +1123,7 @@ class ImageMaskingTool(QMainWindow):
             if "Input type" in error and "bias type" in error:
                 self.statusBar.showMessage("推理失败: 数据类型不匹配，正在重新初始化...")
                 try:
+                    from .inference import Inference
                     self.inference_engine = Inference()
                     self.statusBar.showMessage("推理引擎已重新初始化，请重试")
                 except Exception:
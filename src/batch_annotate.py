@@ -0,0 +1,216 @@
+"""无界面批量标注：读取 图像→框 清单，批量生成 *_mask.png
+
+不依赖Qt，可在服务器上运行:
+
+    python -m src.batch_annotate boxes.json -o masks/
+
+清单格式:
+  - JSON: {"a.jpg": [[x1, y1, x2, y2], ...], ...}
+    或 [{"image": "a.jpg", "boxes": [[x1, y1, x2, y2], ...]}, ...]
+  - CSV: 表头为 image,x1,y1,x2,y2，每行一个框
+相对路径按清单所在目录(或--image-root)解析。
+
+输出与界面保存一致：白底，掩膜区域为黑色。输出按图像相对公共根目录的
+子目录存放，不同目录下的同名图像不会互相覆盖。已存在的输出会被跳过，
+因此中断后重新运行即可续跑。
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from .image_cache import decode_rgb
+
+
+def load_manifest(manifest_path, image_root=None):
+    """读取清单，返回[(图像路径, [[x1, y1, x2, y2], ...]), ...]，同一图像的框合并"""
+    if image_root is None:
+        image_root = os.path.dirname(os.path.abspath(manifest_path))
+    items = OrderedDict()
+
+    def add(image, box):
+        path = image if os.path.isabs(image) else os.path.join(image_root, image)
+        boxes = items.setdefault(path, [])
+        if box is not None:
+            boxes.append([float(v) for v in box])
+
+    if manifest_path.lower().endswith(".csv"):
+        with open(manifest_path, "r", encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                add(row["image"], [row["x1"], row["y1"], row["x2"], row["y2"]])
+    else:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            data = [{"image": k, "boxes": v} for k, v in data.items()]
+        for record in data:
+            add(record["image"], None)
+            for box in record.get("boxes", []):
+                add(record["image"], box)
+    return list(items.items())
+
+
+def mask_output_path(image_path, out_dir, image_root=None):
+    """image_root给定时保留图像相对它的子目录，否则直接放在out_dir下"""
+    baseName = os.path.splitext(os.path.basename(image_path))[0]
+    subdir = ""
+    if image_root is not None:
+        subdir = os.path.relpath(os.path.dirname(os.path.abspath(image_path)), image_root)
+        if subdir == os.curdir:
+            subdir = ""
+    return os.path.join(out_dir, subdir, f"{baseName}_mask.png")
+
+
+def mask_output_paths(paths, out_dir):
+    """为每张图像确定输出路径，子目录相对所有图像的公共根目录保留
+
+    去掉扩展名后仍然重名(如同一目录下的a.jpg与a.png)时抛出ValueError，而不是让后写的覆盖先写的。
+    """
+    paths = list(paths)
+    if not paths:
+        return {}
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+    outputs = OrderedDict()
+    owners = {}
+    for path in paths:
+        save_path = mask_output_path(path, out_dir, root)
+        if save_path in owners:
+            raise ValueError(f"{owners[save_path]} 与 {path} 的输出都是 {save_path}")
+        owners[save_path] = path
+        outputs[path] = save_path
+    return outputs
+
+
+def write_mask(mask, save_path):
+    """按界面格式写出掩膜(白底黑掩膜)，先写临时文件再rename，中断不会留下半个PNG"""
+    out = np.full(mask.shape[:2], 255, dtype=np.uint8)
+    out[mask > 0] = 0
+    tmp_path = save_path + ".tmp"
+    Image.fromarray(out, "L").save(tmp_path, format="PNG")
+    os.replace(tmp_path, save_path)
+    return save_path
+
+
+def iter_masks(items, engine=None, workers=4, prefetch=4):
+    """逐图生成掩膜的生成器，可嵌入其他流水线
+
+    items为[(图像路径, 框列表), ...]；后台线程预先解码后续prefetch张图像，
+    编码与解码在当前线程串行执行。
+    产出(图像路径, masks (N, H, W) uint8, scores (N,))，无法读取或推理失败的图像产出masks=None。
+    """
+    if engine is None:
+        engine = _headless_engine()
+    items = [(path, boxes) for path, boxes in items if boxes]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        it = iter(items)
+        for path, boxes in it:
+            pending.append((path, boxes, pool.submit(decode_rgb, path)))
+            if len(pending) >= prefetch:
+                break
+        while pending:
+            path, boxes, future = pending.popleft()
+            nxt = next(it, None)
+            if nxt is not None:
+                pending.append((nxt[0], nxt[1], pool.submit(decode_rgb, nxt[0])))
+            try:
+                np_img = future.result()
+            except Exception as e:
+                print(f"[batch] 读取失败 {path}: {e}")
+                yield path, None, None
+                continue
+            try:
+                masks, scores = engine.run_prompt_inference_batch(path, boxes, np_img=np_img)
+            except Exception as e:
+                print(f"[batch] 推理失败 {path}: {e}")
+                yield path, None, None
+                continue
+            yield path, masks, scores
+
+
+def _headless_engine(use_store=True):
+    """批处理一开始就连续推理，不需要预热"""
+    from .inference import Config, Inference
+    config = Config()
+    config.warmup = False
+    config.use_embedding_store = use_store
+    return Inference(config=config)
+
+
+def annotate(items, out_dir, engine=None, workers=4, prefetch=4, overwrite=False):
+    """对清单中的全部图像生成掩膜并写入out_dir，返回(写出数, 跳过数, 失败数)"""
+    items = [(path, boxes) for path, boxes in items if boxes]
+    outputs = mask_output_paths([path for path, _ in items], out_dir)
+    for save_dir in set(os.path.dirname(p) for p in outputs.values()) | {out_dir}:
+        os.makedirs(save_dir, exist_ok=True)
+    todo = []
+    skipped = 0
+    for path, boxes in items:
+        if not overwrite and os.path.exists(outputs[path]):
+            skipped += 1
+            continue
+        todo.append((path, boxes))
+    print(f"[batch] 待处理 {len(todo)} 张，已存在跳过 {skipped} 张")
+
+    written = failed = 0
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as writer:
+        writes = deque()
+        for path, masks, _ in iter_masks(todo, engine, workers=workers, prefetch=prefetch):
+            if masks is None:
+                failed += 1
+                continue
+            union = np.any(masks > 0, axis=0) if len(masks) else np.zeros(masks.shape[1:], dtype=bool)
+            writes.append(writer.submit(write_mask, union, outputs[path]))
+            # 写盘落后太多时等待，避免掩膜在内存中堆积
+            while len(writes) > workers * 2 or (writes and writes[0].done()):
+                try:
+                    writes.popleft().result()
+                    written += 1
+                except Exception as e:
+                    print(f"[batch] 写出失败: {e}")
+                    failed += 1
+            done = written + failed
+            if done and done % 50 == 0:
+                print(f"[batch] {done}/{len(todo)}  {done / (time.time() - t0):.2f} 张/秒")
+        for future in writes:
+            try:
+                future.result()
+                written += 1
+            except Exception as e:
+                print(f"[batch] 写出失败: {e}")
+                failed += 1
+    dt = time.time() - t0
+    print(f"[batch] 完成: 写出 {written}，跳过 {skipped}，失败 {failed}，用时{dt:.1f}s")
+    return written, skipped, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="根据框清单批量生成掩膜(无界面)")
+    parser.add_argument("manifest", help="JSON或CSV清单")
+    parser.add_argument("-o", "--out-dir", required=True, help="掩膜输出目录")
+    parser.add_argument("--image-root", default=None, help="清单中相对路径的根目录，默认为清单所在目录")
+    parser.add_argument("--workers", type=int, default=4, help="解码与写盘线程数")
+    parser.add_argument("--prefetch", type=int, default=4, help="预先解码的图像数")
+    parser.add_argument("--overwrite", action="store_true", help="覆盖已存在的掩膜")
+    parser.add_argument("--use-store", action="store_true", help="同时把图像嵌入写入磁盘嵌入库")
+    args = parser.parse_args(argv)
+
+    items = load_manifest(args.manifest, args.image_root)
+    try:
+        # 加载模型前先检查输出路径冲突
+        mask_output_paths([path for path, boxes in items if boxes], args.out_dir)
+    except ValueError as e:
+        parser.error(str(e))
+    engine = _headless_engine(args.use_store)
+    _, _, failed = annotate(items, args.out_dir, engine, args.workers, args.prefetch, args.overwrite)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+"""离线数据集清理：用sam_refiner批量精修其他模型产出的粗掩膜
+
+    python -m src.batch_refine images/ --masks coarse/ -o refined/ --batch-size 4
+
+粗掩膜按图像文件名在--masks目录中查找:
+  - <name>.png: 实例标签图(灰度或调色板PNG)，每个非零值为一个实例
+  - <name>_mask.png: 界面保存的格式(白底黑掩膜)，按连通域拆分为实例
+精修结果以相同的格式与文件名写入输出目录。已存在的输出会被跳过，中断后重新运行即可续跑。
+
+每--batch-size张图像的编码合并为一次编码器前向，精修的每一轮也对这批图像的全部掩膜只调用一次解码器；
+后台线程预先读取、缩放后续--prefetch批图像，写盘同样在后台进行，模型计算不必等待IO。
+批量编码始终走PyTorch模型(ONNX后端导出的编码器固定batch为1)。
+"""
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from .batch_annotate import _headless_engine, write_mask
+from .cpu_profile import encoder_autocast
+from .image_cache import decode_rgb
+from .preencode import find_images
+from .sam_refiner import encode_images, sam_refiner_batch
+
+
+def coarse_mask_path(image_path, masks_dir):
+    """返回(粗掩膜路径, 格式)，格式为"labels"或"ui"；找不到时返回(None, None)"""
+    baseName = os.path.splitext(os.path.basename(image_path))[0]
+    for name, fmt in ((f"{baseName}.png", "labels"), (f"{baseName}_mask.png", "ui")):
+        path = os.path.join(masks_dir, name)
+        if os.path.exists(path):
+            return path, fmt
+    return None, None
+
+
+def load_coarse_masks(path, fmt):
+    """读取粗掩膜，返回(N, H, W) uint8实例掩膜"""
+    with Image.open(path) as im:
+        arr = np.array(im)
+    if arr.ndim == 3:
+        arr = arr[..., 0]
+    if fmt == "ui":
+        count, labels = cv2.connectedComponents((arr < 128).astype(np.uint8), connectivity=8)
+        ids = np.arange(1, count)
+    else:
+        labels = arr
+        ids = np.unique(labels)
+        ids = ids[ids != 0]
+    return (labels[None] == ids[:, None, None]).astype(np.uint8)
+
+
+def write_refined(masks, save_path, fmt):
+    """按输入格式写出精修结果，实例重叠处后面的实例覆盖前面的"""
+    if fmt == "ui":
+        union = np.any(masks > 0, axis=0) if len(masks) else np.zeros(masks.shape[1:], dtype=bool)
+        return write_mask(union, save_path)
+    dtype = np.uint8 if len(masks) < 256 else np.uint16
+    labels = np.zeros(masks.shape[1:], dtype=dtype)
+    for i, mask in enumerate(masks, 1):
+        labels[mask > 0] = i
+    tmp_path = save_path + ".tmp"
+    Image.fromarray(labels).save(tmp_path, format="PNG")
+    os.replace(tmp_path, save_path)
+    return save_path
+
+
+def _prepare(image_path, mask_path, fmt, transform):
+    """后台线程: 解码图像与粗掩膜，并完成编码器输入的缩放"""
+    np_img = decode_rgb(image_path)
+    masks = load_coarse_masks(mask_path, fmt)
+    if masks.shape[1:] != np_img.shape[:2]:
+        raise ValueError(f"粗掩膜尺寸{masks.shape[1:]}与图像尺寸{np_img.shape[:2]}不一致")
+    input_image = torch.as_tensor(transform.apply_image(np_img)).permute(2, 0, 1).contiguous()
+    return input_image, masks
+
+
+def iter_refined(items, engine=None, batch_size=4, workers=4, prefetch=2):
+    """按批精修的生成器
+
+    items为[(图像路径, 粗掩膜路径, 格式), ...]；后台线程预先准备后续prefetch批。
+    产出(图像路径, 格式, 精修掩膜 (N, H, W) uint8)，读取失败的图像产出掩膜None。
+    """
+    if engine is None:
+        engine = _headless_engine(use_store=False)
+    transform = engine.predictor.transform
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        it = iter(batches)
+
+        def submit(batch):
+            pending.append([(item, pool.submit(_prepare, item[0], item[1], item[2], transform)) for item in batch])
+
+        for batch in it:
+            submit(batch)
+            if len(pending) >= prefetch:
+                break
+        while pending:
+            jobs = pending.popleft()
+            nxt = next(it, None)
+            if nxt is not None:
+                submit(nxt)
+            ready = []
+            for (path, _, fmt), future in jobs:
+                try:
+                    ready.append((path, fmt) + future.result())
+                except Exception as e:
+                    print(f"[refine] 读取失败 {path}: {e}")
+                    yield path, fmt, None
+            if not ready:
+                continue
+            for (path, fmt, _, _), (refined, _) in zip(ready, refine_batch(engine, ready)):
+                yield path, fmt, refined
+
+
+def refine_batch(engine, ready):
+    """ready为[(路径, 格式, 缩放后的输入图像, 粗掩膜), ...]，一次编码器前向后批量精修"""
+    input_images = [r[2] for r in ready]
+    model = engine.model_hq
+    with torch.no_grad(), encoder_autocast(engine.encoder_profile):
+        features, interm = encode_images(model, input_images, use_samhq=True)
+    # 解码器保持fp32，低精度编码的输出在此转换回来
+    features, interm = features.float(), interm.float()
+    return sam_refiner_batch(
+        [r[0] for r in ready],
+        [r[3] for r in ready],
+        model,
+        resize_transform=engine.predictor.transform,
+        use_samhq=True,
+        iters=engine.config.refiner_iters,
+        image_embeddings=features,
+        interm_embeddings=interm,
+        input_images=input_images,
+        stop_iou=engine.config.refiner_stop_iou,
+        stop_score_delta=engine.config.refiner_stop_score_delta,
+        work_size=engine.config.refiner_work_size,
+    )
+
+
+def refine_dataset(image_paths, masks_dir, out_dir, engine=None, batch_size=4, workers=4, prefetch=2,
+                   overwrite=False):
+    """精修image_paths中所有能找到粗掩膜的图像，返回(写出数, 跳过数, 失败数)"""
+    os.makedirs(out_dir, exist_ok=True)
+    todo = []
+    skipped = missing = 0
+    for path in image_paths:
+        mask_path, fmt = coarse_mask_path(path, masks_dir)
+        if mask_path is None:
+            missing += 1
+            continue
+        if not overwrite and os.path.exists(os.path.join(out_dir, os.path.basename(mask_path))):
+            skipped += 1
+            continue
+        todo.append((path, mask_path, fmt))
+    print(f"[refine] 待处理 {len(todo)} 张，已存在跳过 {skipped} 张，无粗掩膜 {missing} 张")
+
+    written = failed = 0
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as writer:
+        writes = deque()
+        for path, fmt, refined in iter_refined(todo, engine, batch_size, workers, prefetch):
+            if refined is None:
+                failed += 1
+                continue
+            mask_path, _ = coarse_mask_path(path, masks_dir)
+            save_path = os.path.join(out_dir, os.path.basename(mask_path))
+            writes.append(writer.submit(write_refined, refined, save_path, fmt))
+            # 写盘落后太多时等待，避免掩膜在内存中堆积
+            while len(writes) > workers * 2 or (writes and writes[0].done()):
+                try:
+                    writes.popleft().result()
+                    written += 1
+                except Exception as e:
+                    print(f"[refine] 写出失败: {e}")
+                    failed += 1
+            done = written + failed
+            if done and done % 50 == 0:
+                print(f"[refine] {done}/{len(todo)}  {done / (time.time() - t0):.2f} 张/秒")
+        for future in writes:
+            try:
+                future.result()
+                written += 1
+            except Exception as e:
+                print(f"[refine] 写出失败: {e}")
+                failed += 1
+    dt = time.time() - t0
+    print(f"[refine] 完成: 写出 {written}，跳过 {skipped}，失败 {failed}，用时{dt:.1f}s")
+    return written, skipped, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="用sam_refiner批量精修目录中图像的粗掩膜(无界面)")
+    parser.add_argument("images", help="图像目录")
+    parser.add_argument("--masks", required=True, help="粗掩膜目录")
+    parser.add_argument("-o", "--out-dir", required=True, help="精修结果输出目录")
+    parser.add_argument("--batch-size", type=int, default=4, help="每次编码器前向的图像数")
+    parser.add_argument("--workers", type=int, default=4, help="读取与写盘线程数")
+    parser.add_argument("--prefetch", type=int, default=2, help="预先准备的批数")
+    parser.add_argument("--threads", type=int, default=None, help="CPU推理线程数，默认物理核数")
+    parser.add_argument("--overwrite", action="store_true", help="覆盖已存在的结果")
+    args = parser.parse_args(argv)
+
+    from .inference import Config, Inference
+    config = Config()
+    config.warmup = False
+    config.use_embedding_store = False
+    config.cpu_threads = args.threads
+    engine = Inference(config=config)
+    # 掩膜与输出目录放在图像目录下时，不把其中的PNG当作图像
+    excluded = tuple(os.path.abspath(d) + os.sep for d in (args.masks, args.out_dir))
+    paths = [p for p in find_images(args.images) if not os.path.abspath(p).startswith(excluded)]
+    _, _, failed = refine_dataset(paths, args.masks, args.out_dir, engine, args.batch_size, args.workers,
+                                  args.prefetch, args.overwrite)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
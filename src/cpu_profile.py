@@ -0,0 +1,78 @@
+import contextlib
+import os
+import torch
+
+CPU_PROFILES = ("fp32", "bf16", "int8")
+
+
+def _cpuinfo():
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8", errors="ignore") as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+def physical_core_count():
+    """物理核数；超线程对ViT的矩阵乘几乎没有收益，读不到时退回逻辑核数"""
+    cores = set()
+    physical_id = core_id = None
+    for line in _cpuinfo().splitlines():
+        if line.startswith("physical id"):
+            physical_id = line.split(":")[1].strip()
+        elif line.startswith("core id"):
+            core_id = line.split(":")[1].strip()
+        elif not line.strip() and core_id is not None:
+            cores.add((physical_id, core_id))
+            physical_id = core_id = None
+    if core_id is not None:
+        cores.add((physical_id, core_id))
+    return len(cores) or os.cpu_count() or 1
+
+
+def cpu_supports_bf16():
+    """CPU是否有原生bf16指令(AVX512-BF16或AMX)；没有时bf16只会更慢"""
+    if not torch.backends.mkldnn.is_available():
+        return False
+    flags = _cpuinfo()
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def configure_threads(num_threads=None):
+    """设置intra-op线程数，默认取物理核数；返回实际线程数"""
+    if not num_threads:
+        num_threads = physical_core_count()
+    torch.set_num_threads(num_threads)
+    try:
+        # 只能在任何并行计算之前设置一次，重复设置会抛异常
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+    return num_threads
+
+
+def quantize_encoder_int8(model):
+    """对图像编码器的Linear层做动态int8量化(权重int8，激活在运行时量化)
+
+    编码器的计算量绝大部分在注意力与MLP的Linear上；解码器很小且对精度更敏感，保持fp32。
+    """
+    model.image_encoder = torch.ao.quantization.quantize_dynamic(
+        model.image_encoder, {torch.nn.Linear}, dtype=torch.qint8
+    )
+    return model
+
+
+def resolve_cpu_profile(profile):
+    """校验配置，bf16在不支持的CPU上退回fp32"""
+    if profile not in CPU_PROFILES:
+        raise ValueError(f"未知的CPU配置: {profile}，可选 {CPU_PROFILES}")
+    if profile == "bf16" and not cpu_supports_bf16():
+        print("[Inference] 当前CPU不支持原生bf16，退回fp32")
+        return "fp32"
+    return profile
+
+
+def encoder_autocast(profile):
+    if profile == "bf16":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
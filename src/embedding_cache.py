@@ -0,0 +1,92 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class ImageEmbedding:
+    """单张图像的编码器输出，可直接恢复到SamPredictor中跳过set_image"""
+
+    def __init__(self, features, interm_features, input_image, original_size, input_size):
+        self.features = features
+        # HQ解码器只使用第一个全局注意力块的中间特征，其余层不缓存
+        self.interm_features = list(interm_features)[:1]
+        # 缩放后的(3, h, w) uint8输入，sam_refiner据此构造提示而无需再次解码/编码
+        self.input_image = input_image
+        self.original_size = tuple(original_size)
+        self.input_size = tuple(input_size)
+
+    def nbytes(self):
+        total = 0
+        for t in [self.features, self.input_image] + self.interm_features:
+            if t is not None:
+                total += t.element_size() * t.nelement()
+        return total
+
+
+def embedding_key(image_path, model_tag):
+    """缓存键: (绝对路径, 文件mtime, 模型标识)，文件被改写后自动失效"""
+    path = os.path.abspath(image_path)
+    return (path, os.stat(path).st_mtime_ns, model_tag)
+
+
+class LRUCache:
+    """按字节预算做LRU淘汰的线程安全缓存，sizeof(value)给出条目字节数"""
+
+    def __init__(self, max_bytes, sizeof):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._entries = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def total_bytes(self):
+        return self._total
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._total -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return False
+            self._entries[key] = (value, size)
+            self._total += size
+            while self._total > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._total -= evicted
+        return True
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._total -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total = 0
+
+
+class EmbeddingCache(LRUCache):
+    """按字节预算做LRU淘汰的图像嵌入缓存"""
+
+    def __init__(self, max_bytes):
+        super().__init__(max_bytes, lambda entry: entry.nbytes())
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import zlib
+import numpy as np
+import torch
+from .embedding_cache import ImageEmbedding
+
+STORE_VERSION = 1
+STORE_DIRNAME = ".sam_embeddings"
+
+_ARRAYS = ("features", "interm", "input_image")
+
+
+def file_digest(path, chunk_size=4 * 1024 * 1024):
+    """文件内容的sha1，用作图像的内容哈希"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def checkpoint_fingerprint(path, sample_bytes=8 * 1024 * 1024):
+    """权重文件指纹: 大小 + 首尾各8MB的sha1
+
+    权重文件动辄上GB，每次启动做全量哈希代价过高；任何重新训练或替换都会改变
+    文件大小或首尾内容，足以区分不同权重。
+    """
+    if not os.path.exists(path):
+        return "random-init"
+    size = os.path.getsize(path)
+    h = hashlib.sha1(str(size).encode())
+    with open(path, "rb") as f:
+        h.update(f.read(sample_bytes))
+        if size > sample_bytes:
+            f.seek(max(sample_bytes, size - sample_bytes))
+            h.update(f.read(sample_bytes))
+    return h.hexdigest()
+
+
+def _crc(arr):
+    return zlib.crc32(np.ascontiguousarray(arr).view(np.uint8).reshape(-1)) & 0xFFFFFFFF
+
+
+class EmbeddingStore:
+    """磁盘上的图像嵌入库，嵌入以fp16 .npy保存
+
+    每个条目一个目录: meta.json + features.npy + interm.npy + input_image.npy。
+    每个文件先写到本进程/线程独有的临时名再单独os.replace，meta.json最后写入作为条目完整的标志；
+    条目已存在时直接视为写入成功，多个预编码进程同时写同一条目也不会删掉彼此的文件。
+    读取时整文件读入一次(解码器需要fp32，反正要完整读取并转换)，在内存中校验版本、形状、dtype与crc32，
+    任何不一致都视为损坏条目并删除，由调用方重新编码。
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def entry_key(content_hash, model_type, checkpoint_hash):
+        return hashlib.sha1(f"{content_hash}:{model_type}:{checkpoint_hash}".encode()).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def contains(self, key):
+        return os.path.exists(os.path.join(self._entry_dir(key), "meta.json"))
+
+    def discard(self, key):
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def load(self, key, device="cpu"):
+        """读取条目，不存在返回None；损坏或过期的条目会被删除并返回None"""
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("version") != STORE_VERSION or meta.get("key") != key:
+                raise ValueError("过期的条目格式")
+            arrays = {}
+            for name in _ARRAYS:
+                arr = np.load(os.path.join(entry_dir, f"{name}.npy"))
+                info = meta["arrays"][name]
+                if list(arr.shape) != info["shape"] or str(arr.dtype) != info["dtype"]:
+                    raise ValueError(f"{name} 形状或类型不匹配")
+                if _crc(arr) != info["crc32"]:
+                    raise ValueError(f"{name} 校验失败")
+                arrays[name] = arr
+        except Exception as e:
+            print(f"[EmbeddingStore] 条目 {key} 损坏，将重新编码: {e}")
+            self.discard(key)
+            return None
+
+        features = torch.from_numpy(arrays["features"].astype(np.float32)).to(device)
+        interm = torch.from_numpy(arrays["interm"].astype(np.float32)).to(device)
+        input_image = torch.from_numpy(arrays["input_image"]).to(device)
+        return ImageEmbedding(features, [interm], input_image, meta["original_size"], meta["input_size"])
+
+    def save(self, key, embedding):
+        """写入条目，条目已存在时直接返回True；失败(如数据集目录只读)时仅打印警告并返回False"""
+        if self.contains(key):
+            return True
+        arrays = {
+            "features": embedding.features.detach().to(torch.float16).cpu().numpy(),
+            "interm": embedding.interm_features[0].detach().to(torch.float16).cpu().numpy(),
+            "input_image": embedding.input_image.detach().cpu().numpy(),
+        }
+        entry_dir = self._entry_dir(key)
+        suffix = f".tmp-{os.getpid()}-{threading.get_ident()}"
+        tmp_path = None
+        try:
+            os.makedirs(entry_dir, exist_ok=True)
+            meta = {
+                "version": STORE_VERSION,
+                "key": key,
+                "original_size": list(embedding.original_size),
+                "input_size": list(embedding.input_size),
+                "arrays": {},
+            }
+            for name, arr in arrays.items():
+                path = os.path.join(entry_dir, f"{name}.npy")
+                tmp_path = path + suffix
+                with open(tmp_path, "wb") as f:
+                    np.save(f, arr)
+                os.replace(tmp_path, path)
+                meta["arrays"][name] = {"shape": list(arr.shape), "dtype": str(arr.dtype), "crc32": _crc(arr)}
+            # meta.json最后写入，作为条目完整的标志
+            path = os.path.join(entry_dir, "meta.json")
+            tmp_path = path + suffix
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, path)
+            return True
+        except OSError as e:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            # 并发写入的另一方可能已经写完整个条目
+            if self.contains(key):
+                return True
+            print(f"[EmbeddingStore] 写入 {entry_dir} 失败: {e}")
+            return False
@@ -0,0 +1,60 @@
+import os
+import numpy as np
+from PIL import Image, ImageOps
+from .embedding_cache import LRUCache
+
+# 所有消费者(画布、Inference、sam_refiner)共享的解码结果上限，超大TIFF也只解码一次
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def _to_8bit(img):
+    """把16位/32位整数及浮点灰度图缩放到8位灰度；直接convert("RGB")会把大于255的值截断成白色
+
+    16位按满量程缩放，与QImageReader读取16位灰度图一致；I/F模式没有固定量程，按图像最小/最大值线性拉伸。
+    """
+    arr = np.asarray(img)
+    if img.mode.startswith("I;16"):
+        return Image.fromarray((arr.astype(np.uint32) >> 8).astype(np.uint8), "L")
+    arr = arr.astype(np.float64)
+    lo, hi = float(arr.min()), float(arr.max())
+    if hi > lo:
+        arr = (arr - lo) * (255.0 / (hi - lo))
+    else:
+        arr = np.zeros_like(arr)
+    return Image.fromarray(np.rint(arr).astype(np.uint8), "L")
+
+
+def decode_rgb(path):
+    """解码为HxWx3 uint8 RGB数组，按EXIF方向校正(与QImageReader.setAutoTransform一致)"""
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode.startswith("I") or img.mode == "F":
+            img = _to_8bit(img)
+        return np.asarray(img.convert("RGB"))
+
+
+class DecodedImageCache(LRUCache):
+    """按(路径, mtime)缓存解码后的RGB像素
+
+    返回的数组被设为只读，各消费者直接共享同一块缓冲区(零拷贝)，需要修改时自行复制。
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        super().__init__(max_bytes, lambda arr: arr.nbytes)
+
+    def load(self, path):
+        path = os.path.abspath(path)
+        key = (path, os.stat(path).st_mtime_ns)
+        arr = self.get(key)
+        if arr is None:
+            arr = np.ascontiguousarray(decode_rgb(path))
+            arr.flags.writeable = False
+            self.put(key, arr)
+        return arr
+
+
+shared_image_cache = DecodedImageCache()
+
+
+def load_rgb(path):
+    return shared_image_cache.load(path)
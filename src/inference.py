@@ -1,11 +1,24 @@
 import os
 import time
+import threading
+from contextlib import contextmanager
 import numpy as np
 import torch
 from PIL import Image
 from segment_anything_hq import SamPredictor
 from segment_anything_hq.build_sam import sam_model_registry
-from .sam_refiner import sam_refiner
+from .sam_refiner import RefinementCancelled, sam_refiner
+from .embedding_cache import EmbeddingCache, ImageEmbedding, embedding_key
+from .embedding_store import EmbeddingStore, STORE_DIRNAME, checkpoint_fingerprint, file_digest
+from .model_loading import build_sam_fast
+from .image_cache import decode_rgb, load_rgb
+from .timing import StageTimer, TimingLog, timed
+from .cpu_profile import configure_threads, encoder_autocast, quantize_encoder_int8, resolve_cpu_profile
+
+
+def _check_cancel(should_cancel):
+    if should_cancel is not None and should_cancel():
+        raise RefinementCancelled("请求已被取消")
 
 
 class Config:
@@ -16,57 +29,544 @@ class Config:
         self.multimask_output = False
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.use_fp16 = False
+        # 图像嵌入缓存的字节上限，同一图像的后续拉框只运行解码器
+        self.embedding_cache_bytes = 1024 ** 3
+        # 磁盘嵌入库: 默认放在数据集目录下的.sam_embeddings，设置后统一放到该目录
+        self.use_embedding_store = True
+        self.embedding_store_dir = None
+        # 在meta设备上构建模型并mmap读取权重，跳过随机初始化；失败时退回原有方式
+        self.fast_checkpoint_loading = True
+        # 设置后把权重转存为可mmap的fp32格式缓存在该目录，例如"checkpoints/.converted"
+        self.converted_checkpoint_dir = None
+        # CPU上图像编码器的推理配置: "fp32" | "bf16"(需CPU原生支持) | "int8"(Linear动态量化)
+        self.cpu_profile = "fp32"
+        # CPU intra-op线程数，None时取物理核数
+        self.cpu_threads = None
+        # 推理后端: "torch" | "onnx"(仅CPU，编码器与拉框解码器由ONNX Runtime执行，需要onnxruntime)
+        self.backend = "torch"
+        self.onnx_cache_dir = "checkpoints/.onnx"
+        # 渐进式拉框: 先回调一版未精修的解码器掩膜作为预览，精修结果随后替换
+        self.progressive_preview = True
+        # 可选的小模型预览: HQ嵌入尚未缓存时先用它出预览，例如"vit_b"
+        self.preview_model_type = None
+        self.preview_checkpoint = "checkpoints/sam_hq_vit_b.pth"
+        # 大图上的小框只编码框周围的窗口，精修也只在窗口内进行，结果再贴回原图尺寸；
+        # 仅在图像长边超过编码器输入尺寸、且框长边不超过图像长边的crop_max_box_ratio时启用。
+        # 窗口嵌入只在内存中缓存，默认关闭；开启后整图嵌入已在缓存或磁盘库(含预编码)中时仍直接复用整图嵌入
+        self.crop_mode = False
+        self.crop_max_box_ratio = 0.25
+        self.crop_min_size = 512
+        # sam_refiner最多迭代轮数；相邻两轮掩膜IoU均达到refiner_stop_iou、
+        # 或所选IoU预测的变化均不超过refiner_stop_score_delta时提前结束，None表示不启用该条件
+        self.refiner_iters = 6
+        self.refiner_stop_iou = 0.99
+        self.refiner_stop_score_delta = None
+        # 设置后精修迭代在长边为该值的工作分辨率上进行(如1024，与编码器输入一致)，
+        # 只把最终的低分辨率logits上采样回原图；None表示在原图分辨率上精修
+        self.refiner_work_size = None
+        # 加载后用合成图像跑一遍编码、解码与精修，把内存分配、算子选择和权重换页的开销
+        # 留在启动阶段；无界面批处理可关闭。warmup_image_size为(高, 宽)，宜接近实际图像尺寸
+        self.warmup = True
+        self.warmup_image_size = (1024, 1024)
+        # 设置后每次提示推理的分阶段计时追加到该JSONL文件，可用 python -m src.timing 汇总
+        self.timing_log = None
 
 
 class Inference:
-    def __init__(self):
-        self.config = Config()
+    def __init__(self, progress_callback=None, config=None):
+        self.config = config if config is not None else Config()
+        self.progress_callback = progress_callback
+        self.embedding_cache = EmbeddingCache(self.config.embedding_cache_bytes)
+        # 模型同一时刻只服务一个调用方；交互式请求优先于后台预编码
+        self._model_lock = threading.Lock()
+        self._interactive_cv = threading.Condition()
+        self._interactive_pending = 0
+        self._stores = {}
+        self._content_hashes = {}
+        self.timing_log = TimingLog(self.config.timing_log) if self.config.timing_log else None
+        self.last_timing = None
         self._load_metal_model()
+        self._apply_cpu_profile()
+        self.predictor = self._build_predictor()
+        self._load_preview_model()
+        self.warmup_timing = None
+        if self.config.warmup:
+            # 预热只为提速，失败(如显存不足)不应妨碍模型投入使用
+            try:
+                self.warmup()
+            except Exception as e:
+                self.predictor.reset_image()
+                self.warmup_timing = None
+                self._report(f"预热失败，已跳过: {e}")
+
+    def _report(self, message):
+        """打印加载进度，并转发给界面(如有)"""
+        print(f"[Inference] {message}")
+        if self.progress_callback is not None:
+            self.progress_callback(message)
 
     def _load_metal_model(self):
         print(f"[Inference] HQ类型: {self.config.hq_model_type}")
         print(f"[Inference] HQ权重路径: {self.config.checkpoint_metal_hq}")
-        self.model_hq = sam_model_registry[self.config.hq_model_type](checkpoint=None)
-        if os.path.exists(self.config.checkpoint_metal_hq):
-            state = torch.load(self.config.checkpoint_metal_hq, map_location=self.config.device, weights_only=True)
+        t0 = time.time()
+        self.model_hq = None
+        self._checkpoint_hash = "random-init"
+        if self.config.fast_checkpoint_loading and os.path.exists(self.config.checkpoint_metal_hq):
+            self._report("正在快速加载HQ权重...")
             try:
-                self.model_hq.load_state_dict(state)
+                self.model_hq = build_sam_fast(
+                    self.config.hq_model_type,
+                    self.config.checkpoint_metal_hq,
+                    self.config.device,
+                    self.config.converted_checkpoint_dir,
+                )
+                self._checkpoint_hash = checkpoint_fingerprint(self.config.checkpoint_metal_hq)
                 print("[Inference] 已加载HQ权重")
-            except Exception:
-                print("[Inference] 加载HQ权重失败，但将继续使用随机初始化模型")
-        else:
-            print("[Inference] 未找到HQ权重文件，将使用随机初始化模型")
-        self.model_hq = self.model_hq.to(self.config.device)
+            except Exception as e:
+                self.model_hq = None
+                print(f"[Inference] 快速加载失败，退回常规加载: {e}")
+        if self.model_hq is None:
+            self._report(f"正在构建{self.config.hq_model_type}模型...")
+            self.model_hq = sam_model_registry[self.config.hq_model_type](checkpoint=None)
+            if os.path.exists(self.config.checkpoint_metal_hq):
+                self._report("正在读取HQ权重...")
+                state = torch.load(self.config.checkpoint_metal_hq, map_location=self.config.device, weights_only=True)
+                try:
+                    self.model_hq.load_state_dict(state)
+                    self._checkpoint_hash = checkpoint_fingerprint(self.config.checkpoint_metal_hq)
+                    print("[Inference] 已加载HQ权重")
+                except Exception:
+                    print("[Inference] 加载HQ权重失败，但将继续使用随机初始化模型")
+            else:
+                print("[Inference] 未找到HQ权重文件，将使用随机初始化模型")
+            self._report(f"正在将模型移动到{self.config.device}...")
+            self.model_hq = self.model_hq.to(self.config.device)
         self.model_hq.eval()
         self.use_fp16 = False
         if self.config.use_fp16:
             print("[Inference] 已强制禁用FP16以避免dtype不匹配")
         print(f"[Inference] 模型设备: {self.config.device}")
+        self._report(f"模型加载完成，用时{(time.time() - t0) * 1000.0:.0f}ms")
         return self.model_hq
 
-    def run_prompt_inference(self, image, box, multimask_output=None, hq_token_only=False):
-        """拉框提示推理（仅金属）"""
+    def _load_preview_model(self):
+        self.preview_predictor = None
+        model_type = self.config.preview_model_type
+        if not model_type:
+            return
+        if not os.path.exists(self.config.preview_checkpoint):
+            print(f"[Inference] 未找到预览模型权重 {self.config.preview_checkpoint}，不启用小模型预览")
+            return
+        self._report(f"正在加载{model_type}预览模型...")
+        try:
+            model = build_sam_fast(model_type, self.config.preview_checkpoint, self.config.device)
+        except Exception:
+            model = sam_model_registry[model_type](checkpoint=self.config.preview_checkpoint).to(self.config.device).eval()
+        self.preview_predictor = SamPredictor(model)
+
+    @staticmethod
+    def _synthetic_image(size):
+        """带一个亮色矩形目标的合成图像，返回(图像, 目标框)"""
+        h, w = size
+        rng = np.random.default_rng(0)
+        np_img = rng.integers(0, 64, size=(h, w, 3), dtype=np.uint8)
+        box = np.array([w * 0.3, h * 0.3, w * 0.7, h * 0.7], dtype=np.float32)
+        x0, y0, x1, y1 = box.astype(int)
+        np_img[y0:y1, x0:x1] = 200
+        return np_img, box
+
+    @torch.no_grad()
+    def _warmup_pass(self, np_img, box):
+        timer = self.new_timer(kind="warmup")
+        entry = self._encode_image(np_img, timer)
+        predictor = self._bind_predictor(entry)
+        with timed(timer, "decoder"):
+            masks, _, _ = predictor.predict(box=box, multimask_output=self.config.multimask_output)
+        sam_refiner(
+            None,
+            masks,
+            self.model_hq,
+            use_samhq=True,
+            iters=self.config.refiner_iters,
+            image_embeddings=entry.features,
+            interm_embeddings=entry.interm_features[0],
+            input_image=entry.input_image,
+            timer=timer,
+            work_size=self.config.refiner_work_size,
+        )
+        return timer
+
+    def warmup(self, image_size=None):
+        """用合成图像跑两遍完整的拉框流程，返回并记录首遍(冷)与第二遍(热)的耗时
+
+        嵌入不进入缓存；精修固定跑满refiner_iters轮，使各轮用到的算子都被预热。
+        """
+        size = image_size or self.config.warmup_image_size
+        self._report("正在预热模型...")
+        np_img, box = self._synthetic_image(size)
+        with self._model_lock:
+            cold = self._warmup_pass(np_img, box)
+            warm = self._warmup_pass(np_img, box)
+        self.predictor.reset_image()
+        self.warmup_timing = {
+            "image_size": list(size),
+            "cold_ms": cold.total_ms(),
+            "warm_ms": warm.total_ms(),
+            "cold": cold.as_dict(),
+            "warm": warm.as_dict(),
+        }
+        print(f"[Inference] 预热(冷) {cold.summary_line()}")
+        print(f"[Inference] 预热(热) {warm.summary_line()}")
+        self._report(f"预热完成: 首次 {cold.total_ms():.0f}ms，预热后 {warm.total_ms():.0f}ms")
+        return self.warmup_timing
+
+    def _apply_cpu_profile(self):
+        self.encoder_profile = "fp32"
+        if self.config.device != "cpu":
+            return
+        threads = configure_threads(self.config.cpu_threads)
+        self.encoder_profile = resolve_cpu_profile(self.config.cpu_profile)
+        if self.config.backend == "onnx" and self.encoder_profile != "fp32":
+            # 量化或bf16后的编码器无法导出，ONNX后端使用fp32权重
+            print(f"[Inference] ONNX后端不支持{self.encoder_profile}配置，使用fp32")
+            self.encoder_profile = "fp32"
+        if self.encoder_profile == "int8":
+            quantize_encoder_int8(self.model_hq)
+        print(f"[Inference] CPU配置: {self.encoder_profile}，线程数: {threads}")
+
+    def _build_predictor(self):
+        self.backend = "torch"
+        if self.config.backend == "onnx":
+            if self.config.device != "cpu":
+                print(f"[Inference] ONNX后端仅用于CPU，{self.config.device}上使用PyTorch")
+            else:
+                self._report("正在准备ONNX Runtime后端...")
+                try:
+                    from .onnx_backend import OnnxSamBackend, OnnxSamPredictor
+                    backend = OnnxSamBackend(
+                        self.model_hq,
+                        self.config.hq_model_type,
+                        self._checkpoint_hash,
+                        self.config.onnx_cache_dir,
+                        threads=torch.get_num_threads(),
+                    )
+                    self.backend = "onnx"
+                    return OnnxSamPredictor(self.model_hq, backend)
+                except Exception as e:
+                    print(f"[Inference] ONNX后端不可用，退回PyTorch: {e}")
+        return SamPredictor(self.model_hq)
+
+    def _model_variant(self):
+        """模型类型加编码器精度与后端，不同精度或后端的嵌入不能混用"""
+        variant = self.config.hq_model_type
+        if self.encoder_profile != "fp32":
+            variant = f"{variant}-{self.encoder_profile}"
+        if self.backend != "torch":
+            variant = f"{variant}-{self.backend}"
+        return variant
+
+    def _model_tag(self):
+        return f"{self._model_variant()}@{os.path.abspath(self.config.checkpoint_metal_hq)}"
+
+    def new_timer(self, **meta):
+        sync = torch.cuda.synchronize if str(self.config.device).startswith("cuda") else None
+        return StageTimer(sync=sync, device=str(self.config.device), model=self._model_variant(), **meta)
+
+    def finish_timing(self, timer):
+        """记录最近一次计时，按配置追加到日志，返回字典形式的记录"""
+        record = timer.as_dict()
+        self.last_timing = record
+        iters = timer.meta.get("refiner_iters")
+        if iters is not None:
+            print(f"[Inference] 精修轮数: {iters}/{self.config.refiner_iters}")
+        print(f"[Inference] {timer.summary_line()}")
+        if self.timing_log is not None:
+            try:
+                self.timing_log.append(record)
+            except OSError as e:
+                print(f"[Inference] 写入计时日志失败: {e}")
+        return record
+
+    @torch.no_grad()
+    def _encode_image(self, np_img, timer=None):
+        # 与SamPredictor.set_image相同的预处理，但保留缩放后的输入供sam_refiner复用
+        with timed(timer, "preprocess"):
+            input_image = self.predictor.transform.apply_image(np_img)
+            input_image = torch.as_tensor(input_image, device=self.predictor.device)
+            input_image = input_image.permute(2, 0, 1).contiguous()
+        with timed(timer, "encoder"):
+            with encoder_autocast(self.encoder_profile):
+                self.predictor.set_torch_image(input_image[None, :, :, :], np_img.shape[:2])
+            # 解码器保持fp32，低精度编码的输出在此转换回来
+            self.predictor.features = self.predictor.features.float()
+            self.predictor.interm_features = [t.float() for t in self.predictor.interm_features]
+        return ImageEmbedding(
+            self.predictor.features,
+            self.predictor.interm_features,
+            input_image,
+            self.predictor.original_size,
+            self.predictor.input_size,
+        )
+
+    def _store_for(self, image):
+        root = self.config.embedding_store_dir
+        if not root:
+            root = os.path.join(os.path.dirname(os.path.abspath(image)), STORE_DIRNAME)
+        store = self._stores.get(root)
+        if store is None:
+            store = self._stores[root] = EmbeddingStore(root)
+        return store
+
+    def _store_key(self, image):
+        """磁盘库键: 内容哈希 + 模型类型 + 权重指纹；内容哈希按(路径, mtime, 大小)记忆"""
+        path = os.path.abspath(image)
+        st = os.stat(path)
+        stat_key = (path, st.st_mtime_ns, st.st_size)
+        content_hash = self._content_hashes.get(stat_key)
+        if content_hash is None:
+            content_hash = self._content_hashes[stat_key] = file_digest(path)
+        return EmbeddingStore.entry_key(content_hash, self._model_variant(), self._checkpoint_hash)
+
+    def _lookup_embedding(self, image, key):
+        """依次查询内存缓存与磁盘库，均未命中返回(None, None)"""
+        entry = self.embedding_cache.get(key)
+        if entry is not None:
+            return entry, "memory"
+        if self.config.use_embedding_store:
+            entry = self._store_for(image).load(self._store_key(image), self.config.device)
+            if entry is not None:
+                self.embedding_cache.put(key, entry)
+                return entry, "disk"
+        return None, None
+
+    def _encode_and_store(self, image, key, np_img, timer=None):
+        entry = self._encode_image(np_img, timer)
+        self.embedding_cache.put(key, entry)
+        if self.config.use_embedding_store:
+            with timed(timer, "store_write"):
+                self._store_for(image).save(self._store_key(image), entry)
+        return entry
+
+    def get_image_embedding(self, image, np_img=None, timer=None):
+        """获取图像嵌入，返回(嵌入, 来源)，来源为memory/disk/encoder"""
+        key = embedding_key(image, self._model_tag())
+        with timed(timer, "embedding_lookup"):
+            entry, source = self._lookup_embedding(image, key)
+        if entry is not None:
+            return entry, source
+        if np_img is None:
+            with timed(timer, "decode"):
+                np_img = load_rgb(image)
+        return self._encode_and_store(image, key, np_img, timer), "encoder"
+
+    def _crop_window(self, box, shape):
+        """小框的上下文窗口(x0, y0, x1, y1)，不适用裁剪时返回None
+
+        窗口边长取框长边的3倍(不小于crop_min_size，按256取整)，中心吸附到半个窗口的网格上，
+        相邻的框落到同一窗口时可复用已缓存的窗口嵌入；3倍边长保证吸附后窗口仍完整包含框。
+        """
+        if not self.config.crop_mode:
+            return None
+        h, w = shape[:2]
+        x1, y1, x2, y2 = [float(v) for v in box]
+        box_long = max(x2 - x1, y2 - y1, 1.0)
+        if max(h, w) <= self.predictor.model.image_encoder.img_size:
+            return None
+        if box_long > self.config.crop_max_box_ratio * max(h, w):
+            return None
+        side = max(self.config.crop_min_size, int(np.ceil(box_long * 3)))
+        side = int(np.ceil(side / 256.0)) * 256
+        if side >= h and side >= w:
+            return None
+        step = side // 2
+        cx = round((x1 + x2) / 2.0 / step) * step
+        cy = round((y1 + y2) / 2.0 / step) * step
+        wx, wy = min(side, w), min(side, h)
+        x0 = int(min(max(cx - wx // 2, 0), w - wx))
+        y0 = int(min(max(cy - wy // 2, 0), h - wy))
+        return x0, y0, x0 + wx, y0 + wy
+
+    def get_crop_embedding(self, image, np_img, window, timer=None):
+        """窗口嵌入只缓存在内存中，磁盘库仍只保存整图嵌入"""
+        key = embedding_key(image, f"{self._model_tag()}#crop{window}")
+        with timed(timer, "embedding_lookup"):
+            entry = self.embedding_cache.get(key)
+        if entry is not None:
+            return entry, "memory"
+        x0, y0, x1, y1 = window
+        with timed(timer, "crop"):
+            crop = np.ascontiguousarray(np_img[y0:y1, x0:x1])
+        entry = self._encode_image(crop, timer)
+        self.embedding_cache.put(key, entry)
+        return entry, "encoder"
+
+    @staticmethod
+    def _paste_crop(mask, window, shape):
+        x0, y0, x1, y1 = window
+        full = np.zeros(shape[:2], dtype=np.uint8)
+        full[y0:y1, x0:x1] = mask
+        return full
+
+    def _bind_predictor(self, entry):
+        """把缓存的嵌入恢复到predictor中，等价于一次set_image"""
+        predictor = self.predictor
+        predictor.reset_image()
+        predictor.features = entry.features
+        predictor.interm_features = entry.interm_features
+        predictor.original_size = entry.original_size
+        predictor.input_size = entry.input_size
+        predictor.is_image_set = True
+        return predictor
+
+    def _interactive_enter(self):
+        with self._interactive_cv:
+            self._interactive_pending += 1
+        try:
+            self._model_lock.acquire()
+        except BaseException:
+            self._interactive_release_pending()
+            raise
+
+    def _interactive_release_pending(self):
+        with self._interactive_cv:
+            self._interactive_pending -= 1
+            self._interactive_cv.notify_all()
+
+    def _interactive_exit(self):
+        self._model_lock.release()
+        self._interactive_release_pending()
+
+    @contextmanager
+    def interactive_session(self):
+        """交互式占用模型: 登记后后台预编码不再开始新的编码，当前编码结束即让出"""
+        self._interactive_enter()
+        try:
+            yield
+        finally:
+            self._interactive_exit()
+
+    def encode_to_store(self, image):
+        """确保整图嵌入已写入磁盘库，返回True表示本次新编码，False表示库中已有
+
+        供离线预编码使用：不经过内存缓存与共享解码缓存，不保留任何像素或嵌入。
+        """
+        store = self._store_for(image)
+        key = self._store_key(image)
+        if store.contains(key):
+            return False
+        np_img = decode_rgb(image)
+        with self._model_lock:
+            entry = self._encode_image(np_img)
+            self.predictor.reset_image()
+        if not store.save(key, entry):
+            raise OSError(f"写入嵌入库失败: {image}")
+        return True
+
+    def preencode(self, image, should_cancel=None):
+        """后台低优先级预编码，结果写入嵌入缓存
+
+        只在没有交互式请求等待时才占用模型，一次只编码一张图；
+        should_cancel返回True时放弃。返回是否已有可用嵌入。
+        """
+        key = embedding_key(image, self._model_tag())
+        if self._lookup_embedding(image, key)[0] is not None:
+            return True
+        np_img = load_rgb(image)
+        while True:
+            if should_cancel is not None and should_cancel():
+                return False
+            with self._interactive_cv:
+                if self._interactive_pending:
+                    self._interactive_cv.wait(timeout=0.1)
+                    continue
+                if self._model_lock.acquire(blocking=False):
+                    break
+            time.sleep(0.05)
+        try:
+            if key not in self.embedding_cache:
+                self._encode_and_store(image, key, np_img)
+        finally:
+            self._model_lock.release()
+        return True
+
+    def run_prompt_inference(self, image, box, multimask_output=None, hq_token_only=False, on_preview=None,
+                             return_timing=False, should_cancel=None, timer=None):
+        """拉框提示推理（仅金属）
+
+        on_preview(mask)在精修前被调用，提供一版快速的预览掩膜(原图尺寸, uint8)；
+        HQ嵌入未缓存且配置了预览模型时，预览来自小模型，否则为HQ解码器的未精修输出。
+        return_timing为True时额外返回分阶段计时记录，同一记录也保存在last_timing中。
+        should_cancel()在取得模型后、编码前以及每轮精修前检查，返回True时抛出RefinementCancelled。
+        timer为调用方用new_timer创建的计时器时，各阶段记入其中但不结束计时：调用方追加自己的阶段
+        (如缩放回画布)后调用finish_timing，此时return_timing返回的记录为None。
+        """
+        finish = timer is None
+        if finish:
+            timer = self.new_timer()
+        timer.meta.update(kind="prompt", box=[float(v) for v in box])
+        with timed(timer, "wait_model"):
+            self._interactive_enter()
+        try:
+            _check_cancel(should_cancel)
+            mask, pil_img = self._run_prompt_inference(image, box, multimask_output, hq_token_only, on_preview, timer,
+                                                       should_cancel)
+        finally:
+            self._interactive_exit()
+        record = self.finish_timing(timer) if finish else None
+        if return_timing:
+            return mask, pil_img, record
+        return mask, pil_img
+
+    def _preview_with_small_model(self, np_img, xyxy):
+        self.preview_predictor.set_image(np_img)
+        masks, _, _ = self.preview_predictor.predict(box=xyxy, multimask_output=False)
+        return masks[0].astype(np.uint8)
+
+    def _run_prompt_inference(self, image, box, multimask_output=None, hq_token_only=False, on_preview=None,
+                              timer=None, should_cancel=None):
         if multimask_output is None:
             multimask_output = self.config.multimask_output
-        t0 = time.time()
-        pil_img = Image.open(image).convert("RGB")
-        np_img = np.array(pil_img)
+        if not self.config.progressive_preview:
+            on_preview = None
+        with timed(timer, "decode"):
+            np_img = load_rgb(image)
         print(f"[Inference] 图像尺寸: {np_img.shape[:2]}  框: {box}")
-        predictor = SamPredictor(self.model_hq)
-        predictor.set_image(np_img)
         xyxy = np.array(box, dtype=np.float32)
-        masks, scores, logits = predictor.predict(
-            point_coords=None,
-            point_labels=None,
-            box=xyxy,
-            multimask_output=multimask_output,
-            hq_token_only=hq_token_only,
-        )
-        dt = (time.time() - t0) * 1000.0
+        window = self._crop_window(xyxy, np_img.shape)
+        if window is not None and self._lookup_embedding(image, embedding_key(image, self._model_tag()))[0] is not None:
+            # 已有整图嵌入时解码器与精修直接用它，不再为窗口额外编码
+            window = None
+        if window is not None:
+            print(f"[Inference] 裁剪窗口: {window}")
+            if timer is not None:
+                timer.meta["crop_window"] = list(window)
+            mask = self._run_crop_prompt(image, np_img, xyxy, window, multimask_output, hq_token_only,
+                                         on_preview, timer, should_cancel)
+            return mask, Image.fromarray(np_img)
+        if on_preview is not None and self.preview_predictor is not None:
+            if self._lookup_embedding(image, embedding_key(image, self._model_tag()))[0] is None:
+                with timed(timer, "preview_model"):
+                    preview_mask = self._preview_with_small_model(np_img, xyxy)
+                on_preview(preview_mask)
+                on_preview = None
+        _check_cancel(should_cancel)
+        entry, source = self.get_image_embedding(image, np_img, timer)
+        if timer is not None:
+            timer.meta["embedding_source"] = source
+        print(f"[Inference] 图像嵌入来源: {source}")
+        predictor = self._bind_predictor(entry)
+        with timed(timer, "decoder"):
+            masks, scores, logits = predictor.predict(
+                point_coords=None,
+                point_labels=None,
+                box=xyxy,
+                multimask_output=multimask_output,
+                hq_token_only=hq_token_only,
+            )
         try:
-            print(f"[Inference] 输出: masks{getattr(masks,'shape',None)}, scores{getattr(scores,'shape',None)}, logits{getattr(logits,'shape',None)}  用时{dt:.1f}ms")
+            print(f"[Inference] 输出: masks{getattr(masks,'shape',None)}, scores{getattr(scores,'shape',None)}, logits{getattr(logits,'shape',None)}")
         except Exception:
-            print(f"[Inference] 推理用时{dt:.1f}ms")
+            pass
         
         if masks.ndim == 3 and masks.shape[0] >= 1:
             mask = masks[0].astype(np.uint8)
@@ -76,6 +576,131 @@ class Inference:
             mask = np.zeros((np_img.shape[0], np_img.shape[1]), dtype=np.uint8)
         pos = int(mask.sum()) if mask.dtype != bool else int(mask.astype(np.uint8).sum())
         print(f"[Inference] 掩膜像素和: {pos}")
-        mask = sam_refiner(image, masks, self.model_hq, use_samhq=True, iters=6)[0]
+        if on_preview is not None:
+            on_preview(mask)
+        mask = sam_refiner(
+            image,
+            masks,
+            self.model_hq,
+            use_samhq=True,
+            iters=self.config.refiner_iters,
+            image_embeddings=entry.features,
+            interm_embeddings=entry.interm_features[0],
+            input_image=entry.input_image,
+            timer=timer,
+            stop_iou=self.config.refiner_stop_iou,
+            stop_score_delta=self.config.refiner_stop_score_delta,
+            work_size=self.config.refiner_work_size,
+            should_cancel=should_cancel,
+        )[0]
         
-        return mask, pil_img
+        # Image.fromarray会复制一份像素，只为保持(mask, PIL图像)的返回约定，在推理完成后才构造
+        return mask, Image.fromarray(np_img)
+
+    def _run_crop_prompt(self, image, np_img, xyxy, window, multimask_output, hq_token_only,
+                         on_preview, timer, should_cancel=None):
+        """在上下文窗口内完成解码与精修，缩放与精修开销随框大小而非图像大小变化"""
+        entry, source = self.get_crop_embedding(image, np_img, window, timer)
+        if timer is not None:
+            timer.meta["embedding_source"] = source
+        x0, y0 = window[0], window[1]
+        local_box = xyxy - np.array([x0, y0, x0, y0], dtype=np.float32)
+        predictor = self._bind_predictor(entry)
+        with timed(timer, "decoder"):
+            masks, _, _ = predictor.predict(
+                point_coords=None,
+                point_labels=None,
+                box=local_box,
+                multimask_output=multimask_output,
+                hq_token_only=hq_token_only,
+            )
+        masks = masks[:1].astype(np.uint8)
+        if on_preview is not None:
+            on_preview(self._paste_crop(masks[0], window, np_img.shape))
+        mask = sam_refiner(
+            image,
+            masks,
+            self.model_hq,
+            use_samhq=True,
+            iters=self.config.refiner_iters,
+            image_embeddings=entry.features,
+            interm_embeddings=entry.interm_features[0],
+            input_image=entry.input_image,
+            timer=timer,
+            stop_iou=self.config.refiner_stop_iou,
+            stop_score_delta=self.config.refiner_stop_score_delta,
+            work_size=self.config.refiner_work_size,
+            should_cancel=should_cancel,
+        )[0][0]
+        with timed(timer, "paste"):
+            # 与整图路径的返回形状(1, H, W)保持一致
+            mask = self._paste_crop(mask, window, np_img.shape)[None]
+        return mask
+
+    def run_prompt_inference_batch(self, image, boxes, multimask_output=None, hq_token_only=False, np_img=None,
+                                   return_timing=False, should_cancel=None, timer=None):
+        """多框批量提示推理：所有框一次送入解码器与sam_refiner
+
+        np_img为已解码的RGB数组(可选)，由调用方预取时传入以免重复解码。
+        返回(masks, scores)，masks为(N, H, W) uint8，scores为每个框精修后的IoU预测(N,)；
+        return_timing为True时额外返回分阶段计时记录；should_cancel与timer同run_prompt_inference。
+        """
+        finish = timer is None
+        if finish:
+            timer = self.new_timer()
+        timer.meta.update(kind="batch", boxes=len(boxes))
+        with timed(timer, "wait_model"):
+            self._interactive_enter()
+        try:
+            _check_cancel(should_cancel)
+            masks, scores = self._run_prompt_inference_batch(image, boxes, multimask_output, hq_token_only, np_img, timer,
+                                                             should_cancel)
+        finally:
+            self._interactive_exit()
+        record = self.finish_timing(timer) if finish else None
+        if return_timing:
+            return masks, scores, record
+        return masks, scores
+
+    def _run_prompt_inference_batch(self, image, boxes, multimask_output=None, hq_token_only=False, np_img=None,
+                                    timer=None, should_cancel=None):
+        if multimask_output is None:
+            multimask_output = self.config.multimask_output
+        entry, source = self.get_image_embedding(image, np_img, timer)
+        if timer is not None:
+            timer.meta["embedding_source"] = source
+        h, w = entry.original_size
+        if len(boxes) == 0:
+            return np.zeros((0, h, w), dtype=np.uint8), np.zeros((0,), dtype=np.float32)
+        print(f"[Inference] 批量框数: {len(boxes)}  图像嵌入来源: {source}")
+        predictor = self._bind_predictor(entry)
+        boxes_t = torch.as_tensor(np.array(boxes, dtype=np.float32), device=predictor.device)
+        boxes_t = predictor.transform.apply_boxes_torch(boxes_t, entry.original_size)
+        with torch.no_grad(), timed(timer, "decoder"):
+            masks, scores, _ = predictor.predict_torch(
+                point_coords=None,
+                point_labels=None,
+                boxes=boxes_t,
+                multimask_output=multimask_output,
+                hq_token_only=hq_token_only,
+            )
+        # 每个框取得分最高的候选作为粗掩膜 (N, H, W)
+        best = torch.argmax(scores, dim=1)
+        coarse = masks[torch.arange(len(masks), device=masks.device), best]
+        refined, ious, _ = sam_refiner(
+            image,
+            coarse.cpu().numpy(),
+            self.model_hq,
+            use_samhq=True,
+            iters=self.config.refiner_iters,
+            image_embeddings=entry.features,
+            interm_embeddings=entry.interm_features[0],
+            input_image=entry.input_image,
+            timer=timer,
+            stop_iou=self.config.refiner_stop_iou,
+            stop_score_delta=self.config.refiner_stop_score_delta,
+            work_size=self.config.refiner_work_size,
+            should_cancel=should_cancel,
+        )
+        refined_scores = ious.max(dim=1).values.float().cpu().numpy()
+        return refined, refined_scores
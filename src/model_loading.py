@@ -0,0 +1,98 @@
+import os
+import time
+import torch
+from segment_anything_hq.build_sam import sam_model_registry
+from .embedding_store import checkpoint_fingerprint
+
+# 与segment_anything_hq.build_sam中一致；Sam把它们注册为非持久buffer，不在权重文件里
+_PIXEL_MEAN = [123.675, 116.28, 103.53]
+_PIXEL_STD = [58.395, 57.12, 57.375]
+
+
+def build_sam_legacy(model_type, checkpoint, device):
+    """原有加载方式: 随机初始化完整模型，再整体torch.load并拷贝权重"""
+    model = sam_model_registry[model_type](checkpoint=None)
+    loaded = False
+    if os.path.exists(checkpoint):
+        state = torch.load(checkpoint, map_location=device, weights_only=True)
+        model.load_state_dict(state)
+        loaded = True
+    return model.to(device).eval(), loaded
+
+
+def load_state_dict_lazy(path):
+    """以mmap方式读取权重，张量在首次访问时才从磁盘换页；旧格式文件退回常规读取"""
+    try:
+        return torch.load(path, map_location="cpu", weights_only=True, mmap=True)
+    except (RuntimeError, TypeError):
+        return torch.load(path, map_location="cpu", weights_only=True)
+
+
+def converted_checkpoint_path(checkpoint, cache_dir):
+    name = os.path.splitext(os.path.basename(checkpoint))[0]
+    return os.path.join(cache_dir, f"{name}.{checkpoint_fingerprint(checkpoint)[:16]}.pt")
+
+
+def convert_checkpoint(checkpoint, converted_path):
+    """转存为可mmap的zip格式，张量连续存储且统一为fp32，之后可直接assign到模型"""
+    state = torch.load(checkpoint, map_location="cpu", weights_only=True)
+    state = {
+        k: (v.float() if v.is_floating_point() else v).contiguous()
+        for k, v in state.items()
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(converted_path)), exist_ok=True)
+    tmp_path = converted_path + ".tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, converted_path)
+    return converted_path
+
+
+def _materialize_sam_buffers(model):
+    for name, values in (("pixel_mean", _PIXEL_MEAN), ("pixel_std", _PIXEL_STD)):
+        buf = getattr(model, name, None)
+        if buf is not None and buf.is_meta:
+            model.register_buffer(name, torch.tensor(values).view(-1, 1, 1), False)
+
+
+def build_sam_fast(model_type, checkpoint, device, cache_dir=None):
+    """跳过随机初始化的加载方式
+
+    模型结构在meta设备上构建(不分配也不初始化参数)，权重以mmap读取后通过
+    load_state_dict(assign=True)直接作为参数，冷启动基本只受磁盘读取速度限制。
+    cache_dir不为空时先把权重转存为可mmap的fp32格式并复用。
+    需要torch>=2.1；权重与模型结构不完全匹配时抛出异常，由调用方退回原有方式。
+    """
+    source = checkpoint
+    if cache_dir:
+        source = converted_checkpoint_path(checkpoint, cache_dir)
+        if not os.path.exists(source):
+            convert_checkpoint(checkpoint, source)
+    state = load_state_dict_lazy(source)
+
+    with torch.device("meta"):
+        model = sam_model_registry[model_type](checkpoint=None)
+    model.load_state_dict(state, strict=True, assign=True)
+    _materialize_sam_buffers(model)
+    leftover = [n for n, t in list(model.named_parameters()) + list(model.named_buffers()) if t.is_meta]
+    if leftover:
+        raise RuntimeError(f"以下张量未被权重覆盖: {leftover[:5]}")
+    return model.float().to(device).eval()
+
+
+def time_loaders(model_type, checkpoint, device, cache_dir=None, repeat=1):
+    """分别计时原有方式、快速方式与(可选)转存缓存方式，返回{方式: [毫秒, ...]}"""
+    results = {"legacy": [], "fast": []}
+    if cache_dir:
+        results["fast+converted"] = []
+    for _ in range(repeat):
+        for name in results:
+            t0 = time.perf_counter()
+            if name == "legacy":
+                model, _ = build_sam_legacy(model_type, checkpoint, device)
+            else:
+                model = build_sam_fast(model_type, checkpoint, device, cache_dir if name == "fast+converted" else None)
+            if device.startswith("cuda"):
+                torch.cuda.synchronize()
+            results[name].append((time.perf_counter() - t0) * 1000.0)
+            del model
+    return results
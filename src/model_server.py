@@ -0,0 +1,582 @@
+"""本机模型服务：一个进程持有模型与嵌入缓存，多个标注窗口共用
+
+启动服务:
+
+    python -m src.model_server [--address /tmp/sam_model_server_<uid>/server.sock]
+
+标注窗口在启动前设置环境变量 SAM_MODEL_SERVER=<address> 即改为连接该服务，
+不再各自加载一份模型。默认地址位于只有本用户可访问(0700)的目录中；服务端每次启动
+生成随机密钥，写入与socket同名的.key文件(0600)，客户端从中读取后完成连接认证。
+
+请求与应答经Unix socket传递(只含路径、框与形状等小对象)，掩膜写入客户端
+创建的共享内存，客户端直接以numpy数组映射读取，不经过socket复制。
+服务端按客户端轮转调度：每个客户端的请求排成一队，每轮各取一个，
+一个窗口连续拉框不会饿死其他窗口；预编码请求走单独的低优先级队列。
+客户端的取消以{"op": "cancel", "id": 请求id}消息送达：排队中的请求直接应答为已取消，
+运行中的请求在编码前或下一轮精修前停止，与本地推理的should_cancel一致。
+应答带status字段("ok"/"cancelled"/"error")，客户端对已取消的请求抛出与本地推理相同的RefinementCancelled。
+"""
+import argparse
+import os
+import secrets
+import socket
+import sys
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict, deque
+from functools import partial
+from multiprocessing import AuthenticationError, resource_tracker
+from multiprocessing.connection import Client, Listener
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from .timing import StageTimer
+
+ENV_ADDRESS = "SAM_MODEL_SERVER"
+ENV_AUTHKEY = "SAM_MODEL_SERVER_AUTHKEY"
+# 走交互式队列的请求，其余(预编码)走后台队列
+_INTERACTIVE_OPS = ("prompt", "batch")
+
+
+def default_address():
+    return os.path.join(tempfile.gettempdir(), f"sam_model_server_{os.getuid()}", "server.sock")
+
+
+def key_path(address):
+    return address + ".key"
+
+
+def _private_dir(path):
+    """创建只有本用户可访问的目录；已存在时确认属于本用户并收紧权限"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if st.st_uid != os.getuid() or not os.path.isdir(path) or os.path.islink(path):
+        raise PermissionError(f"{path} 不是当前用户的目录")
+    if st.st_mode & 0o077:
+        os.chmod(path, 0o700)
+
+
+def _authkey(address):
+    """客户端的认证密钥：环境变量优先，否则读取服务端写出的密钥文件"""
+    key = os.environ.get(ENV_AUTHKEY)
+    if key:
+        return key.encode()
+    with open(key_path(address), "rb") as f:
+        return f.read()
+
+
+def _create_authkey(address):
+    """服务端每次启动生成随机密钥，经临时文件写入0600的密钥文件"""
+    key = os.environ.get(ENV_AUTHKEY)
+    if key:
+        return key.encode(), None
+    key = secrets.token_bytes(32)
+    path = key_path(address)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    os.replace(tmp_path, path)
+    return key, path
+
+
+def _cancelled():
+    """与本地推理相同的取消异常；延迟导入，客户端平时不必加载torch"""
+    from .sam_refiner import RefinementCancelled
+    return RefinementCancelled("请求已被取消")
+
+
+def _attach(name):
+    """映射对方创建的共享内存；不登记到本进程的resource_tracker，以免退出时把它删掉"""
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class FairScheduler:
+    """按客户端轮转的请求队列"""
+
+    def __init__(self):
+        self._queues = OrderedDict()
+        self._cv = threading.Condition()
+        self._closed = False
+
+    def put(self, client_id, item):
+        with self._cv:
+            self._queues.setdefault(client_id, deque()).append(item)
+            self._cv.notify()
+
+    def get(self):
+        """取下一个请求；取走后该客户端移到轮转末尾。关闭后返回None"""
+        with self._cv:
+            while not self._closed:
+                for client_id, queue in self._queues.items():
+                    if queue:
+                        item = queue.popleft()
+                        self._queues.move_to_end(client_id)
+                        return item
+                self._cv.wait()
+            return None
+
+    def close(self):
+        with self._cv:
+            self._closed = True
+            self._cv.notify_all()
+
+
+class _ClientConnection:
+    def __init__(self, conn, client_id):
+        self.conn = conn
+        self.client_id = client_id
+        self.send_lock = threading.Lock()
+        self.buffers = {}
+        self.alive = True
+        self._cancelled = set()
+        self._cancel_lock = threading.Lock()
+
+    def send(self, message):
+        with self.send_lock:
+            if self.alive:
+                self.conn.send(message)
+
+    def reply(self, request_id, status, **fields):
+        """发送请求的最终应答；status为"ok"、"cancelled"或"error"(附error说明)"""
+        try:
+            self.send(dict(fields, id=request_id, status=status))
+        except OSError:
+            self.alive = False
+
+    def cancel(self, request_id):
+        with self._cancel_lock:
+            self._cancelled.add(request_id)
+
+    def is_cancelled(self, request_id):
+        return not self.alive or request_id in self._cancelled
+
+    def finish(self, request_id):
+        """同一连接上的请求由一个客户端线程依次发出，id递增；晚到的取消消息也一并清掉"""
+        with self._cancel_lock:
+            self._cancelled = {i for i in self._cancelled if i > request_id}
+
+    def write(self, name, array):
+        """把数组写入客户端的共享内存槽，返回形状与类型描述"""
+        array = np.ascontiguousarray(array)
+        shm = self.buffers.get(name)
+        if shm is None:
+            shm = self.buffers[name] = _attach(name)
+        if array.nbytes > shm.size:
+            raise ValueError(f"结果缓冲区过小: 需要{array.nbytes}字节，实际{shm.size}")
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        view[...] = array
+        del view
+        return {"buffer": name, "shape": list(array.shape), "dtype": str(array.dtype)}
+
+    def close(self):
+        self.alive = False
+        for shm in self.buffers.values():
+            try:
+                shm.close()
+            except BufferError:
+                # 工作线程仍在写入，映射随对象回收释放
+                pass
+        self.buffers.clear()
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+
+
+class ModelServer:
+    """持有一个Inference实例，为多个客户端提供拉框推理与预编码"""
+
+    def __init__(self, address=None, engine=None, authkey=None):
+        """authkey为None时在serve_forever中生成随机密钥并写入key_path(address)"""
+        self.address = address or default_address()
+        self.authkey = authkey
+        self._key_file = None
+        self.engine = engine
+        self.interactive = FairScheduler()
+        self.background = FairScheduler()
+        self._listener = None
+        self._listener_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def serve_forever(self):
+        if self.engine is None:
+            from .inference import Inference
+            self.engine = Inference(progress_callback=lambda msg: print(f"[ModelServer] {msg}"))
+        directory = os.path.dirname(os.path.abspath(self.address))
+        if self.address == default_address():
+            _private_dir(directory)
+        else:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        if self.authkey is None:
+            self.authkey, self._key_file = _create_authkey(self.address)
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        # socket文件创建时即为0600，不留先创建后chmod的窗口
+        umask = os.umask(0o177)
+        try:
+            listener = self._listener = Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+        finally:
+            os.umask(umask)
+        for scheduler in (self.interactive, self.background):
+            threading.Thread(target=self._worker, args=(scheduler,), daemon=True).start()
+        print(f"[ModelServer] 监听 {self.address}")
+        try:
+            while not self._stopping.is_set():
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError, AuthenticationError):
+                    # 握手失败的连接不影响其他客户端；监听关闭后退出
+                    continue
+                if self._stopping.is_set():
+                    conn.close()
+                    break
+                threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """可从任意线程调用，也可重复调用；serve_forever随之返回"""
+        self._stopping.set()
+        self.interactive.close()
+        self.background.close()
+        with self._listener_lock:
+            listener, self._listener = self._listener, None
+        if listener is None:
+            return
+        # 关闭监听socket唤不醒阻塞中的accept；连上即断开，让它在握手时出错返回
+        try:
+            with socket.socket(socket.AF_UNIX) as wake:
+                wake.connect(self.address)
+        except OSError:
+            pass
+        try:
+            # Listener.close同时删除socket文件
+            listener.close()
+        except OSError:
+            pass
+        if self._key_file is not None:
+            try:
+                os.unlink(self._key_file)
+            except OSError:
+                pass
+
+    def _serve_client(self, conn):
+        try:
+            hello = conn.recv()
+        except (EOFError, OSError):
+            conn.close()
+            return
+        client = _ClientConnection(conn, hello.get("client") or uuid.uuid4().hex)
+        try:
+            # 客户端据此把multimask_output=None解析为服务端的默认值，按实际掩膜数准备结果槽
+            config = getattr(self.engine, "config", None)
+            client.send({"multimask_output": bool(getattr(config, "multimask_output", False))})
+            while True:
+                request = conn.recv()
+                if request["op"] == "cancel":
+                    client.cancel(request["id"])
+                    continue
+                scheduler = self.interactive if request["op"] in _INTERACTIVE_OPS else self.background
+                scheduler.put(client.client_id, (client, request))
+        except (EOFError, OSError):
+            pass
+        finally:
+            client.close()
+
+    def _worker(self, scheduler):
+        from .sam_refiner import RefinementCancelled
+        while True:
+            item = scheduler.get()
+            if item is None:
+                return
+            client, request = item
+            if not client.alive:
+                continue
+            request_id = request["id"]
+            try:
+                if client.is_cancelled(request_id):
+                    status, fields = "cancelled", {}
+                else:
+                    status, fields = "ok", self._handle(client, request)
+            except RefinementCancelled:
+                status, fields = "cancelled", {}
+            except Exception as e:
+                status, fields = "error", {"error": f"{type(e).__name__}: {e}"}
+            client.finish(request_id)
+            client.reply(request_id, status, **fields)
+
+    def _handle(self, client, request):
+        op = request["op"]
+        should_cancel = partial(client.is_cancelled, request["id"])
+        if op == "ping":
+            return {}
+        if op == "preencode":
+            return {"ready": self.engine.preencode(request["image"], should_cancel=should_cancel)}
+        if op == "prompt":
+            def on_preview(mask):
+                result = client.write(request["preview_buffer"], mask.astype(np.uint8))
+                client.send({"id": request["id"], "preview": result})
+
+            mask, _, timing = self.engine.run_prompt_inference(
+                request["image"],
+                request["box"],
+                multimask_output=request.get("multimask_output"),
+                hq_token_only=request.get("hq_token_only", False),
+                on_preview=on_preview if request.get("preview_buffer") else None,
+                return_timing=True,
+                should_cancel=should_cancel,
+            )
+            return {"result": client.write(request["buffer"], mask.astype(np.uint8)), "timing": timing}
+        if op == "batch":
+            masks, scores, timing = self.engine.run_prompt_inference_batch(
+                request["image"],
+                request["boxes"],
+                multimask_output=request.get("multimask_output"),
+                hq_token_only=request.get("hq_token_only", False),
+                return_timing=True,
+                should_cancel=should_cancel,
+            )
+            return {
+                "result": client.write(request["buffer"], masks.astype(np.uint8)),
+                "scores": [float(v) for v in scores],
+                "timing": timing,
+            }
+        raise ValueError(f"未知请求: {op}")
+
+
+class _ResultRing:
+    """客户端持有的一组共享内存结果槽，轮流使用
+
+    返回给调用方的掩膜直接映射槽内存，在之后又发出len(slots)次请求前保持有效；
+    需要长期保存的结果请自行复制。槽容量不够时换新槽，旧槽在不再被引用后释放。
+    """
+
+    def __init__(self, slots=4):
+        self._slots = [None] * slots
+        self._next = 0
+        self._retired = []
+        self._lock = threading.Lock()
+
+    def acquire(self, nbytes):
+        with self._lock:
+            self._reap()
+            index = self._next
+            self._next = (self._next + 1) % len(self._slots)
+            shm = self._slots[index]
+            if shm is None or shm.size < nbytes:
+                if shm is not None:
+                    shm.unlink()
+                    self._retired.append(shm)
+                shm = self._slots[index] = SharedMemory(create=True, size=max(nbytes, 1))
+            return shm
+
+    def view(self, shm, description):
+        return np.ndarray(description["shape"], dtype=description["dtype"], buffer=shm.buf)
+
+    def _reap(self):
+        alive = []
+        for shm in self._retired:
+            try:
+                shm.close()
+            except BufferError:
+                # 仍有数组引用这块内存
+                alive.append(shm)
+        self._retired = alive
+
+    def close(self):
+        with self._lock:
+            for shm in self._slots:
+                if shm is not None:
+                    shm.unlink()
+                    self._retired.append(shm)
+            self._slots = [None] * len(self._slots)
+            self._reap()
+
+
+class RemoteInference:
+    """与Inference接口一致的模型服务客户端
+
+    每个调用线程使用独立的连接，后台预编码不会阻塞同一窗口的拉框请求；
+    同一客户端的所有连接在服务端按一个客户端参与轮转调度。
+    """
+
+    def __init__(self, address=None, authkey=None, result_slots=4, cancel_poll_interval=0.02):
+        self.address = address or os.environ.get(ENV_ADDRESS) or default_address()
+        self.authkey = authkey or _authkey(self.address)
+        self.client_id = uuid.uuid4().hex
+        self.result_slots = result_slots
+        self.cancel_poll_interval = cancel_poll_interval
+        self.last_timing = None
+        self.default_multimask_output = False
+        self._local = threading.local()
+        self._channels = []
+        self._lock = threading.Lock()
+        self._request_id = 0
+        # 连接失败立即抛出，调用方(如ModelLoaderWorker)据此退回本地推理
+        self._channel()
+
+    def _channel(self):
+        channel = getattr(self._local, "channel", None)
+        if channel is None:
+            conn = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+            conn.send({"op": "hello", "client": self.client_id})
+            self.default_multimask_output = conn.recv()["multimask_output"]
+            channel = self._local.channel = (conn, _ResultRing(self.result_slots))
+            with self._lock:
+                self._channels.append(channel)
+        return channel
+
+    def _recv(self, conn, request_id, should_cancel, cancel_sent):
+        """等待下一条应答；等待期间should_cancel()变为True时向服务端发送一次取消消息"""
+        if should_cancel is not None and not cancel_sent[0]:
+            while not conn.poll(self.cancel_poll_interval):
+                if should_cancel():
+                    conn.send({"op": "cancel", "id": request_id})
+                    cancel_sent[0] = True
+                    break
+        return conn.recv()
+
+    def _call(self, op, on_preview=None, result_bytes=0, should_cancel=None, **payload):
+        conn, ring = self._channel()
+        with self._lock:
+            self._request_id += 1
+            request_id = self._request_id
+        request = dict(payload, op=op, id=request_id)
+        buffers = {}
+        if result_bytes:
+            buffers["buffer"] = ring.acquire(result_bytes)
+            request["buffer"] = buffers["buffer"].name
+            if on_preview is not None:
+                buffers["preview_buffer"] = ring.acquire(result_bytes)
+                request["preview_buffer"] = buffers["preview_buffer"].name
+        conn.send(request)
+        cancel_sent = [False]
+        while True:
+            reply = self._recv(conn, request_id, should_cancel, cancel_sent)
+            if "preview" in reply:
+                if not cancel_sent[0]:
+                    on_preview(ring.view(buffers["preview_buffer"], reply["preview"]))
+                continue
+            break
+        if reply["status"] == "cancelled":
+            raise _cancelled()
+        if reply["status"] != "ok":
+            raise RuntimeError(f"模型服务推理失败: {reply['error']}")
+        if "timing" in reply:
+            self.last_timing = reply["timing"]
+        if "result" in reply:
+            reply["array"] = ring.view(buffers["buffer"], reply["result"])
+        return reply
+
+    def new_timer(self, **meta):
+        return StageTimer(**meta)
+
+    def finish_timing(self, timer):
+        """结束调用方持有的计时器，服务端各阶段已在应答时并入其中"""
+        record = timer.as_dict()
+        self.last_timing = record
+        print(f"[RemoteInference] {timer.summary_line()}")
+        return record
+
+    @staticmethod
+    def _merge_timing(timer, reply):
+        timing = reply.get("timing")
+        if timer is not None and timing:
+            timer.meta.update(timing["meta"])
+            timer.stages.extend(timing["stages"])
+
+    def run_prompt_inference(self, image, box, multimask_output=None, hq_token_only=False, on_preview=None,
+                             return_timing=False, should_cancel=None, timer=None):
+        """should_cancel在等待应答期间轮询，取消经连接转发给服务端；timer同Inference.run_prompt_inference"""
+        if should_cancel is not None and should_cancel():
+            raise _cancelled()
+        from PIL import Image
+        from .image_cache import load_rgb
+        if multimask_output is None:
+            multimask_output = self.default_multimask_output
+        # 解码结果与画布共享，通常已在缓存中；用于确定结果槽大小并返回pil_img
+        np_img = load_rgb(image)
+        h, w = np_img.shape[:2]
+        reply = self._call(
+            "prompt",
+            on_preview=on_preview,
+            result_bytes=(3 if multimask_output else 1) * h * w,
+            should_cancel=should_cancel,
+            image=os.path.abspath(image),
+            box=[float(v) for v in box],
+            multimask_output=multimask_output,
+            hq_token_only=hq_token_only,
+        )
+        self._merge_timing(timer, reply)
+        pil_img = Image.fromarray(np_img)
+        if return_timing:
+            return reply["array"], pil_img, None if timer is not None else reply.get("timing")
+        return reply["array"], pil_img
+
+    def run_prompt_inference_batch(self, image, boxes, multimask_output=None, hq_token_only=False, np_img=None,
+                                   return_timing=False, should_cancel=None, timer=None):
+        """np_img只用于确定结果大小，服务端自行读取图像"""
+        if should_cancel is not None and should_cancel():
+            raise _cancelled()
+        if np_img is None:
+            from .image_cache import load_rgb
+            np_img = load_rgb(image)
+        h, w = np_img.shape[:2]
+        reply = self._call(
+            "batch",
+            result_bytes=max(len(boxes), 1) * h * w,
+            should_cancel=should_cancel,
+            image=os.path.abspath(image),
+            boxes=[[float(v) for v in box] for box in boxes],
+            multimask_output=multimask_output,
+            hq_token_only=hq_token_only,
+        )
+        self._merge_timing(timer, reply)
+        scores = np.array(reply["scores"], dtype=np.float32)
+        if return_timing:
+            return reply["array"], scores, None if timer is not None else reply.get("timing")
+        return reply["array"], scores
+
+    def preencode(self, image, should_cancel=None):
+        if should_cancel is not None and should_cancel():
+            return False
+        try:
+            return self._call("preencode", should_cancel=should_cancel, image=os.path.abspath(image))["ready"]
+        except Exception:
+            # 预编码被取消(RefinementCancelled)时与本地推理一样返回False
+            if should_cancel is not None and should_cancel():
+                return False
+            raise
+
+    def close(self):
+        """关闭所有线程的连接并释放共享内存结果槽；之后不应再发出请求"""
+        with self._lock:
+            channels, self._channels = self._channels, []
+        for conn, ring in channels:
+            try:
+                conn.close()
+            except OSError:
+                pass
+            ring.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本机模型服务，供多个标注窗口共用一份模型")
+    parser.add_argument("--address", default=None, help=f"Unix socket路径，默认{default_address()}")
+    args = parser.parse_args(argv)
+    server = ModelServer(args.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+"""ONNX Runtime后端: HQ图像编码器与拉框解码器在ONNX Runtime的CPU执行器上运行
+
+模型首次使用时导出为ONNX并缓存在cache_dir，文件名带权重指纹，换权重后自动重新导出。
+解码器按(multimask_output, hq_token_only)各导出一个图，只支持框提示；
+点提示与掩膜提示(sam_refiner的精修轮次)仍走PyTorch。
+"""
+import inspect
+import os
+import numpy as np
+import torch
+from segment_anything_hq import SamPredictor
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+OPSET_VERSION = 17
+
+
+class _EncoderWrapper(torch.nn.Module):
+    def __init__(self, image_encoder):
+        super().__init__()
+        self.image_encoder = image_encoder
+
+    def forward(self, image):
+        features, interm_embeddings = self.image_encoder(image)
+        # 解码器只用到第一层的中间特征
+        return features, interm_embeddings[0]
+
+
+class _BoxDecoderWrapper(torch.nn.Module):
+    """框提示编码 + HQ掩膜解码，与SamPredictor.predict_torch的框提示路径一致"""
+
+    def __init__(self, sam, multimask_output, hq_token_only):
+        super().__init__()
+        self.prompt_encoder = sam.prompt_encoder
+        self.mask_decoder = sam.mask_decoder
+        self.multimask_output = multimask_output
+        self.hq_token_only = hq_token_only
+
+    def forward(self, image_embeddings, interm_embeddings, boxes):
+        sparse_embeddings, dense_embeddings = self.prompt_encoder(points=None, boxes=boxes, masks=None)
+        return self.mask_decoder(
+            image_embeddings=image_embeddings,
+            image_pe=self.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            multimask_output=self.multimask_output,
+            hq_token_only=self.hq_token_only,
+            interm_embeddings=[interm_embeddings],
+        )
+
+
+def _export(module, args, path, input_names, output_names, dynamic_axes=None):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp"
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # 新版PyTorch默认的dynamo导出器需要onnxscript且不认dynamic_axes，固定用TorchScript导出器
+        kwargs["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(
+            module,
+            args,
+            tmp_path,
+            opset_version=OPSET_VERSION,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            do_constant_folding=True,
+            **kwargs,
+        )
+    os.replace(tmp_path, path)
+    return path
+
+
+class OnnxSamBackend:
+    """持有编码器与各解码器变体的ONNX Runtime会话，输入输出均为torch张量"""
+
+    def __init__(self, sam, model_type, checkpoint_hash, cache_dir, threads=None):
+        if ort is None:
+            raise ImportError("ONNX后端需要安装onnxruntime")
+        self.sam = sam
+        self.cache_dir = cache_dir
+        self.prefix = os.path.join(cache_dir, f"{model_type}.{checkpoint_hash[:16]}")
+        self.threads = threads
+        self.encoder = self._session(self._encoder_path())
+        self._decoders = {}
+
+    def _session(self, path):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.threads:
+            options.intra_op_num_threads = self.threads
+        return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def _encoder_path(self):
+        path = f"{self.prefix}.encoder.onnx"
+        if not os.path.exists(path):
+            print(f"[ONNX] 正在导出图像编码器到 {path}...")
+            size = self.sam.image_encoder.img_size
+            dummy = torch.zeros(1, 3, size, size, dtype=torch.float32)
+            _export(_EncoderWrapper(self.sam.image_encoder).eval(), (dummy,), path,
+                    ["image"], ["features", "interm"])
+        return path
+
+    def _decoder_path(self, multimask_output, hq_token_only):
+        path = f"{self.prefix}.decoder_mm{int(multimask_output)}_hq{int(hq_token_only)}.onnx"
+        if not os.path.exists(path):
+            print(f"[ONNX] 正在导出解码器到 {path}...")
+            size = self.sam.image_encoder.img_size
+            with torch.no_grad():
+                features, interm = _EncoderWrapper(self.sam.image_encoder)(
+                    torch.zeros(1, 3, size, size, dtype=torch.float32))
+            boxes = torch.tensor([[0.0, 0.0, size / 2.0, size / 2.0], [size / 4.0, size / 4.0, size, size]])
+            _export(
+                _BoxDecoderWrapper(self.sam, multimask_output, hq_token_only).eval(),
+                (features, interm, boxes),
+                path,
+                ["image_embeddings", "interm_embeddings", "boxes"],
+                ["low_res_masks", "iou_predictions"],
+                dynamic_axes={"boxes": {0: "n"}, "low_res_masks": {0: "n"}, "iou_predictions": {0: "n"}},
+            )
+        return path
+
+    def decoder(self, multimask_output, hq_token_only):
+        key = (bool(multimask_output), bool(hq_token_only))
+        session = self._decoders.get(key)
+        if session is None:
+            session = self._decoders[key] = self._session(self._decoder_path(*key))
+        return session
+
+    def encode(self, input_image):
+        """input_image为预处理(归一化、补边)后的(1, 3, S, S)张量，返回(features, interm)"""
+        device = input_image.device
+        features, interm = self.encoder.run(None, {"image": input_image.float().cpu().numpy()})
+        return torch.from_numpy(features).to(device), torch.from_numpy(interm).to(device)
+
+    def decode(self, features, interm, boxes, multimask_output, hq_token_only):
+        """boxes为缩放到编码器输入坐标的(N, 4)张量，返回(low_res_masks, iou_predictions)"""
+        device = features.device
+        low_res_masks, iou_predictions = self.decoder(multimask_output, hq_token_only).run(None, {
+            "image_embeddings": features.float().cpu().numpy(),
+            "interm_embeddings": interm.float().cpu().numpy(),
+            "boxes": np.ascontiguousarray(boxes.float().cpu().numpy()),
+        })
+        return torch.from_numpy(low_res_masks).to(device), torch.from_numpy(iou_predictions).to(device)
+
+
+class OnnxSamPredictor(SamPredictor):
+    """SamPredictor的编码与框提示解码改由OnnxSamBackend执行，其余行为不变"""
+
+    def __init__(self, sam_model, backend):
+        super().__init__(sam_model)
+        self.backend = backend
+
+    @torch.no_grad()
+    def set_torch_image(self, transformed_image, original_image_size):
+        self.reset_image()
+        self.original_size = original_image_size
+        self.input_size = tuple(transformed_image.shape[-2:])
+        input_image = self.model.preprocess(transformed_image)
+        features, interm = self.backend.encode(input_image)
+        self.features = features
+        self.interm_features = [interm]
+        self.is_image_set = True
+
+    @torch.no_grad()
+    def predict_torch(self, point_coords, point_labels, boxes=None, mask_input=None, multimask_output=True,
+                      return_logits=False, hq_token_only=False):
+        if point_coords is not None or mask_input is not None or boxes is None:
+            return super().predict_torch(point_coords, point_labels, boxes, mask_input, multimask_output,
+                                         return_logits, hq_token_only)
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+        low_res_masks, iou_predictions = self.backend.decode(
+            self.features, self.interm_features[0], boxes, multimask_output, hq_token_only)
+        masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+        if not return_logits:
+            masks = masks > self.model.mask_threshold
+        return masks, iou_predictions, low_res_masks
@@ -0,0 +1,109 @@
+"""多进程离线预编码：为整个目录树预先计算图像嵌入并写入磁盘嵌入库
+
+    python -m src.preencode data/ --processes 4
+
+每个进程各自加载一份模型并使用独立的线程预算，文件列表按进程动态分发。
+结果与界面使用同一嵌入库格式(默认在图像所在目录的.sam_embeddings下)，
+库中已有的图像会被跳过，因此可以随时中断后增量重跑。
+注意嵌入按模型类型、权重与CPU配置区分，需与标注时的Config一致才会被命中。
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+_engine = None
+
+
+def find_images(root):
+    """递归列出目录下的图像，跳过嵌入库目录"""
+    from .embedding_store import STORE_DIRNAME
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d != STORE_DIRNAME)
+        for name in sorted(filenames):
+            if name.lower().endswith(IMAGE_EXTS):
+                paths.append(os.path.join(dirpath, name))
+    return paths
+
+
+def _init_worker(overrides):
+    global _engine
+    from .inference import Config, Inference
+    config = Config()
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    _engine = Inference(config=config)
+
+
+def _encode_one(path):
+    t0 = time.perf_counter()
+    try:
+        encoded = _engine.encode_to_store(path)
+    except Exception as e:
+        return path, "failed", f"{type(e).__name__}: {e}"
+    return path, "encoded" if encoded else "skipped", (time.perf_counter() - t0) * 1000.0
+
+
+def default_processes():
+    from .cpu_profile import physical_core_count
+    # ViT-L每个进程约占1.5GB内存，单进程4线程左右时整机吞吐最高
+    return max(1, physical_core_count() // 4)
+
+
+def preencode_paths(paths, processes=None, threads=None, overrides=None, report_every=10):
+    """多进程预编码，返回(新编码数, 跳过数, 失败数)"""
+    from .cpu_profile import physical_core_count
+    processes = processes or default_processes()
+    threads = threads or max(1, physical_core_count() // processes)
+    overrides = dict(overrides or {})
+    overrides.update(cpu_threads=threads, warmup=False, embedding_cache_bytes=0)
+    print(f"[preencode] {len(paths)} 张图像，{processes} 个进程 × {threads} 线程")
+
+    counts = {"encoded": 0, "skipped": 0, "failed": 0}
+    t0 = time.time()
+    # spawn: 每个子进程干净地初始化torch线程池，不继承父进程状态
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(processes, initializer=_init_worker, initargs=(overrides,)) as pool:
+        for done, (path, status, detail) in enumerate(pool.imap_unordered(_encode_one, paths), 1):
+            counts[status] += 1
+            if status == "failed":
+                print(f"[preencode] 失败 {path}: {detail}")
+            if done % report_every == 0 or done == len(paths):
+                dt = time.time() - t0
+                print(f"[preencode] {done}/{len(paths)}  新编码 {counts['encoded']}  跳过 {counts['skipped']}  "
+                      f"失败 {counts['failed']}  {counts['encoded'] / dt:.2f} 张/秒")
+    dt = time.time() - t0
+    print(f"[preencode] 完成，用时{dt:.1f}s，编码吞吐 {counts['encoded'] / dt if dt else 0.0:.2f} 张/秒")
+    return counts["encoded"], counts["skipped"], counts["failed"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="多进程预编码目录树中所有图像的SAM嵌入")
+    parser.add_argument("roots", nargs="+", help="图像目录")
+    parser.add_argument("--processes", type=int, default=None, help="进程数，默认物理核数/4")
+    parser.add_argument("--threads", type=int, default=None, help="每个进程的线程数，默认均分物理核")
+    parser.add_argument("--store-dir", default=None, help="嵌入库目录，默认放在各图像所在目录下")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--cpu-profile", default="fp32", help="须与标注时的配置一致")
+    args = parser.parse_args(argv)
+
+    paths = [p for root in args.roots for p in find_images(root)]
+    if not paths:
+        print("[preencode] 未找到图像")
+        return 0
+    overrides = {
+        "device": args.device,
+        "cpu_profile": args.cpu_profile,
+        "embedding_store_dir": args.store_dir,
+        "use_embedding_store": True,
+    }
+    _, _, failed = preencode_paths(paths, args.processes, args.threads, overrides)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+import numpy as np
+from PyQt5.QtGui import QImage, QImageReader
+from .image_cache import load_rgb
+
+def qimage_to_numpy(image):
+    if image.isNull():
+        return None
+        
+    width = image.width()
+    height = image.height()
+    
+    if image.format() == QImage.Format_ARGB32 or image.format() == QImage.Format_ARGB32_Premultiplied:
+        ptr = image.constBits()
+        if ptr is None:
+            return None
+            
+        ptr.setsize(image.byteCount())
+        arr = np.array(ptr).reshape(height, width, 4)
+        return arr
+    
+    elif image.format() == QImage.Format_RGB32:
+        ptr = image.constBits()
+        if ptr is None:
+            return None
+            
+        ptr.setsize(image.byteCount())
+        arr = np.array(ptr).reshape(height, width, 4)
+        return arr
+    
+    elif image.format() == QImage.Format_RGB888:
+        ptr = image.constBits()
+        if ptr is None:
+            return None
+            
+        ptr.setsize(image.byteCount())
+        arr = np.array(ptr).reshape(height, width, 3)
+        return arr
+    
+    return None
+
+def numpy_to_qimage(array, format=QImage.Format_ARGB32):
+    if array is None:
+        return QImage()
+        
+    height, width = array.shape[:2]
+    
+    if len(array.shape) == 3:
+        if array.shape[2] == 4:
+            bytes_per_line = 4 * width
+            img = QImage(array.data, width, height, bytes_per_line, format)
+            return img
+        elif array.shape[2] == 3:
+            bytes_per_line = 3 * width
+            img = QImage(array.data, width, height, bytes_per_line, QImage.Format_RGB888)
+            return img
+    
+    elif len(array.shape) == 2:
+        bytes_per_line = width
+        img = QImage(array.data, width, height, bytes_per_line, QImage.Format_Grayscale8)
+        return img
+    
+    return QImage()
+
+def mask_has_content(mask_image):
+    try:
+        array = qimage_to_numpy(mask_image)
+        if array is None:
+            return False
+            
+        if array.shape[2] >= 4:
+            return np.any(array[:, :, 3] > 0)
+        return False
+    except Exception:
+        return False
+
+def numpy_mask_to_qimage(mask_array, color=None):
+    """将numpy掩码数组转换为QImage"""
+    if mask_array is None:
+        return QImage()
+    
+    try:
+        # 确保掩码是二值的
+        if mask_array.dtype != np.uint8:
+            mask_array = (mask_array * 255).astype(np.uint8)
+        
+        height, width = mask_array.shape[:2]
+        
+        # 创建ARGB32格式的图像
+        result = np.zeros((height, width, 4), dtype=np.uint8)
+        
+        # 设置默认颜色（红色）
+        if color is None:
+            color = [255, 0, 0, 128]  # 红色，半透明
+        
+        # 在掩码为真的地方设置颜色
+        mask_bool = mask_array > 128
+        result[mask_bool] = color
+        
+        # 转换为QImage
+        bytes_per_line = 4 * width
+        qimg = QImage(result.data, width, height, bytes_per_line, QImage.Format_ARGB32)
+        return qimg.copy()  # 创建副本以避免内存问题
+        
+    except Exception:
+        return QImage()
+
+def rgb_array_to_qimage(array):
+    """把HxWx3 uint8 RGB数组零拷贝地包装为QImage
+
+    QImage不持有外部缓冲区，因此把数组挂在返回的QImage对象上保证其存活。
+    """
+    height, width = array.shape[:2]
+    img = QImage(array.data, width, height, array.strides[0], QImage.Format_RGB888)
+    img._buffer = array
+    return img
+
+def load_qimage(path):
+    """从共享解码缓存取像素并包装为QImage，PIL无法解码的格式退回QImageReader"""
+    try:
+        return rgb_array_to_qimage(load_rgb(path))
+    except Exception:
+        reader = QImageReader(path)
+        reader.setAutoTransform(True)
+        return reader.read()
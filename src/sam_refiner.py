@@ -1,11 +1,13 @@
 import numpy as np
 import torch
 import os
+from torch.nn import functional as F
 from collections import defaultdict
-import cv2
 from tqdm import tqdm
 from segment_anything.utils.transforms import ResizeLongestSide
 from .utils import prepare_image, extract_bboxes_expand, extract_points, extract_mask
+from .image_cache import load_rgb
+from .timing import timed
 
 
 def sam_input_prepare(image, pred_masks, image_embeddings=None, resize_transform=None, use_point=True, use_box=True, use_mask=True, add_neg=True, margin=0.0, gamma=1.0, strength=15):
@@ -32,7 +34,68 @@ def sam_input_prepare(image, pred_masks, image_embeddings=None, resize_transform
         input_dict['mask_inputs'] = extract_mask(pred_masks, gaus_dt, target_size, is01=True, strength=strength, device=image.device, expand_list=expand_list)
    
     return input_dict,point_coords
-    
+
+
+class RefinementCancelled(Exception):
+    """Raised by sam_refiner when should_cancel() returns True between iterations"""
+
+
+def _consecutive_iou(prev_masks, masks):
+    """IoU between the (n, h, w) bool masks of two consecutive iterations; empty pairs count as 1"""
+    prev_masks = prev_masks.flatten(1)
+    masks = masks.flatten(1)
+    inter = (prev_masks & masks).sum(dim=1).float()
+    union = (prev_masks | masks).sum(dim=1).float()
+    return torch.where(union > 0, inter / union.clamp(min=1), torch.ones_like(union))
+
+
+def _converged(prev_masks, masks, prev_scores, scores, stop_iou, stop_score_delta):
+    if stop_iou is not None and bool((_consecutive_iou(prev_masks, masks) >= stop_iou).all()):
+        return True
+    if stop_score_delta is not None and bool(((scores - prev_scores).abs() <= stop_score_delta).all()):
+        return True
+    return False
+
+
+def _downsample_masks(masks, ori_size, work_size, timer=None):
+    """Area-downsample (n, h, w) masks so that their long side is work_size; returns (masks, work_shape),
+    work_shape is None when no resizing is needed"""
+    if work_size is None or max(ori_size) <= work_size:
+        return masks, None
+    work_shape = ResizeLongestSide.get_preprocess_shape(ori_size[0], ori_size[1], work_size)
+    with timed(timer, "downsample"):
+        masks = F.interpolate(masks[:, None].float(), size=work_shape, mode="area")[:, 0]
+        masks = (masks >= 0.5).to(torch.uint8)
+    return masks, work_shape
+
+
+def _select_best(sam_output):
+    """Per mask, the candidate with the highest iou_prediction: (masks, low_res_logits)"""
+    best = torch.argmax(sam_output['iou_predictions'], dim=1)
+    idx = torch.arange(len(best), device=best.device)
+    return sam_output['masks'][idx, best], sam_output['low_res_logits'][idx, best]
+
+
+@torch.no_grad()
+def _upsample_logits(model, logits, input_size, ori_size):
+    # the selected low-res logits are in the encoder input frame, independent of the working size
+    logits = model.postprocess_masks(logits[:, None], input_size, ori_size)
+    return logits[:, 0] > model.mask_threshold
+
+
+@torch.no_grad()
+def encode_images(sam, input_images, use_samhq=False):
+    """Run the image encoder once on a list of resized (3, h, w) uint8 images.
+
+    Returns (image_embeddings (B, 256, 64, 64), interm_embeddings); interm_embeddings is the early-layer
+    HQ feature batch when use_samhq, otherwise None.
+    """
+    input_images = torch.stack([sam.preprocess(x.to(sam.device)) for x in input_images], dim=0)
+    if not use_samhq:
+        return sam.image_encoder(input_images), None
+    image_embeddings, interm_embeddings = sam.image_encoder(input_images)
+    return image_embeddings, interm_embeddings[0]  # early layer
+
 
 def sam_refiner(image_path, 
                 coarse_masks,
@@ -48,7 +111,15 @@ def sam_refiner(image_path,
                 strength=30,
                 use_samhq=False,
                 ddp=False,
-                is_train=False):
+                is_train=False,
+                image_embeddings=None,
+                interm_embeddings=None,
+                input_image=None,
+                timer=None,
+                stop_iou=None,
+                stop_score_delta=None,
+                should_cancel=None,
+                work_size=None):
     """
     SAMRefiner refines coarse masks from an image by generating noise-tolerant prompts for SAM.
 
@@ -66,6 +137,22 @@ def sam_refiner(image_path,
       gamma (float): The parameter used to control the span of Gaussian distribution in mask prompt. Default: 4.0
       strength (float): The parameter used to control the amplitude of Gaussian distribution in mask prompt. Default: 30
       use_samhq (bool): Whether to use samhq model. Default: False
+      image_embeddings (tensor): Precomputed image embeddings (1, 256, 64, 64). When given together with
+        input_image, image_path is not read and the image encoder is skipped. Default: None
+      interm_embeddings (tensor): Precomputed early-layer HQ embeddings, required with use_samhq. Default: None
+      input_image (tensor): The resized (3, h, w) uint8 image that produced image_embeddings. Default: None
+      timer (StageTimer): Optional per-stage timer; each iteration records refiner_prompt and
+        refiner_decoder stages, and timer.meta['refiner_iters'] is set to the iterations actually run. Default: None
+      stop_iou (float): Stop early once every mask's IoU with the previous iteration reaches this value,
+        e.g. 0.99. Default: None (always run iters)
+      stop_score_delta (float): Stop early once every selected iou_prediction changes by at most this much
+        between consecutive iterations. Default: None (always run iters)
+      should_cancel (callable): Checked before each iteration; when it returns True,
+        RefinementCancelled is raised. Default: None
+      work_size (int): Run the iterative loop with masks resized so that their long side is work_size
+        (e.g. the encoder's 1024) instead of the original resolution; only the final low-res logits are
+        upsampled to the original size. Ignored for smaller images and when is_train. The returned
+        sam_masks3 are then at the working resolution. Default: None (full resolution)
     """
     
     if isinstance(coarse_masks, list):
@@ -74,58 +161,69 @@ def sam_refiner(image_path,
     if len(coarse_masks.shape) == 2:
         coarse_masks = coarse_masks[None: ,]
     coarse_masks = torch.tensor(coarse_masks, dtype=torch.uint8).to(sam.device)
+    ori_size = tuple(coarse_masks.shape[-2:])
         
     assert len(coarse_masks.shape) == 3, "coarse mask dim must be (n, h, w), but got {}".format(coarse_masks.shape)
 
     if resize_transform is None:
         resize_transform = ResizeLongestSide(sam.image_encoder.img_size)
     
-    # image = cv2.imread(image_path)
-    # image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    data = np.fromfile(image_path, dtype=np.uint8)
-    image = cv2.imdecode(data, cv2.IMREAD_COLOR)
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    ori_size = image.shape[:2]
-    image = [prepare_image(image, resize_transform, sam.device)]
+    if image_embeddings is not None and input_image is not None:
+        # reuse the encoder pass already done by the caller (e.g. SamPredictor.set_image)
+        if use_samhq and interm_embeddings is None:
+            raise ValueError("interm_embeddings must be provided together with image_embeddings when use_samhq=True")
+        image = [input_image.to(sam.device)]
+    else:
+        # decoded pixels are shared with the canvas and Inference, EXIF orientation applied
+        image = load_rgb(image_path)
+        image = [prepare_image(image, resize_transform, sam.device)]
     
-    with torch.no_grad():
-        if ddp:
-            input_images = torch.stack([sam.module.preprocess(x) for x in image], dim=0)
-            if not use_samhq:
-                image_embeddings = sam.module.image_encoder(input_images) # torch.Size([1, 256, 64, 64])
-            else:
-                image_embeddings, interm_embeddings = sam.module.image_encoder(input_images)
-                interm_embeddings = interm_embeddings[0] # early layer
-        else:
-            input_images = torch.stack([sam.preprocess(x) for x in image], dim=0)
-            if not use_samhq:
-                image_embeddings = sam.image_encoder(input_images) # torch.Size([1, 256, 64, 64])
+        with torch.no_grad():
+            if ddp:
+                input_images = torch.stack([sam.module.preprocess(x) for x in image], dim=0)
+                if not use_samhq:
+                    image_embeddings = sam.module.image_encoder(input_images) # torch.Size([1, 256, 64, 64])
+                else:
+                    image_embeddings, interm_embeddings = sam.module.image_encoder(input_images)
+                    interm_embeddings = interm_embeddings[0] # early layer
             else:
-                image_embeddings, interm_embeddings = sam.image_encoder(input_images)
-                interm_embeddings = interm_embeddings[0] # early layer
+                input_images = torch.stack([sam.preprocess(x) for x in image], dim=0)
+                if not use_samhq:
+                    image_embeddings = sam.image_encoder(input_images) # torch.Size([1, 256, 64, 64])
+                else:
+                    image_embeddings, interm_embeddings = sam.image_encoder(input_images)
+                    interm_embeddings = interm_embeddings[0] # early layer
         
+    work_shape = None
+    pred_mask_list = coarse_masks
+    if not is_train:
+        pred_mask_list, work_shape = _downsample_masks(coarse_masks, ori_size, work_size, timer)
+
+    prev_masks = prev_scores = None
+    iters_run = 0
     for i in range(iters):
-        if i == 0:
-            pred_mask_list = coarse_masks
-        else:
+        if should_cancel is not None and should_cancel():
+            raise RefinementCancelled(f"cancelled before iteration {i}")
+        if i > 0:
             pred_mask_list = sam_masks_list.to(torch.uint8)
         
-        input_dict, point_coords = sam_input_prepare(image[0],
-                                                     pred_mask_list,
-                                                     image_embeddings,
-                                                     resize_transform,
-                                                     use_point=use_point,
-                                                     use_box=use_box,
-                                                     use_mask=use_mask,
-                                                     add_neg=add_neg,
-                                                     margin=margin,
-                                                     gamma=gamma,
-                                                     strength=strength)
+        with timed(timer, "refiner_prompt", iter=i):
+            input_dict, point_coords = sam_input_prepare(image[0],
+                                                         pred_mask_list,
+                                                         image_embeddings,
+                                                         resize_transform,
+                                                         use_point=use_point,
+                                                         use_box=use_box,
+                                                         use_mask=use_mask,
+                                                         add_neg=add_neg,
+                                                         margin=margin,
+                                                         gamma=gamma,
+                                                         strength=strength)
         
         sam_input = [input_dict]
         
         if not is_train:
-            with torch.no_grad():
+            with torch.no_grad(), timed(timer, "refiner_decoder", iter=i):
                 if ddp:
                     if not use_samhq:
                         sam_output = sam.module.forward_with_image_embeddings(image_embeddings, sam_input, multimask_output=True)[0] #dict_keys(['masks', 'iou_predictions', 'low_res_logits'])
@@ -149,20 +247,129 @@ def sam_refiner(image_path,
 
         if is_train:
             return sam_masks, sam_ious, sam_masks3
-        sam_masks_list = []
-        sam_masks_logits_list = []
-        cnt = 0
-        for sm, si in zip(sam_masks, sam_ious):
-            max_idx = torch.argmax(si)
-            sam_masks_list.append(sm[max_idx])
-            sam_masks_logits_list.append(sam_masks_logits[cnt][max_idx])
-            cnt += 1
-
-        sam_masks = torch.stack(sam_masks_list, dim=0)
-        sam_masks_logits = torch.stack(sam_masks_logits_list, dim=0)
+        sam_masks, sam_masks_logits = _select_best(sam_output)
 
         sam_masks_list = sam_masks > 0
+        iters_run = i + 1
+
+        if stop_iou is None and stop_score_delta is None:
+            continue
+        selected_scores = sam_ious.max(dim=1).values
+        if prev_masks is not None and _converged(prev_masks, sam_masks_list, prev_scores, selected_scores,
+                                                 stop_iou, stop_score_delta):
+            break
+        prev_masks, prev_scores = sam_masks_list, selected_scores
         
-    refined_masks = sam_masks_list.cpu().numpy().astype(np.uint8)
+    if timer is not None:
+        timer.meta["refiner_iters"] = iters_run
+    if work_shape is not None:
+        with timed(timer, "upsample"):
+            model = sam.module if ddp else sam
+            sam_masks_list = _upsample_logits(model, sam_masks_logits, tuple(image[0].shape[-2:]), ori_size)
+    with timed(timer, "postprocess"):
+        refined_masks = sam_masks_list.cpu().numpy().astype(np.uint8)
     assert len(refined_masks) == len(coarse_masks)
-    return refined_masks, sam_ious, sam_masks3
\ No newline at end of file
+    return refined_masks, sam_ious, sam_masks3
+
+
+def sam_refiner_batch(image_paths,
+                      coarse_masks,
+                      sam,
+                      resize_transform=None,
+                      use_point=True,
+                      use_box=True,
+                      use_mask=True,
+                      add_neg=True,
+                      iters=5,
+                      margin=0.0,
+                      gamma=4.0,
+                      strength=30,
+                      use_samhq=False,
+                      image_embeddings=None,
+                      interm_embeddings=None,
+                      input_images=None,
+                      timer=None,
+                      stop_iou=None,
+                      stop_score_delta=None,
+                      work_size=None):
+    """
+    Batched sam_refiner over several images: the images go through the image encoder in one forward pass
+    and every refinement iteration decodes the masks of all images in one forward_with_image_embeddings call.
+
+    Arguments:
+      image_paths (list(str)): The target images; not read when image_embeddings and input_images are given.
+      coarse_masks (list): Per image, the coarse masks (n_i, h_i, w_i) to be refined; n_i may be 0.
+      image_embeddings (tensor): Precomputed (B, 256, 64, 64) image embeddings. Default: None
+      interm_embeddings (tensor): Precomputed early-layer HQ embeddings of the batch, required with use_samhq.
+      input_images (list(tensor)): The resized (3, h, w) uint8 images that produced image_embeddings. Default: None
+      stop_iou, stop_score_delta: As in sam_refiner but checked per image; a converged image leaves the
+        batch while the others keep iterating.
+      The remaining arguments are as in sam_refiner (inference only, no ddp / is_train).
+
+    Returns: per image, (refined_masks (n_i, h_i, w_i) uint8 array, iou_predictions of the last iteration).
+    """
+    if resize_transform is None:
+        resize_transform = ResizeLongestSide(sam.image_encoder.img_size)
+    masks = []
+    for m in coarse_masks:
+        m = torch.as_tensor(np.asarray(m), dtype=torch.uint8).to(sam.device)
+        masks.append(m[None] if m.dim() == 2 else m)
+    ori_sizes = [tuple(m.shape[-2:]) for m in masks]
+
+    if image_embeddings is None or input_images is None:
+        input_images = [prepare_image(load_rgb(p), resize_transform, sam.device) for p in image_paths]
+        with timed(timer, "encoder", images=len(input_images)):
+            image_embeddings, interm_embeddings = encode_images(sam, input_images, use_samhq)
+    elif use_samhq and interm_embeddings is None:
+        raise ValueError("interm_embeddings must be provided together with image_embeddings when use_samhq=True")
+    input_images = [x.to(sam.device) for x in input_images]
+    assert len(masks) == len(input_images) == len(image_embeddings), "one mask set per image is required"
+
+    current, work_shapes, ious, logits, prev = {}, {}, {}, {}, {}
+    for b, m in enumerate(masks):
+        if len(m):
+            current[b], work_shapes[b] = _downsample_masks(m, ori_sizes[b], work_size, timer)
+    active = sorted(current)
+    iters_run = 0
+    for i in range(iters):
+        if not active:
+            break
+        with timed(timer, "refiner_prompt", iter=i, images=len(active)):
+            sam_input = [sam_input_prepare(input_images[b], current[b], image_embeddings[b:b + 1], resize_transform,
+                                           use_point=use_point, use_box=use_box, use_mask=use_mask, add_neg=add_neg,
+                                           margin=margin, gamma=gamma, strength=strength)[0] for b in active]
+        idx = torch.tensor(active, device=image_embeddings.device)
+        with torch.no_grad(), timed(timer, "refiner_decoder", iter=i, images=len(active)):
+            if not use_samhq:
+                outputs = sam.forward_with_image_embeddings(image_embeddings[idx], sam_input, multimask_output=True)
+            else:
+                outputs = sam.forward_with_image_embeddings(image_embeddings[idx], interm_embeddings[idx], sam_input,
+                                                            multimask_output=True)
+        iters_run = i + 1
+        still_active = []
+        for b, sam_output in zip(active, outputs):
+            sam_masks, logits[b] = _select_best(sam_output)
+            ious[b] = sam_output['iou_predictions']
+            binary = sam_masks > 0
+            current[b] = binary.to(torch.uint8)
+            scores = ious[b].max(dim=1).values
+            if b in prev and _converged(prev[b][0], binary, prev[b][1], scores, stop_iou, stop_score_delta):
+                continue
+            prev[b] = (binary, scores)
+            still_active.append(b)
+        active = still_active
+
+    if timer is not None:
+        timer.meta["refiner_iters"] = iters_run
+    results = []
+    for b, ori_size in enumerate(ori_sizes):
+        if b not in current:
+            results.append((np.zeros((0,) + ori_size, dtype=np.uint8), torch.zeros((0, 3), device=sam.device)))
+            continue
+        refined = current[b]
+        if work_shapes[b] is not None and b in logits:
+            with timed(timer, "upsample"):
+                refined = _upsample_logits(sam, logits[b], tuple(input_images[b].shape[-2:]), ori_size)
+        with timed(timer, "postprocess"):
+            results.append((refined.cpu().numpy().astype(np.uint8), ious.get(b)))
+    return results
@@ -0,0 +1,148 @@
+"""提示推理的分阶段计时
+
+每次提示推理生成一条StageTimer记录，可追加到JSONL日志并汇总p50/p95:
+
+    python -m src.timing timing.jsonl
+"""
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class StageTimer:
+    """单次推理的分阶段耗时记录
+
+    sync为可选的同步函数(如torch.cuda.synchronize)，在每个阶段结束前调用，
+    保证GPU上的异步计算被计入对应阶段。
+    """
+
+    def __init__(self, sync=None, **meta):
+        self.sync = sync
+        self.meta = dict(meta)
+        self.stages = []
+        self.timestamp = time.time()
+        self._t0 = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name, **meta):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync is not None:
+                self.sync()
+            self.add(name, (time.perf_counter() - t0) * 1000.0, **meta)
+
+    def add(self, name, ms, **meta):
+        record = {"name": name, "ms": ms}
+        record.update(meta)
+        self.stages.append(record)
+
+    def total_ms(self):
+        return (time.perf_counter() - self._t0) * 1000.0
+
+    def stage_totals(self):
+        """同名阶段(如各轮精修)合并求和，按首次出现的顺序"""
+        totals = OrderedDict()
+        for s in self.stages:
+            totals[s["name"]] = totals.get(s["name"], 0.0) + s["ms"]
+        return totals
+
+    def as_dict(self):
+        return {
+            "timestamp": self.timestamp,
+            "total_ms": self.total_ms(),
+            "meta": self.meta,
+            "stages": self.stages,
+        }
+
+    def summary_line(self):
+        parts = [f"{name} {ms:.1f}" for name, ms in self.stage_totals().items()]
+        return f"总计 {self.total_ms():.1f}ms (" + ", ".join(parts) + ")"
+
+
+def timed(timer, name, **meta):
+    """timer为None时不计时，便于在可选计时的代码路径中使用"""
+    if timer is None:
+        return contextlib.nullcontext()
+    return timer.stage(name, **meta)
+
+
+class TimingLog:
+    """线程安全地把计时记录追加到JSONL文件"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, record):
+        if isinstance(record, StageTimer):
+            record = record.as_dict()
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def load_records(path):
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return records
+
+
+def summarize(records):
+    """每个阶段(同名合并)以及总耗时的p50/p95，返回{阶段: {"count", "p50", "p95"}}"""
+    per_stage = OrderedDict()
+    totals = []
+    for record in records:
+        totals.append(record["total_ms"])
+        merged = OrderedDict()
+        for s in record["stages"]:
+            merged[s["name"]] = merged.get(s["name"], 0.0) + s["ms"]
+        for name, ms in merged.items():
+            per_stage.setdefault(name, []).append(ms)
+    per_stage["total"] = totals
+    return OrderedDict(
+        (name, {"count": len(v), "p50": _percentile(v, 0.5), "p95": _percentile(v, 0.95)})
+        for name, v in per_stage.items()
+    )
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print("用法: python -m src.timing <timing.jsonl>")
+        return 1
+    records = load_records(argv[0])
+    print(f"记录数: {len(records)}")
+    print(f"{'阶段':<20}{'次数':>8}{'p50(ms)':>12}{'p95(ms)':>12}")
+    for name, s in summarize(records).items():
+        print(f"{name:<20}{s['count']:>8}{s['p50']:>12.1f}{s['p95']:>12.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
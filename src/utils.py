@@ -1,124 +1,9 @@
 import numpy as np
-from PyQt5.QtGui import QImage
 from torch.nn import functional as F
 import torch
 # from FastGeodis import FastGeodis
 import FastGeodis
 
-def qimage_to_numpy(image):
-    if image.isNull():
-        return None
-        
-    width = image.width()
-    height = image.height()
-    
-    if image.format() == QImage.Format_ARGB32 or image.format() == QImage.Format_ARGB32_Premultiplied:
-        ptr = image.constBits()
-        if ptr is None:
-            return None
-            
-        ptr.setsize(image.byteCount())
-        arr = np.array(ptr).reshape(height, width, 4)
-        return arr
-    
-    elif image.format() == QImage.Format_RGB32:
-        ptr = image.constBits()
-        if ptr is None:
-            return None
-            
-        ptr.setsize(image.byteCount())
-        arr = np.array(ptr).reshape(height, width, 4)
-        return arr
-    
-    elif image.format() == QImage.Format_RGB888:
-        ptr = image.constBits()
-        if ptr is None:
-            return None
-            
-        ptr.setsize(image.byteCount())
-        arr = np.array(ptr).reshape(height, width, 3)
-        return arr
-    
-    return None
-
-def numpy_to_qimage(array, format=QImage.Format_ARGB32):
-    if array is None:
-        return QImage()
-        
-    height, width = array.shape[:2]
-    
-    if len(array.shape) == 3:
-        if array.shape[2] == 4:
-            bytes_per_line = 4 * width
-            img = QImage(array.data, width, height, bytes_per_line, format)
-            return img
-        elif array.shape[2] == 3:
-            bytes_per_line = 3 * width
-            img = QImage(array.data, width, height, bytes_per_line, QImage.Format_RGB888)
-            return img
-    
-    elif len(array.shape) == 2:
-        bytes_per_line = width
-        img = QImage(array.data, width, height, bytes_per_line, QImage.Format_Grayscale8)
-        return img
-    
-    return QImage()
-
-def mask_has_content(mask_image):
-    try:
-        array = qimage_to_numpy(mask_image)
-        if array is None:
-            return False
-            
-        if array.shape[2] >= 4:
-            return np.any(array[:, :, 3] > 0)
-        return False
-    except Exception:
-        return False
-
-def numpy_mask_to_qimage(mask_array, color=None):
-    """将numpy掩码数组转换为QImage"""
-    if mask_array is None:
-        return QImage()
-    
-    try:
-        # 确保掩码是二值的
-        if mask_array.dtype != np.uint8:
-            mask_array = (mask_array * 255).astype(np.uint8)
-        
-        height, width = mask_array.shape[:2]
-        
-        # 创建ARGB32格式的图像
-        result = np.zeros((height, width, 4), dtype=np.uint8)
-        
-        # 设置默认颜色（红色）
-        if color is None:
-            color = [255, 0, 0, 128]  # 红色，半透明
-        
-        # 在掩码为真的地方设置颜色
-        mask_bool = mask_array > 128
-        result[mask_bool] = color
-        
-        # 转换为QImage
-        bytes_per_line = 4 * width
-        qimg = QImage(result.data, width, height, bytes_per_line, QImage.Format_ARGB32)
-        return qimg.copy()  # 创建副本以避免内存问题
-        
-    except Exception:
-        return QImage()
-        print(f"设置了 {pixels_set} 个像素")
-        
-        # 转换为QImage
-        bytes_per_line = 4 * width
-        qimg = QImage(result.data, width, height, bytes_per_line, QImage.Format_ARGB32)
-        return qimg.copy()  # 创建副本以避免内存问题
-        
-    except Exception as e:
-        print(f"转换掩码时出错: {e}")
-        import traceback
-        traceback.print_exc()
-        return QImage()
-
 def prepare_image(image, transform, device):
     image = transform.apply_image(image)
     image = torch.as_tensor(image, device=device) 
@@ -160,14 +45,105 @@ def get_mask_embed(mask, img_embed):
 
 
 
+def get_mask_embeds(masks, img_embed, chunk_pixels=1 << 24):
+    """Batched get_mask_embed for N masks.
+
+    Masks are converted to float and downsampled a few at a time, so at most about
+    chunk_pixels full-resolution float values exist at once.
+
+    :param masks: N x H x W, binary masks
+    :param img_embed: 1 x c x h x w, image embedding tensor
+    :return: N x c, mask embedding tensor
+    """
+    orig_H, orig_W = masks.shape[-2:]
+    embed_H, embed_W = img_embed.shape[-2:]
+    if orig_H >= orig_W:
+        resize_W = int(embed_H * orig_W / orig_H)
+        resize_H = embed_H
+    else:
+        resize_H = int(embed_W * orig_H / orig_W)
+        resize_W = embed_W
+    chunk = max(1, chunk_pixels // max(1, orig_H * orig_W))
+    mask_resize = torch.cat([
+        F.interpolate(masks[i:i + chunk, None].float(), size=(resize_H, resize_W), mode='nearest')
+        for i in range(0, max(1, len(masks)), chunk)
+    ])
+    query_embed = (img_embed[:, :, :resize_H, :resize_W] * mask_resize).sum(dim=(-2, -1)) / mask_resize.sum(dim=(-2, -1))
+    return query_embed
+
+
+def masks_to_boxes(mask):
+    """Tight inclusive boxes of N masks, (x1, y1, x2, y2) as int64; empty masks give (0, 0, 0, 0)."""
+    n, h, w = mask.shape
+    rows = mask.any(dim=2).to(torch.uint8)
+    cols = mask.any(dim=1).to(torch.uint8)
+    # any() keeps the uint8 dtype; torch.where needs a bool condition
+    nonempty = rows.any(dim=1).bool()
+    # argmax returns the first maximal index
+    y1 = rows.argmax(dim=1)
+    y2 = h - 1 - rows.flip(1).argmax(dim=1)
+    x1 = cols.argmax(dim=1)
+    x2 = w - 1 - cols.flip(1).argmax(dim=1)
+    boxes = torch.stack([x1, y1, x2, y2], dim=1)
+    return torch.where(nonempty[:, None], boxes, torch.zeros_like(boxes))
+
+
+def _strip_similarity_counts(embed, out_size, query_embed, rects, chunk=1 << 16):
+    """Count strip pixels whose upsampled embedding is similar (cos > 0.5) to their instance's query.
+
+    Equivalent to bilinearly upsampling embed (1 x c x h x w) to out_size and thresholding the cosine
+    similarity at every pixel, but only the pixels inside rects are sampled, with grid_sample, in
+    chunks of at most `chunk` points, so memory does not depend on the image size.
+
+    rects: list of (instance, y0, y1, x0, x1) in output pixels; returns one count per rect.
+    """
+    device = embed.device
+    out_h, out_w = out_size
+    coords, owners = [], []
+    for k, (inst, y0, y1, x0, x1) in enumerate(rects):
+        if y1 <= y0 or x1 <= x0:
+            continue
+        yy, xx = torch.meshgrid(torch.arange(y0, y1, device=device), torch.arange(x0, x1, device=device),
+                                indexing="ij")
+        coords.append(torch.stack([xx.reshape(-1), yy.reshape(-1)], dim=1))
+        owners.append(torch.full((yy.numel(),), k, dtype=torch.int64, device=device))
+    counts = torch.zeros(len(rects), device=device)
+    if not coords:
+        return counts
+    coords = torch.cat(coords).float()
+    owners = torch.cat(owners)
+    instance = torch.tensor([r[0] for r in rects], device=device)[owners]
+    # pixel centres in the normalised coordinates of F.interpolate(..., align_corners=False);
+    # border padding reproduces its clamping at the edges
+    grid = torch.stack([2 * (coords[:, 0] + 0.5) / out_w - 1, 2 * (coords[:, 1] + 0.5) / out_h - 1], dim=1)
+    for start in range(0, len(grid), chunk):
+        part = slice(start, start + chunk)
+        feats = F.grid_sample(embed, grid[part].view(1, 1, -1, 2), mode="bilinear",
+                              padding_mode="border", align_corners=False)[0, :, 0].t()
+        feats = feats / feats.norm(dim=-1, keepdim=True)
+        sim = (feats * query_embed[instance[part]].float()).sum(dim=-1) > 0.5
+        counts.index_add_(0, owners[part], sim.float())
+    return counts
+
+
 def extract_bboxes_expand(image_embeddings, mask, margin=0, img_path=None):
     """Compute bounding boxes from masks.
     mask: [num_instances,height, width,]. Mask pixels are either 1 or 0.
 
-    Returns: bbox array [num_instances, (y1, x1, y2, x2)].
+    All instances are handled in batched tensor ops; with margin > 0 each box side is pushed
+    out by up to 10% (at most 10 px) when the fraction of similar-embedding pixels in that
+    strip exceeds margin. Similarity is sampled only inside those strips, so memory stays
+    bounded on large images.
+
+    Returns: boxes [num_instances, (x1, y1, x2, y2)], box_masks, areas, expand_list.
     """
+    device = image_embeddings.device
     ori_h, ori_w = mask.shape[-2:]
-    if margin > 0 and ori_h > 0 and ori_w > 0:
+    boxes = masks_to_boxes(mask).to(device)
+    x1, y1, x2, y2 = boxes.unbind(dim=1)
+    expand_list = torch.zeros(len(boxes), dtype=torch.int64, device=device)
+
+    if margin > 0 and ori_h > 0 and ori_w > 0 and len(boxes) > 0:
         embed_H, embed_W = image_embeddings.shape[-2:]
         if ori_h >= ori_w:
             resize_W = int(embed_H * ori_w / ori_h)
@@ -175,186 +151,144 @@ def extract_bboxes_expand(image_embeddings, mask, margin=0, img_path=None):
         else:
             resize_H = int(embed_W * ori_h / ori_w)
             resize_W = embed_W
-        image_embeddings_resize = image_embeddings[:, :, :resize_H, :resize_W]
-        image_embeddings_resize = F.interpolate(image_embeddings_resize, size=(ori_h, ori_w), mode='bilinear')
-        image_embeddings_resize = image_embeddings_resize.permute(0, 2, 3, 1)
-        image_embeddings_resize = image_embeddings_resize / image_embeddings_resize.norm(dim=-1, keepdim=True)
-    
-    boxes = []
-    box_masks = []
-    areas = []
-    expand_list = []
-    for i in range(mask.shape[0]):
-        m = mask[i, :, :]
-        # Bounding box.
-        coord = torch.nonzero(m)
-        y_coord, x_coord = coord[:, 0], coord[:, 1]
-        try:
-            y1, x1 = int(y_coord.min()), int(x_coord.min())
-            y2, x2 = int(y_coord.max()), int(x_coord.max())
-        except:
-            y1, x1 = 0, 0
-            y2, x2 = 0, 0
-        
-        x1 = max(0, x1)
-        y1 = max(0, y1)
-        y2 = min(mask.shape[-2] - 1, y2)
-        x2 = min(mask.shape[-1] - 1, x2)
-        
+        embed_valid = image_embeddings[:, :, :resize_H, :resize_W].float()
+
+        query_embed = get_mask_embeds(mask.to(device), image_embeddings)
+        query_embed = query_embed / query_embed.norm(dim=-1, keepdim=True)
+
         box_h = y2 - y1
         box_w = x2 - x1
-        final_x1, final_x2, final_y1, final_y2 = x1, x2, y1, y2
-        changed = False
-        
-        if box_h > 0 and box_w > 0 and margin > 0 and ori_h > 0 and ori_w > 0:
-            steph = min(box_h * 0.1, 10)
-            stepw = min(box_w * 0.1, 10)
-            
-        
-            query_embed, mask_resize = get_mask_embed(m, image_embeddings)
-            query_embed = query_embed / query_embed.norm(dim=-1, keepdim=True)
-            sim = image_embeddings_resize @ query_embed.transpose(0, 1)
-            sim = sim.squeeze()
-            sim = sim > 0.5
-            assert len(sim.shape) == 2, (sim.shape, m.shape, x1, x2, y1, y2, image_embeddings_resize.shape, ori_h, ori_w, query_embed.shape, img_path, mask.shape)
-            
-            temp_x1 = int(x1-stepw)
-            
-            if temp_x1 > 0 and temp_x1 < x1:
-                context_area = (y2-y1) * (x1-temp_x1)
-                sim_context = sim[y1:y2, temp_x1:x1]
-                pos_area = sim_context.sum()
-                if pos_area / context_area > margin:
-                    final_x1 = temp_x1
-                    changed = True
-                    
-            temp_x2 = int(x2+stepw)
-            if temp_x2 < ori_w and temp_x2 > x2:
-                context_area = (y2-y1) * (temp_x2-x2)
-                sim_context = sim[y1:y2, x2:temp_x2]
-                pos_area = sim_context.sum()
-                if pos_area / context_area > margin:
-                    final_x2 = temp_x2
-                    changed = True
-                    
-            temp_y1 = int(y1-steph)
-            if temp_y1 > 0 and temp_y1 < y1:
-                context_area = (y1-temp_y1) * (x2-x1)
-                sim_context = sim[temp_y1:y1, x1:x2]
-                pos_area = sim_context.sum()
-                if pos_area / context_area > margin:
-                    final_y1 = temp_y1
-                    changed = True
-                    
-            temp_y2 = int(y2+steph)
-            if temp_y2 < ori_h and temp_y2 > y2:
-                context_area = (temp_y2-y2) * (x2-x1)
-                sim_context = sim[y2:temp_y2, x1:x2]
-                pos_area = sim_context.sum()
-                if pos_area / context_area > margin:
-                    final_y2 = temp_y2
-                    changed = True
-                
-        if changed:
-            expand_list.append(1)
-        else:
-            expand_list.append(0)
-            
-        x1, x2, y1, y2 = final_x1, final_x2, final_y1, final_y2
-        boxes.append(torch.tensor([x1, y1, x2, y2]))
-        box_mask = torch.zeros((m.shape[0], m.shape[1])).to(image_embeddings.device)
-        
-        box_mask[y1:y2, x1:x2] = 1
-        box_masks.append(box_mask)
-        areas.append(1.0*(x2-x1)*(y2-y1))
-    boxes = torch.stack(boxes, dim=0).reshape(-1, 4).to(image_embeddings.device)
-    box_masks = torch.stack(box_masks,dim=0).to(image_embeddings.device)
-    areas = torch.tensor(areas).reshape(-1).to(image_embeddings.device)
-    expand_list = torch.tensor(expand_list).reshape(-1).to(image_embeddings.device)
+        valid = (box_h > 0) & (box_w > 0)
+        steph = torch.clamp(box_h * 0.1, max=10)
+        stepw = torch.clamp(box_w * 0.1, max=10)
+        temp_x1 = torch.trunc(x1 - stepw).long()
+        temp_x2 = torch.trunc(x2 + stepw).long()
+        temp_y1 = torch.trunc(y1 - steph).long()
+        temp_y2 = torch.trunc(y2 + steph).long()
+        # context strips (condition, y0, y1, x0, x1) on the left, right, top and bottom of each box
+        sides = [
+            ((temp_x1 > 0) & (temp_x1 < x1), y1, y2, temp_x1, x1),
+            ((temp_x2 < ori_w) & (temp_x2 > x2), y1, y2, x2, temp_x2),
+            ((temp_y1 > 0) & (temp_y1 < y1), temp_y1, y1, x1, x2),
+            ((temp_y2 < ori_h) & (temp_y2 > y2), y2, temp_y2, x1, x2),
+        ]
+        sides = [(valid & cond, ys0.clamp(0, ori_h), ys1.clamp(0, ori_h), xs0.clamp(0, ori_w), xs1.clamp(0, ori_w))
+                 for cond, ys0, ys1, xs0, xs1 in sides]
+
+        # similarity is only evaluated inside the strips that can actually expand a box
+        strips = [(k, i) for k, side in enumerate(sides) for i in torch.nonzero(side[0]).flatten().tolist()]
+        rects = [(i, *(int(t[i]) for t in sides[k][1:])) for k, i in strips]
+        pos_area = torch.zeros(len(sides), len(boxes), device=device)
+        if strips:
+            k_idx, i_idx = torch.tensor(strips, device=device).unbind(dim=1)
+            pos_area[k_idx, i_idx] = _strip_similarity_counts(embed_valid, (ori_h, ori_w), query_embed, rects)
+
+        left, right, top, bottom = [
+            cond & (pos_area[k] / ((ys1 - ys0) * (xs1 - xs0)).clamp(min=1).float() > margin)
+            for k, (cond, ys0, ys1, xs0, xs1) in enumerate(sides)
+        ]
+
+        x1 = torch.where(left, temp_x1, x1)
+        x2 = torch.where(right, temp_x2, x2)
+        y1 = torch.where(top, temp_y1, y1)
+        y2 = torch.where(bottom, temp_y2, y2)
+        expand_list = (left | right | top | bottom).long()
+
+    boxes = torch.stack([x1, y1, x2, y2], dim=1)
+    ys = torch.arange(ori_h, device=device)
+    xs = torch.arange(ori_w, device=device)
+    in_y = (ys[None, :] >= y1[:, None]) & (ys[None, :] < y2[:, None])
+    in_x = (xs[None, :] >= x1[:, None]) & (xs[None, :] < x2[:, None])
+    box_masks = (in_y[:, :, None] & in_x[:, None, :]).float()
+    areas = ((x2 - x1) * (y2 - y1)).float()
     return boxes, box_masks, areas, expand_list
 
 
 
 
+def _crop_distance_transforms(crops, v, lamb, iterations):
+    """FastGeodis distance transform of each 2D float softmask crop (0 marks seeds) at its own size.
+
+    FastGeodis only accepts single-image batches, so the crops go through it one at a time; each
+    call allocates buffers the size of its crop, never of the largest crop or the image.
+    """
+    dists = []
+    for crop in crops:
+        softmask = crop[None, None]
+        image_pt = torch.ones_like(softmask)
+        dists.append(FastGeodis.generalised_geodesic2d(image_pt, softmask, v, lamb, iterations)[0, 0])
+    return dists
+
+
+def _first_argmax(values):
+    """Row-major (y, x) of the first maximum of a 2D map, with the maximum; (0, 0, 0) when empty."""
+    if values.numel() == 0:
+        return 0, 0, values.new_zeros(())
+    flat = values.flatten()
+    peak = flat.max()
+    # max() does not promise the first index; pick the first position equal to the peak
+    idx = int(torch.nonzero(flat == peak)[0])
+    return idx // values.shape[-1], idx % values.shape[-1], peak
+
+
 def extract_points(pred_masks, add_neg=True, use_mask=True, gamma=1.0):
-    
-    point_coords = []
-    point_labels = []
-    gaus_dt = []
-    
-    image_pt = torch.ones(pred_masks.shape[-2:]).float().unsqueeze_(0).unsqueeze_(0).to(pred_masks.device)
+    """Positive/negative point prompts and Gaussian mask-prompt weights for N masks.
+
+    The distance transforms only need each mask's neighbourhood: the positive transform
+    (distance to the nearest background pixel) is computed on the bounding box plus a one
+    pixel ring, the negative one (distance to the mask, used only inside the box) on the box
+    itself, so the cost follows object size rather than image area. An empty mask has no
+    seeds and is transformed over the whole image, as before.
+    """
+    device = pred_masks.device
+    n, h, w = pred_masks.shape
     v = 1e10
     # lamb = 0.0 (Euclidean) or 1.0 (Geodesic) or (0.0, 1.0) (mixture)
     lamb = 0.0
     iterations = 2
-    for idx, pred_mask in enumerate(pred_masks):
-        h, w = pred_mask.shape
-       
-        
-        #pos point
-        pred_mask_dt = FastGeodis.generalised_geodesic2d(
-            image_pt, pred_mask.unsqueeze(0).unsqueeze(0), v, lamb, iterations
-        )
-        pred_mask_dt = pred_mask_dt.squeeze()
-        
-        
-        pred_max_dist = pred_mask_dt.max()
-        coords_y, coords_x = torch.where(pred_mask_dt == pred_max_dist)  # coords is [y, x]
-        point_coords.append([coords_x[0], coords_y[0]])
+    if n == 0:
+        points = 2 if add_neg else 1
+        return (torch.zeros(0, points, 2, dtype=torch.int64, device=device),
+                torch.zeros(0, points, dtype=torch.int64, device=device),
+                torch.zeros(0, h, w, device=device) if use_mask else [])
+
+    boxes = masks_to_boxes(pred_masks).tolist()
+    nonempty = pred_masks.flatten(1).any(dim=1).tolist()
+    pos_windows = []
+    for (xmin, ymin, xmax, ymax), has_mask in zip(boxes, nonempty):
+        if has_mask:
+            pos_windows.append((max(ymin - 1, 0), min(ymax + 2, h), max(xmin - 1, 0), min(xmax + 2, w)))
+        else:
+            pos_windows.append((0, h, 0, w))
+    pos_dist = _crop_distance_transforms(
+        [pred_masks[i, y0:y1, x0:x1].float() for i, (y0, y1, x0, x1) in enumerate(pos_windows)], v, lamb, iterations)
+
+    point_coords, point_labels, pos_peaks = [], [], []
+    for i, ((y0, _, x0, _), dist) in enumerate(zip(pos_windows, pos_dist)):
+        py, px, peak = _first_argmax(dist)
+        pos_peaks.append(peak)
+        point_coords.append([px + x0, py + y0])
         point_labels.append(1)
-        
-        coord = torch.nonzero(pred_mask)
-        y_coord, x_coord = coord[:, 0], coord[:, 1]
-        try:
-            ymin, xmin = int(y_coord.min()), int(x_coord.min())
-            ymax, xmax = int(y_coord.max()), int(x_coord.max())
-        except:
-            ymin, xmin = 0, 0
-            ymax, xmax = 0, 0
-
-        
-        box_mask = torch.zeros_like(pred_mask).to(pred_masks.device)
-        box_mask[ymin:ymax, xmin:xmax] = 1
-        
         if add_neg:
-            pred_mask_rev = pred_mask.clone().detach()
-            
-            assert pred_mask_rev.dtype == torch.uint8, "unsuitable data type {}".format(pred_mask_rev.dtype)
-            assert pred_mask_rev.device == pred_mask.device
-            pred_mask_rev[pred_mask_rev > 0] = 255
-            pred_mask_rev = (~pred_mask_rev) / 255
-            assert pred_mask_rev.max() <= 1
-            
-            pred_mask_dt_rev = FastGeodis.generalised_geodesic2d(
-                image_pt, pred_mask_rev.unsqueeze(0).unsqueeze(0), v, lamb, iterations
-            )
-            pred_mask_dt_rev = pred_mask_dt_rev.squeeze()
+            xmin, ymin, xmax, ymax = boxes[i]
+            crop = (pred_masks[i, ymin:ymax + 1, xmin:xmax + 1] == 0).float()
+            neg_dist = _crop_distance_transforms([crop], v, lamb, iterations)[0]
+            # the box excludes its last row and column, as box_mask[ymin:ymax, xmin:xmax] did
+            ny, nx, neg_peak = _first_argmax(neg_dist[:-1, :-1])
+            # a box without background pixels leaves an all-zero map; its first maximum is (0, 0)
+            point_coords.append([nx + xmin, ny + ymin] if neg_peak > 0 else [0, 0])
+            point_labels.append(0)
 
-            pred_mask_dt_rev[box_mask == 0] = 0
+    point_coords = torch.tensor(point_coords, dtype=torch.int64, device=device).reshape(n, -1, 2)
+    point_labels = torch.tensor(point_labels, dtype=torch.int64, device=device).reshape(n, -1)
 
-            pred_max_dist_rev = pred_mask_dt_rev.max()
-            coords_y_neg, coords_x_neg = torch.where(pred_mask_dt_rev == pred_max_dist_rev)  # coords is [y, x]
-            
-            point_coords.append([coords_x_neg[0], coords_y_neg[0]])
-            point_labels.append(0)
-        
-        if use_mask:
-            pred_mask_dt_copy = pred_mask_dt.clone().detach()
-
-            
-            boxh, boxw = ymax-ymin, xmax-xmin
-            mask_area = pred_mask.sum() / gamma
-            mask_area = max(mask_area, 1)
-            pred_max_dist = pred_mask_dt.max()
-            pred_mask_dt0 = pred_mask_dt - pred_max_dist
-            pred_mask_dt0 = torch.exp(-pred_mask_dt0*pred_mask_dt0/mask_area)
-            pred_mask_dt0[pred_mask_dt_copy==0] = 0
-            gaus_dt.append(pred_mask_dt0)
-    
-    point_coords = torch.tensor(point_coords).reshape(len(pred_masks),-1,2).to(pred_masks.device)
-    point_labels = torch.tensor(point_labels).reshape(len(pred_masks),-1).to(pred_masks.device)
+    gaus_dt = []
     if use_mask:
-        gaus_dt = torch.stack(gaus_dt, dim=0).to(pred_masks.device)
+        mask_area = torch.clamp(pred_masks.flatten(1).sum(dim=1) / gamma, min=1).tolist()
+        gaus_dt = torch.zeros(n, h, w, device=device)
+        for i, ((y0, y1, x0, x1), dist, peak) in enumerate(zip(pos_windows, pos_dist, pos_peaks)):
+            gaus = torch.exp(-(dist - peak) ** 2 / mask_area[i])
+            gaus_dt[i, y0:y1, x0:x1] = torch.where(dist != 0, gaus, torch.zeros_like(gaus))
     return point_coords, point_labels, gaus_dt
 
 
@@ -392,13 +326,12 @@ def extract_mask(pred_masks, gaus_dt, target_size, is01, strength=15, device=0,
             )
 
     if is01:
-        for i in range(len(pred_masks)):
-            if expand_list[i] == 0:
-                pred_masks[pred_masks<=0] = -1*strength
-                pred_masks[pred_masks>0] = strength
-            else:
-                pred_masks[pred_masks<=0] = -1
-                pred_masks[pred_masks>0] = 1
+        # per-instance amplitude: strength for boxes that were not expanded, 1 for expanded ones
+        expand_list = torch.as_tensor(expand_list, device=pred_masks.device).reshape(-1, 1, 1, 1)
+        amplitude = torch.where(expand_list == 0,
+                                torch.full_like(expand_list, strength, dtype=pred_masks.dtype),
+                                torch.ones_like(expand_list, dtype=pred_masks.dtype))
+        pred_masks = torch.where(pred_masks > 0, amplitude, -amplitude)
 
         gaus_dt[gaus_dt<=0] = 1
         pred_masks = pred_masks * gaus_dt
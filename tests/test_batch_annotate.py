@@ -0,0 +1,60 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+from src.batch_annotate import annotate, iter_masks, mask_output_paths
+
+
+class FakeEngine:
+    """框内置1的假推理引擎；路径在fail中时抛出异常"""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+
+    def run_prompt_inference_batch(self, image, boxes, np_img=None):
+        if image in self.fail:
+            raise RuntimeError("boom")
+        masks = np.zeros((len(boxes),) + np_img.shape[:2], dtype=np.uint8)
+        for i, (x1, y1, x2, y2) in enumerate(boxes):
+            masks[i, int(y1):int(y2), int(x1):int(x2)] = 1
+        return masks, np.ones(len(boxes), dtype=np.float32)
+
+
+def make_image(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.fromarray(np.zeros((16, 20, 3), dtype=np.uint8)).save(path)
+    return str(path)
+
+
+def test_same_name_in_different_dirs_keeps_both(tmp_path):
+    a = make_image(tmp_path / "in" / "a" / "001.png")
+    b = make_image(tmp_path / "in" / "b" / "001.png")
+    out_dir = str(tmp_path / "out")
+    written, skipped, failed = annotate([(a, [[0, 0, 4, 4]]), (b, [[4, 4, 8, 8]])], out_dir, FakeEngine())
+    assert (written, skipped, failed) == (2, 0, 0)
+    mask_a = np.array(Image.open(os.path.join(out_dir, "a", "001_mask.png")))
+    mask_b = np.array(Image.open(os.path.join(out_dir, "b", "001_mask.png")))
+    assert mask_a[0, 0] == 0 and mask_a[5, 5] == 255
+    assert mask_b[0, 0] == 255 and mask_b[5, 5] == 0
+
+
+def test_flat_input_keeps_flat_output(tmp_path):
+    a = make_image(tmp_path / "in" / "001.png")
+    assert mask_output_paths([a], "out") == {a: os.path.join("out", "001_mask.png")}
+
+
+def test_same_stem_in_one_dir_is_rejected(tmp_path):
+    a = make_image(tmp_path / "001.png")
+    b = make_image(tmp_path / "001.jpg")
+    with pytest.raises(ValueError):
+        mask_output_paths([a, b], str(tmp_path / "out"))
+
+
+def test_inference_failure_is_counted_and_run_continues(tmp_path):
+    a = make_image(tmp_path / "in" / "a.png")
+    b = make_image(tmp_path / "in" / "b.png")
+    items = [(a, [[0, 0, 4, 4]]), (b, [[0, 0, 4, 4]])]
+    results = list(iter_masks(items, FakeEngine(fail=[a])))
+    assert [(path, masks is None) for path, masks, _ in results] == [(a, True), (b, False)]
+    written, skipped, failed = annotate(items, str(tmp_path / "out"), FakeEngine(fail=[a]))
+    assert (written, skipped, failed) == (1, 0, 1)
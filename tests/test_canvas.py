@@ -0,0 +1,65 @@
+import os
+import pytest
+
+pytest.importorskip("PyQt5")
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+from PyQt5.QtCore import Qt
+from PyQt5.QtTest import QTest
+from PyQt5.QtWidgets import QApplication, QWidget
+from src.Canvas import Canvas
+
+
+class Window(QWidget):
+    """只记录Canvas回调的主窗口替身"""
+
+    def __init__(self):
+        super().__init__()
+        self.applied = 0
+        self.canvas = Canvas(self)
+
+    def applyQueuedBoxes(self):
+        self.applied += 1
+
+    def clearQueuedBoxes(self):
+        self.canvas.clearQueuedBoxes()
+
+
+@pytest.fixture
+def window():
+    app = QApplication.instance() or QApplication([])
+    window = Window()
+    yield window
+    window.deleteLater()
+    app.processEvents()
+
+
+def test_escape_cancels_lasso_in_progress(window):
+    canvas = window.canvas
+    canvas.setDrawingMode("lasso")
+    canvas.isDrawingLasso = True
+    canvas.lassoPoints = [(1, 1), (5, 5)]
+    QTest.keyClick(canvas, Qt.Key_Escape)
+    assert not canvas.isDrawingLasso
+    assert canvas.lassoPoints == []
+
+
+def test_escape_cancels_lasso_before_clearing_queue(window):
+    canvas = window.canvas
+    canvas.queueBox([0, 0, 10, 10])
+    canvas.setDrawingMode("lasso")
+    canvas.isDrawingLasso = True
+    QTest.keyClick(canvas, Qt.Key_Escape)
+    assert not canvas.isDrawingLasso
+    assert canvas.queuedBoxes == [[0, 0, 10, 10]]
+    QTest.keyClick(canvas, Qt.Key_Escape)
+    assert canvas.queuedBoxes == []
+
+
+def test_enter_applies_queued_boxes_only_when_queued(window):
+    canvas = window.canvas
+    QTest.keyClick(canvas, Qt.Key_Return)
+    assert window.applied == 0
+    canvas.queueBox([0, 0, 10, 10])
+    QTest.keyClick(canvas, Qt.Key_Return)
+    QTest.keyClick(canvas, Qt.Key_Enter, Qt.KeypadModifier)
+    assert window.applied == 2
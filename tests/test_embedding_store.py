@@ -0,0 +1,63 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from src.embedding_cache import ImageEmbedding
+from src.embedding_store import EmbeddingStore
+
+KEY = "ab" + "0" * 38
+
+
+def make_embedding(seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return ImageEmbedding(
+        torch.randn(1, 256, 8, 8, generator=g),
+        [torch.randn(1, 8, 8, 32, generator=g)],
+        torch.randint(0, 255, (3, 96, 128), generator=g, dtype=torch.uint8),
+        (300, 400),
+        (96, 128),
+    )
+
+
+def test_roundtrip(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    embedding = make_embedding()
+    assert store.save(KEY, embedding)
+    loaded = store.load(KEY)
+    assert loaded.features.dtype == torch.float32
+    assert torch.allclose(loaded.features, embedding.features, atol=1e-2)
+    assert torch.equal(loaded.input_image, embedding.input_image)
+    assert loaded.original_size == (300, 400)
+    assert loaded.input_size == (96, 128)
+
+
+def test_save_existing_entry_is_success_and_keeps_files(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    assert store.save(KEY, make_embedding(0))
+    entry_dir = store._entry_dir(KEY)
+    before = {name: os.stat(os.path.join(entry_dir, name)).st_mtime_ns for name in os.listdir(entry_dir)}
+    assert store.save(KEY, make_embedding(1))
+    after = {name: os.stat(os.path.join(entry_dir, name)).st_mtime_ns for name in os.listdir(entry_dir)}
+    assert before == after
+
+
+def test_concurrent_saves_of_same_key(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    embedding = make_embedding()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda _: store.save(KEY, embedding), range(16)))
+    assert all(results)
+    assert store.load(KEY) is not None
+    leftovers = [name for name in os.listdir(store._entry_dir(KEY)) if ".tmp-" in name]
+    assert leftovers == []
+
+
+def test_corrupted_entry_is_discarded(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    assert store.save(KEY, make_embedding())
+    path = os.path.join(store._entry_dir(KEY), "features.npy")
+    arr = np.load(path)
+    arr[0, 0, 0, 0] += 1
+    np.save(path, arr)
+    assert store.load(KEY) is None
+    assert not store.contains(KEY)
@@ -0,0 +1,30 @@
+import numpy as np
+from PIL import Image
+from src.image_cache import decode_rgb
+
+
+def test_16bit_tiff_is_scaled_not_clipped(tmp_path):
+    values = np.linspace(0, 65535, 64 * 64).astype(np.uint16).reshape(64, 64)
+    path = str(tmp_path / "gray16.tif")
+    Image.fromarray(values).save(path)
+    assert Image.open(path).mode.startswith("I;16")
+    rgb = decode_rgb(path)
+    assert rgb.shape == (64, 64, 3) and rgb.dtype == np.uint8
+    assert np.array_equal(rgb[..., 0], (values >> 8).astype(np.uint8))
+    assert (rgb == 255).mean() < 0.01
+
+
+def test_float_tiff_is_stretched_to_8bit(tmp_path):
+    values = np.linspace(-1.0, 3.0, 32 * 32, dtype=np.float32).reshape(32, 32)
+    path = str(tmp_path / "float.tif")
+    Image.fromarray(values, "F").save(path)
+    rgb = decode_rgb(path)
+    assert rgb[0, 0, 0] == 0 and rgb[-1, -1, 0] == 255
+    assert np.all(np.diff(rgb[..., 0].ravel().astype(int)) >= 0)
+
+
+def test_8bit_rgb_is_unchanged(tmp_path):
+    values = np.random.default_rng(0).integers(0, 256, size=(8, 9, 3), dtype=np.uint8)
+    path = str(tmp_path / "rgb.png")
+    Image.fromarray(values).save(path)
+    assert np.array_equal(decode_rgb(path), values)
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+import src.inference as inference
+from src.inference import Config
+from benchmarks.tiny_model import TINY_TEST_MODEL, TinyInference
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    config = Config()
+    config.device = "cpu"
+    config.cpu_threads = 2
+    config.warmup = False
+    config.progressive_preview = False
+    config.crop_mode = True
+    config.embedding_store_dir = str(tmp_path / "store")
+    engine = TinyInference(TINY_TEST_MODEL, config)
+    # 这里只关心嵌入从哪里来；精修原样返回解码器掩膜
+    monkeypatch.setattr(inference, "sam_refiner", lambda image, masks, *args, **kwargs: (masks, None, None))
+    encodes = []
+    encode = engine._encode_image
+    monkeypatch.setattr(engine, "_encode_image", lambda np_img, timer=None: encodes.append(np_img.shape) or encode(np_img, timer))
+    engine.encodes = encodes
+    return engine
+
+
+@pytest.fixture
+def large_image(tmp_path):
+    rng = np.random.default_rng(0)
+    path = tmp_path / "large.png"
+    Image.fromarray(rng.integers(0, 255, size=(1536, 2048, 3), dtype=np.uint8)).save(path)
+    return str(path)
+
+
+SMALL_BOX = [1000.0, 700.0, 1080.0, 780.0]
+
+
+def test_crop_mode_is_opt_in():
+    assert Config().crop_mode is False
+
+
+def test_small_box_on_preencoded_image_reuses_full_embedding(engine, large_image):
+    assert engine._crop_window(np.array(SMALL_BOX), (1536, 2048)) is not None
+    assert engine.preencode(large_image)
+    engine.embedding_cache.clear()
+    del engine.encodes[:]
+
+    mask, _, record = engine.run_prompt_inference(large_image, SMALL_BOX, return_timing=True)
+
+    assert engine.encodes == []
+    assert record["meta"]["embedding_source"] != "encoder"
+    assert "crop_window" not in record["meta"]
+    assert mask.shape == (1, 1536, 2048)
+
+
+def test_small_box_without_embedding_encodes_crop_window(engine, large_image):
+    mask, _, record = engine.run_prompt_inference(large_image, SMALL_BOX, return_timing=True)
+
+    assert len(engine.encodes) == 1
+    assert engine.encodes[0] != (1536, 2048, 3)
+    assert "crop_window" in record["meta"]
+    assert mask.shape == (1, 1536, 2048)
+
+
+def test_caller_timer_collects_stages_until_finished(engine, large_image):
+    timer = engine.new_timer()
+    _, _, record = engine.run_prompt_inference(large_image, SMALL_BOX, return_timing=True, timer=timer)
+    assert record is None and engine.last_timing is None
+    with timer.stage("resize_to_canvas"):
+        pass
+    record = engine.finish_timing(timer)
+    names = [stage["name"] for stage in record["stages"]]
+    assert names[0] == "wait_model" and "decoder" in names and names[-1] == "resize_to_canvas"
+    assert record["meta"]["kind"] == "prompt"
+    assert engine.last_timing is record
+
+
+def test_failed_warmup_does_not_stop_loading(monkeypatch):
+    def fail(self, np_img, box):
+        raise RuntimeError("out of memory")
+
+    monkeypatch.setattr(TinyInference, "_warmup_pass", fail)
+    config = Config()
+    config.device = "cpu"
+    config.cpu_threads = 2
+    config.warmup = True
+    config.warmup_image_size = (64, 64)
+    config.progressive_preview = False
+    messages = []
+    engine = TinyInference(TINY_TEST_MODEL, config, progress_callback=messages.append)
+    assert engine.warmup_timing is None
+    assert any("预热失败" in m and "out of memory" in m for m in messages)
+    assert engine.model_hq is not None
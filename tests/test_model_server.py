@@ -0,0 +1,164 @@
+import multiprocessing
+import os
+import threading
+import time
+import numpy as np
+import pytest
+from multiprocessing import AuthenticationError
+from PIL import Image
+from src.model_server import ModelServer, RemoteInference
+from src.sam_refiner import RefinementCancelled
+
+
+class BlockingEngine:
+    """直到should_cancel()为True才返回的推理引擎，记录被取消的请求"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.cancelled = []
+
+    def run_prompt_inference(self, image, box, multimask_output=None, hq_token_only=False, on_preview=None,
+                             return_timing=False, should_cancel=None):
+        self.started.set()
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            if should_cancel():
+                self.cancelled.append(box)
+                raise RefinementCancelled("请求已被取消")
+            time.sleep(0.01)
+        raise AssertionError("should_cancel never became true")
+
+
+class MaskEngine:
+    """按解析后的multimask_output返回3张或1张全1掩膜"""
+
+    def __init__(self, multimask_output):
+        self.config = type("Config", (), {"multimask_output": multimask_output})()
+
+    def run_prompt_inference(self, image, box, multimask_output=None, hq_token_only=False, on_preview=None,
+                             return_timing=False, should_cancel=None):
+        if multimask_output is None:
+            multimask_output = self.config.multimask_output
+        masks = np.ones((3 if multimask_output else 1, 32, 48), dtype=np.uint8)
+        return masks, None, None
+
+
+def start_server(address, engine, authkey=b"test"):
+    server = ModelServer(address=address, engine=engine, authkey=authkey)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    deadline = time.time() + 5
+    while not os.path.exists(server.address) and time.time() < deadline:
+        time.sleep(0.01)
+    server.thread = thread
+    return server
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = start_server(str(tmp_path / "server.sock"), BlockingEngine())
+    yield server
+    server.shutdown()
+
+
+def test_shutdown_is_idempotent_and_stops_serving(server):
+    server.shutdown()
+    server.shutdown()
+    server.thread.join(5)
+    assert not server.thread.is_alive()
+    assert not os.path.exists(server.address)
+
+
+def test_connect_fails_without_server(tmp_path):
+    with pytest.raises(OSError):
+        RemoteInference(str(tmp_path / "missing.sock"), authkey=b"test")
+
+
+def test_generated_key_and_socket_are_private(tmp_path, monkeypatch):
+    monkeypatch.delenv("SAM_MODEL_SERVER_AUTHKEY", raising=False)
+    server = start_server(str(tmp_path / "run" / "server.sock"), BlockingEngine(), authkey=None)
+    try:
+        key_file = server.address + ".key"
+        assert os.stat(key_file).st_mode & 0o777 == 0o600
+        assert os.stat(server.address).st_mode & 0o077 == 0
+        assert os.stat(os.path.dirname(server.address)).st_mode & 0o077 == 0
+        RemoteInference(server.address).close()
+        with pytest.raises(AuthenticationError):
+            RemoteInference(server.address, authkey=b"wrong")
+    finally:
+        server.shutdown()
+    assert not os.path.exists(key_file)
+
+
+def serve_masks(address):
+    ModelServer(address=address, engine=MaskEngine(multimask_output=True), authkey=b"test").serve_forever()
+
+
+def test_default_multimask_is_resolved_before_sizing_result(tmp_path, image):
+    # 服务端在单独进程中运行，与实际部署一样各自管理共享内存的登记
+    address = str(tmp_path / "multi.sock")
+    process = multiprocessing.get_context("fork").Process(target=serve_masks, args=(address,), daemon=True)
+    process.start()
+    try:
+        deadline = time.time() + 5
+        while not os.path.exists(address) and time.time() < deadline:
+            time.sleep(0.01)
+        client = RemoteInference(address, authkey=b"test")
+        masks, _ = client.run_prompt_inference(image, [0, 0, 10, 10])
+        assert masks.shape == (3, 32, 48)
+        masks, _ = client.run_prompt_inference(image, [0, 0, 10, 10], multimask_output=False)
+        assert masks.shape == (1, 32, 48)
+        client.close()
+    finally:
+        process.terminate()
+        process.join(5)
+
+
+def test_close_releases_connections(server):
+    client = RemoteInference(server.address, authkey=b"test")
+    client.close()
+    client.close()
+
+
+@pytest.fixture
+def image(tmp_path):
+    path = tmp_path / "image.png"
+    Image.fromarray(np.zeros((32, 48, 3), dtype=np.uint8)).save(path)
+    return str(path)
+
+
+def test_cancel_reaches_running_request(server, image):
+    client = RemoteInference(server.address, authkey=b"test")
+    cancel = threading.Event()
+    threading.Thread(target=lambda: server.engine.started.wait(5) and cancel.set(), daemon=True).start()
+    t0 = time.time()
+    with pytest.raises(RefinementCancelled):
+        client.run_prompt_inference(image, [0, 0, 10, 10], should_cancel=cancel.is_set)
+    assert time.time() - t0 < 5
+    assert server.engine.cancelled == [[0.0, 0.0, 10.0, 10.0]]
+    client.close()
+
+
+def test_cancel_before_send_does_not_reach_engine(server, image):
+    client = RemoteInference(server.address, authkey=b"test")
+    with pytest.raises(RefinementCancelled):
+        client.run_prompt_inference(image, [0, 0, 10, 10], should_cancel=lambda: True)
+    assert not server.engine.started.is_set()
+    client.close()
+
+
+class FailingEngine:
+    def run_prompt_inference(self, *args, **kwargs):
+        raise ValueError("boom")
+
+
+def test_engine_failure_is_not_reported_as_cancel(tmp_path, image):
+    server = start_server(str(tmp_path / "failing.sock"), FailingEngine())
+    try:
+        client = RemoteInference(server.address, authkey=b"test")
+        with pytest.raises(RuntimeError, match="ValueError: boom") as info:
+            client.run_prompt_inference(image, [0, 0, 10, 10])
+        assert not isinstance(info.value, RefinementCancelled)
+        client.close()
+    finally:
+        server.shutdown()
@@ -0,0 +1,46 @@
+import itertools
+import pytest
+import torch
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("onnx")
+from src.onnx_backend import OnnxSamBackend, _BoxDecoderWrapper, _EncoderWrapper
+from benchmarks.tiny_model import TINY_TEST_MODEL, build_tiny_sam_hq
+
+
+@pytest.fixture(scope="module")
+def sam():
+    torch.manual_seed(0)
+    return build_tiny_sam_hq(**TINY_TEST_MODEL).eval()
+
+
+@pytest.fixture(scope="module")
+def backend(sam, tmp_path_factory):
+    return OnnxSamBackend(sam, "tiny", "random-init", str(tmp_path_factory.mktemp("onnx")))
+
+
+@pytest.fixture(scope="module")
+def embeddings(sam, backend):
+    torch.manual_seed(1)
+    image = torch.randn(1, 3, 1024, 1024)
+    with torch.no_grad():
+        expected = _EncoderWrapper(sam.image_encoder)(image)
+    return expected, backend.encode(image)
+
+
+def test_encoder_matches_torch(embeddings):
+    (features, interm), (onnx_features, onnx_interm) = embeddings
+    torch.testing.assert_close(onnx_features, features, atol=1e-3, rtol=1e-3)
+    torch.testing.assert_close(onnx_interm, interm, atol=1e-3, rtol=1e-3)
+
+
+@pytest.mark.parametrize("multimask_output,hq_token_only", list(itertools.product((False, True), repeat=2)))
+def test_decoder_variant_matches_torch(sam, backend, embeddings, multimask_output, hq_token_only):
+    features, interm = embeddings[0]
+    boxes = torch.tensor([[100.0, 120.0, 400.0, 380.0], [0.0, 0.0, 1023.0, 1023.0], [500.0, 600.0, 520.0, 640.0]])
+    with torch.no_grad():
+        masks, scores = _BoxDecoderWrapper(sam, multimask_output, hq_token_only)(features, interm, boxes)
+    onnx_masks, onnx_scores = backend.decode(features, interm, boxes, multimask_output, hq_token_only)
+    assert onnx_masks.shape == masks.shape
+    torch.testing.assert_close(onnx_masks, masks, atol=1e-3, rtol=1e-3)
+    torch.testing.assert_close(onnx_scores, scores, atol=1e-3, rtol=1e-3)
@@ -0,0 +1,32 @@
+import pytest
+import torch
+from torch.nn import functional as F
+from src.utils import get_mask_embeds, masks_to_boxes
+
+# torch warns (or, in newer versions, fails) on uint8 conditions in torch.where
+pytestmark = pytest.mark.filterwarnings("error::UserWarning")
+
+
+def test_masks_to_boxes_with_empty_mask():
+    masks = torch.zeros(3, 8, 10, dtype=torch.uint8)
+    masks[0, 2:5, 3:7] = 1
+    masks[2, 7, 9] = 1
+    boxes = masks_to_boxes(masks)
+    assert boxes.dtype == torch.int64
+    assert boxes.tolist() == [[3, 2, 6, 4], [0, 0, 0, 0], [9, 7, 9, 7]]
+
+
+def test_masks_to_boxes_all_empty():
+    boxes = masks_to_boxes(torch.zeros(2, 4, 4, dtype=torch.uint8))
+    assert boxes.tolist() == [[0, 0, 0, 0], [0, 0, 0, 0]]
+
+
+def test_get_mask_embeds_chunked_matches_single_pass():
+    torch.manual_seed(0)
+    masks = torch.rand(5, 90, 120) > 0.5
+    img_embed = torch.randn(1, 8, 16, 16)
+    mask_resize = F.interpolate(masks[:, None].float(), size=(12, 16), mode='nearest')
+    expected = (img_embed[:, :, :12, :16] * mask_resize).sum(dim=(-2, -1)) / mask_resize.sum(dim=(-2, -1))
+    # two masks per chunk, so the last chunk is partial
+    torch.testing.assert_close(get_mask_embeds(masks, img_embed, chunk_pixels=2 * 90 * 120), expected)
+    torch.testing.assert_close(get_mask_embeds(masks, img_embed), expected)